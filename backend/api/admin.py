@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import MusicJob
+
+
+@admin.register(MusicJob)
+class MusicJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'duration', 'attempts', 'created_at', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('prompt', 'dedupe_key')
+    readonly_fields = ('created_at', 'updated_at')
@@ -0,0 +1,115 @@
+"""
+CPU-bound extraction steps that run in the local extraction process pool.
+
+Workers are started with the spawn method, so this module must stay importable on its own:
+it must not import Django or api.views.
+"""
+import io
+import os
+import unicodedata
+
+from PIL import Image, ImageOps, ImageSequence
+from pypdf import PdfReader
+
+
+def is_suspect_char(char):
+    code = ord(char)
+    return (
+        # Private use area: glyph codes from legacy Urdu fonts that have no Unicode mapping.
+        0xE000 <= code <= 0xF8FF or code >= 0xF0000
+        # Arabic presentation forms: shaped glyphs dumped in visual order instead of letters.
+        or 0xFB50 <= code <= 0xFDFF or 0xFE70 <= code <= 0xFEFF
+        or code == 0xFFFD
+        or (unicodedata.category(char) == 'Cc' and not char.isspace())
+    )
+
+
+def text_layer_usable(text, min_chars, max_suspect_ratio):
+    """A page's text layer is usable when it has enough text and almost none of it is broken glyph codes."""
+    visible = [char for char in text if not char.isspace()]
+    if len(visible) < min_chars:
+        return False
+    suspect = sum(1 for char in visible if is_suspect_char(char))
+    return suspect <= max_suspect_ratio * len(visible)
+
+
+def extract_pdf_text_layer(file_path, pages, min_chars, max_suspect_ratio):
+    """
+    Extract the embedded text of the given pages. Returns one entry per page: the text, or None
+    when the page is image-only or its text layer fails the quality check and needs OCR.
+    """
+    reader = PdfReader(file_path)
+    page_texts = []
+    for index in pages:
+        try:
+            text = reader.pages[index].extract_text() or ''
+        except Exception:
+            text = ''
+        page_texts.append(text if text_layer_usable(text, min_chars, max_suspect_ratio) else None)
+    return page_texts
+
+
+def flatten_frame(frame):
+    # Transparent areas become white paper rather than black once the alpha channel is dropped.
+    if frame.mode in ('RGBA', 'LA', 'PA') or (frame.mode == 'P' and 'transparency' in frame.info):
+        frame = frame.convert('RGBA')
+        background = Image.new('RGBA', frame.size, (255, 255, 255, 255))
+        frame = Image.alpha_composite(background, frame)
+    return frame.convert('L')
+
+
+def ocr_scale(size, dpi, target_dpi, max_edge, max_pixels):
+    width, height = size
+    scale = 1.0
+    if dpi and dpi > target_dpi:
+        scale = target_dpi / dpi
+    scale = min(scale, max_edge / max(width, height))
+    if width * height * scale * scale > max_pixels:
+        scale = (max_pixels / (width * height)) ** 0.5
+    return scale
+
+
+def encode_page(page, jpeg_quality, lossless_source):
+    buffer = io.BytesIO()
+    page.save(buffer, format='JPEG', quality=jpeg_quality, optimize=True)
+    encoded = (buffer.getvalue(), 'image/jpeg')
+    if lossless_source:
+        # Screenshots and line art from lossless formats are usually smaller as PNG.
+        buffer = io.BytesIO()
+        page.save(buffer, format='PNG')
+        if buffer.tell() < len(encoded[0]):
+            encoded = (buffer.getvalue(), 'image/png')
+    return encoded
+
+
+def preprocess_image(file_path, target_dpi, max_edge, max_pixels, jpeg_quality, max_frames):
+    """
+    Prepare an image upload for OCR: one page per frame, downsampled to at most target_dpi and
+    max_edge pixels on the long side, converted to grayscale and re-encoded. Returns a
+    list of (content, mime_type) pages, or None when the upload is a single frame that is already
+    smaller than anything re-encoding would produce and should be sent as it is.
+    """
+    with Image.open(file_path) as image:
+        frame_count = getattr(image, 'n_frames', 1)
+        if frame_count > max_frames:
+            raise ValueError(f"Image has {frame_count} frames; at most {max_frames} can be processed.")
+        dpi = image.info.get('dpi', (0, 0))[0]
+        original_size = os.path.getsize(file_path)
+        pages = []
+        resized = False
+        for frame in ImageSequence.Iterator(image):
+            long_edge = max(frame.size)
+            scale = ocr_scale(frame.size, dpi, target_dpi, max_edge, max_pixels)
+            if image.format == 'JPEG':
+                # Let the JPEG decoder do most of the downscaling and the grayscale conversion.
+                frame.draft('L', (round(frame.width * scale), round(frame.height * scale)))
+            page = flatten_frame(ImageOps.exif_transpose(frame))
+            if scale < 1.0:
+                # Measured after the EXIF rotation and any draft downscaling, so only the long edge is compared.
+                factor = scale * long_edge / max(page.size)
+                page = page.resize((max(1, round(page.width * factor)), max(1, round(page.height * factor))), Image.LANCZOS)
+                resized = True
+            pages.append(encode_page(page, jpeg_quality, lossless_source=image.format != 'JPEG'))
+    if len(pages) == 1 and not resized and len(pages[0][0]) >= original_size:
+        return None
+    return pages
@@ -1,3 +1,51 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class MusicJob(models.Model):
+    """
+    A prompt-based music generation request handled by the background worker pool.
+    Jobs with the same prompt and duration share a dedupe_key so repeat submissions
+    can be answered from an existing job.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    prompt = models.TextField()
+    duration = models.PositiveIntegerField()
+    dedupe_key = models.CharField(max_length=64, db_index=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    error_details = models.TextField(blank=True, default='')
+    error_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['dedupe_key', 'status'], name='api_musicjob_dedupe_status'),
+        ]
+        constraints = [
+            # At most one queued or running job per prompt+duration, across all worker processes.
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='api_musicjob_one_active_per_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
@@ -1,3 +1,950 @@
-from django.test import TestCase
-
-# Create your tests here.
+import asyncio
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from requests.exceptions import ConnectTimeout, ReadTimeout
+
+from .extraction_workers import extract_pdf_text_layer, preprocess_image, text_layer_usable
+from .views import (
+    LEXICON_EVIDENCE_SCALE, LOUDLY_ENDPOINTS, MAP_REDUCE_WINDOW_BYTES, MAX_BATCH_RENDERS, MAX_TEXT_LENGTH,
+    MIX_CHANNELS, MIX_CROSSFADE_FRAMES, MIX_SAMPLE_RATE, VALID_TONES, DiskLRUCache, LexiconClassifier,
+    MultiPatternMatcher, MusicGenerationError, NegotiationCache, UploadSpooler, UpstreamClient,
+    UpstreamUnavailableError, VoiceDirective, build_profanity_matcher, build_ssml, classify_with_lexicons,
+    compile_voice_directive, concat_mp3_bytes, concat_wav_bytes, content_defined_chunks, ducking_envelope,
+    extend_task_deadline, extract_text_from_file, find_profanity, fit_ssml_chunk, fold_for_matching,
+    gather_shard_results, get_async_loop_state, lexicon_tokens, load_urdu_dictionary, map_bounded,
+    mark_emphasis, mix_background_music, mp3_header_frame_length, ocr_pdf, open_pdf, parse_batch_render_request,
+    plan_analysis_windows, reduce_window_labels, render_pdf_shards, request_loudly_music, sniff_upload_type,
+    strip_id3_tags,
+)
+
+# 50 ms of a 440 Hz tone, 8 kHz mono, encoded by LAME through ffmpeg: CBR with an Info header frame.
+LAME_CBR_MP3 = zlib.decompress(base64.b64decode(
+    'eNr7/9jiAAMMeOal5QMpfiBmZmBg3MCwihC4Sgj8JwRA9vokliWbGeoZ6zEgARWmDxAG4wZ1xg3eDKSB/48ljjBwfWC7'
+    'utORgem/e8HtBDb+5ge/r3AwsSv8sKsXbn7wS6HxiOOH2h8Kr/cflmH7q9gX++e5/+6la321Vrd/m7RWV//SsWy3lSBz'
+    '+AU23FrBONODQads2VOj5T/XujgkKWxtUytqWCO47FGMSKCiSFdYZtpDluKLgsavvDmdHC5MTXB3jNA6vG/+ykkqvjnJ'
+    '83+BzGHn0ThmwniSg3GSppomz5YVS6YZuWiJGk+asjVgReoLz8hIYa+FUwI2ZQQcWD6buzG+c///Lh9HX1djPUMDA1iA'
+    'AwChUMAJ'
+))
+# The same tone encoded as VBR, which carries a Xing header frame.
+LAME_VBR_MP3 = zlib.decompress(base64.b64decode(
+    'eNr7/9jiAAMMRGTmpQMpfiBmBqIEhlWEwCtC4D8hALLXJ7Es2cxQz1iPAQmoMH2AMJgTwrzsjjCQBv4/jjjCoPhh2ox6'
+    'fwZGrtt59xtY31ff+773pVfQlKWaQNa+v49S7aKPr/E9vmbn5qsLGNgrKur/M/B8lP/H9v/HA/k/zPZ/bBjvN0j8//CB'
+    'vY4h+f/xBmsGBoMPQAAyHoPBkvjw4cMHIBFkxmNQ2Aq2t7f/ZmCQ/2db2cTAsPfbrfu54i7zn4X82nTS+1sUu+uc3TuD'
+    'DhutyDJMtprdcQQkMfeQ2K9Ds+cpqzT/OePQMF3Ua2HYoZqf51hcq/92fHgU1bLOsvdSkWPIsYlLDrVtnPMi4oGVkrZo'
+    'y5cdOwyW+4oaG0ndWRfumArScjDuf/7945X+fEI7bdl0JsTtXZvdHW26TjcrOPz+3u/+D92aOT+/eiUivt5lufM+Div+'
+    'By1ibAsDrv9v/zz7YMLLhJUXNTwfqfo4+roa6xkaGIRiAf8fWxy5rJvktCxyZgUDVAyvhiEC/j+WOAJMc8x/GIFRSIE5'
+    'AJrJcGE='
+))
+
+
+def wav_bytes(frames, channels=1, frame_rate=8000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as writer:
+        writer.setnchannels(channels)
+        writer.setsampwidth(2)
+        writer.setframerate(frame_rate)
+        writer.writeframes(np.asarray(frames, dtype=np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def id3v2_tag(payload, footer=False):
+    size = len(payload)
+    syncsafe = bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+    flags = b'\x10' if footer else b'\x00'
+    return b'ID3\x04\x00' + flags + syncsafe + payload + (b'3DI' + b'\x00' * 7 if footer else b'')
+
+
+class MultiPatternMatcherTests(SimpleTestCase):
+    def test_prefers_leftmost_then_longest_match(self):
+        matcher = MultiPatternMatcher(['he', 'she', 'hers', 'his'])
+        self.assertEqual(matcher.find('ushers'), [(1, 4)])
+
+    def test_term_containing_another_is_matched_whole(self):
+        matcher = MultiPatternMatcher(['kam', 'kamina'])
+        self.assertEqual(matcher.find('kamina kam'), [(0, 6), (7, 10)])
+
+    def test_matches_do_not_overlap(self):
+        matcher = MultiPatternMatcher(['aa'])
+        self.assertEqual(matcher.find('aaaaa'), [(0, 2), (2, 4)])
+
+    def test_empty_patterns_are_ignored(self):
+        self.assertFalse(MultiPatternMatcher([]))
+        self.assertFalse(MultiPatternMatcher(['']))
+        self.assertEqual(MultiPatternMatcher(['']).find('text'), [])
+
+
+class EmphasisMarkupTests(SimpleTestCase):
+    def test_marks_every_occurrence_in_one_pass(self):
+        matcher = MultiPatternMatcher(['خوش', 'very happy'])
+        self.assertEqual(
+            mark_emphasis('I am very happy, خوش and خوش', matcher),
+            'I am <emphasis level="strong">very happy</emphasis>, '
+            '<emphasis level="strong">خوش</emphasis> and <emphasis level="strong">خوش</emphasis>',
+        )
+
+    def test_ssml_escapes_text_around_markup(self):
+        matcher = MultiPatternMatcher(['loud'])
+        self.assertEqual(
+            build_ssml('a < b & loud', matcher),
+            '<speak>a &lt; b &amp; <emphasis level="strong">loud</emphasis></speak>',
+        )
+
+    def test_splits_chunk_when_markup_exceeds_budget(self):
+        matcher = MultiPatternMatcher(['word'])
+        chunk = ' '.join(['word'] * 20)
+        documents = fit_ssml_chunk(chunk, matcher, 400)
+        self.assertGreater(len(documents), 1)
+        self.assertTrue(all(len(document.encode('utf-8')) <= 400 for document in documents))
+        self.assertEqual(sum(document.count('<emphasis') for document in documents), 20)
+
+
+class DiskLRUCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def disk_bytes(self):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(self.directory) for name in names
+        )
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = DiskLRUCache(self.directory, max_bytes=10, ttl_seconds=60)
+        cache.set('aa-first', b'1111')
+        cache.set('bb-second', b'2222')
+        self.assertEqual(cache.get('aa-first'), b'1111')
+        cache.set('cc-third', b'3333')
+        self.assertIsNone(cache.get('bb-second'))
+        self.assertEqual(cache.get('aa-first'), b'1111')
+        self.assertEqual(cache.get('cc-third'), b'3333')
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'bb', 'bb-second')))
+
+    def test_overwrite_replaces_size(self):
+        cache = DiskLRUCache(self.directory, max_bytes=10, ttl_seconds=60)
+        cache.set('aa-key', b'12345678')
+        cache.set('aa-key', b'12')
+        cache.set('bb-key', b'12345678')
+        self.assertEqual(cache.get('aa-key'), b'12')
+        self.assertEqual(cache.get('bb-key'), b'12345678')
+
+    def test_entry_larger_than_cache_is_not_stored(self):
+        cache = DiskLRUCache(self.directory, max_bytes=4, ttl_seconds=60)
+        cache.set('aa-key', b'too large')
+        self.assertIsNone(cache.get('aa-key'))
+
+    def test_expired_entry_is_a_miss(self):
+        cache = DiskLRUCache(self.directory, max_bytes=100, ttl_seconds=-1)
+        cache.set('aa-key', b'value')
+        self.assertIsNone(cache.get('aa-key'))
+        self.assertEqual(cache.misses, 1)
+
+    def test_entry_written_by_another_process_is_a_hit(self):
+        writer = DiskLRUCache(self.directory, max_bytes=100, ttl_seconds=60)
+        reader = DiskLRUCache(self.directory, max_bytes=100, ttl_seconds=60)
+        self.assertIsNone(reader.get('aa-key'))
+        writer.set('aa-key', b'value')
+        self.assertEqual(reader.get('aa-key'), b'value')
+        self.assertEqual(reader.get_path('aa-key'), os.path.join(self.directory, 'aa', 'aa-key'))
+        self.assertEqual(reader.hits, 2)
+
+    def test_size_limit_applies_to_the_shared_directory(self):
+        first = DiskLRUCache(self.directory, max_bytes=10, ttl_seconds=60)
+        second = DiskLRUCache(self.directory, max_bytes=10, ttl_seconds=60)
+        first.set('aa-one', b'1111')
+        second.set('bb-two', b'2222')
+        first.set('cc-three', b'3333')
+        self.assertLessEqual(self.disk_bytes(), 10)
+        self.assertIsNone(second.get('aa-one'))
+        self.assertEqual(second.get('cc-three'), b'3333')
+
+    def test_entry_evicted_by_another_process_is_a_miss(self):
+        first = DiskLRUCache(self.directory, max_bytes=8, ttl_seconds=60)
+        second = DiskLRUCache(self.directory, max_bytes=8, ttl_seconds=60)
+        first.set('aa-one', b'1111')
+        self.assertEqual(second.get('aa-one'), b'1111')
+        first.set('bb-two', b'2222')
+        first.set('cc-three', b'3333')
+        self.assertIsNone(second.get('aa-one'))
+        self.assertEqual(second.stats()['entries'], 0)
+
+
+class UploadTypeSniffingTests(SimpleTestCase):
+    def test_identifies_binary_types_by_signature(self):
+        self.assertEqual(sniff_upload_type(b'%PDF-1.7\n', 'pdf'), 'pdf')
+        self.assertEqual(sniff_upload_type(b'\x89PNG\r\n\x1a\n....', 'jpg'), 'png')
+        self.assertEqual(sniff_upload_type(b'\xff\xd8\xff\xe0', 'jpeg'), 'jpeg')
+
+    def test_zip_is_only_accepted_as_docx(self):
+        self.assertEqual(sniff_upload_type(b'PK\x03\x04rest', 'docx'), 'docx')
+        self.assertIsNone(sniff_upload_type(b'PK\x03\x04rest', 'pdf'))
+
+    def test_text_must_be_utf8_without_nul_bytes(self):
+        self.assertEqual(sniff_upload_type('سلام'.encode('utf-8'), 'txt'), 'txt')
+        self.assertEqual(sniff_upload_type('سلام'.encode('utf-8')[:-1], 'txt'), 'txt')
+        self.assertIsNone(sniff_upload_type(b'\xff\xfe t\x00e\x00', 'txt'))
+
+    def test_unknown_content_is_rejected(self):
+        self.assertIsNone(sniff_upload_type(b'<html>', 'pdf'))
+
+
+class UploadSpoolerTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        patcher = mock.patch('api.views.UPLOAD_SPOOL_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def spooled_files(self):
+        return [name for _, _, names in os.walk(self.directory) for name in names]
+
+    def test_spools_content_with_hash_and_type(self):
+        spooler = UploadSpooler('notes.txt')
+        spooler.write(b'hello ')
+        spooler.write(b'world')
+        upload = spooler.finish()
+        self.addCleanup(upload.close)
+        self.assertIsNone(upload.error)
+        self.assertEqual(upload.kind, 'txt')
+        self.assertEqual(upload.size, 11)
+        self.assertEqual(upload.sha256, 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9')
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello world')
+        self.assertEqual(extract_text_from_file(upload.path, 'txt'), 'hello world')
+
+    def test_rejects_unsupported_content_without_keeping_a_file(self):
+        spooler = UploadSpooler('scan.pdf')
+        spooler.write(b'not a pdf')
+        upload = spooler.finish()
+        self.assertIsNotNone(upload.error)
+        self.assertIsNone(upload.path)
+        self.assertEqual(self.spooled_files(), [])
+
+    def test_rejects_empty_upload(self):
+        upload = UploadSpooler('empty.txt').finish()
+        self.assertEqual(upload.error, 'File is empty.')
+
+    def test_stops_at_size_limit(self):
+        spooler = UploadSpooler('big.txt')
+        with mock.patch('api.views.MAX_FILE_SIZE_ONLINE', 8):
+            spooler.write(b'12345')
+            spooler.write(b'67890')
+            spooler.write(b'more')
+        upload = spooler.finish()
+        self.assertTrue(upload.error.startswith('File is too large.'))
+        self.assertEqual(self.spooled_files(), [])
+
+    def test_close_removes_the_spool_file(self):
+        spooler = UploadSpooler('notes.txt')
+        spooler.write(b'text')
+        upload = spooler.finish()
+        path = upload.path
+        upload.close()
+        self.assertFalse(os.path.exists(path))
+
+
+class AudioConcatenationTests(SimpleTestCase):
+    def test_strip_id3_tags_removes_leading_and_trailing_tags(self):
+        audio = b'\xff\xfb\x90\x00frames'
+        tagged = id3v2_tag(b'TIT2title') + audio + b'TAG' + b'\x00' * 125
+        self.assertEqual(strip_id3_tags(tagged), audio)
+
+    def test_strip_id3_tags_skips_footer(self):
+        audio = b'\xff\xfb\x90\x00frames'
+        self.assertEqual(strip_id3_tags(id3v2_tag(b'payload', footer=True) + audio), audio)
+
+    def test_strip_id3_tags_leaves_untagged_audio_alone(self):
+        audio = b'\xff\xfb\x90\x00' * 40
+        self.assertEqual(strip_id3_tags(audio), audio)
+
+    def test_finds_encoder_header_frames(self):
+        # MPEG 2.5 layer III at 24 kbps and 8 kHz: 72 * 24000 / 8000 = 216 bytes, no padding.
+        self.assertEqual(LAME_CBR_MP3[13:17], b'Info')
+        self.assertEqual(mp3_header_frame_length(LAME_CBR_MP3), 216)
+        self.assertEqual(LAME_VBR_MP3[13:17], b'Xing')
+        self.assertEqual(mp3_header_frame_length(LAME_VBR_MP3), 216)
+
+    def test_audio_frames_are_not_header_frames(self):
+        self.assertEqual(mp3_header_frame_length(LAME_CBR_MP3[216:]), 0)
+        self.assertEqual(mp3_header_frame_length(b'\xff\xfbA'), 0)
+
+    def test_concat_mp3_bytes_drops_header_frames_of_every_chunk(self):
+        chunks = [id3v2_tag(b'one') + LAME_CBR_MP3, id3v2_tag(b'two') + LAME_CBR_MP3, LAME_VBR_MP3]
+        joined = concat_mp3_bytes(chunks)
+        self.assertEqual(joined, LAME_CBR_MP3[216:] + LAME_CBR_MP3[216:] + LAME_VBR_MP3[216:])
+        self.assertNotIn(b'Info', joined)
+        self.assertNotIn(b'Xing', joined)
+
+    def test_concat_mp3_bytes_joins_frames_without_tags(self):
+        chunks = [id3v2_tag(b'one') + b'\xff\xfbA', id3v2_tag(b'two') + b'\xff\xfbB']
+        self.assertEqual(concat_mp3_bytes(chunks), b'\xff\xfbA\xff\xfbB')
+        self.assertEqual(concat_mp3_bytes(chunks[:1]), chunks[0])
+
+    def test_concat_wav_bytes_keeps_one_header_and_all_frames(self):
+        joined = concat_wav_bytes([wav_bytes([1, 2, 3]), wav_bytes([4, 5])])
+        with wave.open(io.BytesIO(joined), 'rb') as reader:
+            self.assertEqual(reader.getnframes(), 5)
+            self.assertEqual(reader.getframerate(), 8000)
+            frames = np.frombuffer(reader.readframes(5), dtype=np.int16)
+        self.assertEqual(frames.tolist(), [1, 2, 3, 4, 5])
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.text = json.dumps(data) if data is not None else ''
+        self.headers = headers or {}
+        self.closed = False
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('no JSON body')
+        return self.data
+
+    def close(self):
+        self.closed = True
+
+
+class LoudlyNegotiationTests(SimpleTestCase):
+    def setUp(self):
+        self.negotiation = NegotiationCache(ttl_seconds=60, max_failures=2)
+        for target, value in [
+            ('api.views.LOUDLY_API_KEY', 'key'),
+            ('api.views.upstream_negotiation', self.negotiation),
+            ('api.views.music_store.prefetch', lambda url: None),
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def request(self, *outcomes):
+        calls = []
+
+        def post(url, **kwargs):
+            calls.append((url, kwargs.get('json', kwargs.get('data'))))
+            outcome = outcomes[len(calls) - 1]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        with mock.patch('api.views.loudly_client.post', side_effect=post):
+            try:
+                return request_loudly_music('calm piano', 60), calls
+            except MusicGenerationError as e:
+                return e, calls
+
+    def test_moves_to_next_payload_after_400_and_next_endpoint_after_other_errors(self):
+        song = {'music_file_path': 'https://cdn.example/song.mp3'}
+        result, calls = self.request(FakeResponse(400, {'error': 'bad'}), FakeResponse(500), FakeResponse(200, song))
+        self.assertEqual(result, song)
+        self.assertEqual([url for url, _ in calls], [LOUDLY_ENDPOINTS[0], LOUDLY_ENDPOINTS[0], LOUDLY_ENDPOINTS[1]])
+        self.assertEqual(self.negotiation.get('loudly'), (LOUDLY_ENDPOINTS[1], 'json-0'))
+
+    def test_learned_variant_is_tried_first(self):
+        self.negotiation.record_success('loudly', (LOUDLY_ENDPOINTS[1], 'json-2'))
+        song = {'music_file_path': 'https://cdn.example/song.mp3'}
+        _, calls = self.request(FakeResponse(200, song))
+        self.assertEqual(calls, [(LOUDLY_ENDPOINTS[1], {'data': {'prompt': 'calm piano', 'duration': 60}})])
+
+    def test_network_errors_skip_the_endpoint_and_surface_the_last_error(self):
+        result, calls = self.request(ConnectTimeout('down'), ConnectTimeout('down'))
+        self.assertIsInstance(result, MusicGenerationError)
+        self.assertEqual(result.status_code, 500)
+        self.assertEqual([url for url, _ in calls], LOUDLY_ENDPOINTS)
+
+
+class AsyncLoopStateTests(SimpleTestCase):
+    def test_clients_are_per_loop_and_closed_with_the_loop(self):
+        async def loop_http_client():
+            state = get_async_loop_state()
+            self.assertIs(get_async_loop_state(), state)
+            return state['http_client']
+
+        first = asyncio.run(loop_http_client())
+        second = asyncio.run(loop_http_client())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertTrue(second.is_closed)
+
+
+class BoundedFanOutTests(SimpleTestCase):
+    def test_results_keep_item_order(self):
+        self.assertEqual(map_bounded(lambda n: n * n, range(10)), [n * n for n in range(10)])
+
+    @mock.patch('api.views.ANALYZE_TASK_TIMEOUT', 0.05)
+    def test_slow_task_is_replaced_by_on_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        results = map_bounded(lambda item: release.wait(5) and item, ['slow'], on_timeout=lambda item: 'timed out')
+        self.assertEqual(results, ['timed out'])
+
+    @mock.patch('api.views.ANALYZE_TASK_TIMEOUT', 0.05)
+    def test_task_can_extend_its_deadline(self):
+        def large_task(item):
+            extend_task_deadline(5)
+            time.sleep(0.2)
+            return item
+
+        self.assertEqual(map_bounded(large_task, ['large'], on_timeout=lambda item: 'timed out'), ['large'])
+
+    def test_shards_are_cancelled_on_timeout(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        running = executor.submit(release.wait, 5)
+        queued = executor.submit(lambda: 'never')
+        with self.assertRaises(TimeoutError):
+            gather_shard_results([running, queued], 0.05)
+        self.assertTrue(queued.cancelled())
+
+
+class ProfanityMatchingTests(SimpleTestCase):
+    def setUp(self):
+        self.matcher = build_profanity_matcher(['کمینہ', 'bad'])
+
+    def matched_text(self, text, matcher=None):
+        return [text[start:end] for start, end in find_profanity(text, matcher or self.matcher)]
+
+    def test_folding_drops_diacritics_and_maps_positions(self):
+        folded, positions = fold_for_matching('کُتّا')
+        self.assertEqual(folded, 'کتا')
+        self.assertEqual(positions, [0, 2, 4])
+
+    def test_folding_collapses_repeated_letters_and_leetspeak(self):
+        self.assertEqual(fold_for_matching('B4AAD')[0], 'bad')
+
+    def test_arabic_letter_variants_match_urdu_entry(self):
+        self.assertEqual(self.matched_text('وہ كمينه ہے'), ['كمينه'])
+
+    def test_span_covers_tatweel_and_zero_width_characters(self):
+        text = 'وہ کمیـــن‌ہ ہے'
+        self.assertEqual(self.matched_text(text), ['کمیـــن‌ہ'])
+
+    def test_span_maps_back_to_original_spelling(self):
+        self.assertEqual(self.matched_text('such a b4aad day'), ['b4aad'])
+
+    def test_only_whole_words_match(self):
+        self.assertEqual(self.matched_text('badminton and abad'), [])
+
+    def test_shipped_blocklist_leaves_everyday_sentences_alone(self):
+        matcher = build_profanity_matcher(load_urdu_dictionary())
+        for text in ['مجھے کل یاد دلا دینا', 'اس نے مجھے ذلیل محسوس کرایا', 'usne chai mein cheeni dala']:
+            self.assertEqual(self.matched_text(text, matcher), [], text)
+        self.assertEqual(self.matched_text('وہ کمینہ ہے', matcher), ['کمینہ'])
+
+
+def stereo(value, frames):
+    return np.full((frames, MIX_CHANNELS), value, dtype=np.int16)
+
+
+class MixerTests(SimpleTestCase):
+    def test_ducking_envelope_of_empty_narration_is_empty(self):
+        self.assertEqual(ducking_envelope(stereo(0, 0), -12).shape, (0,))
+
+    def test_ducking_envelope_is_flat_at_the_edges(self):
+        silent = ducking_envelope(stereo(0, MIX_SAMPLE_RATE), -12)
+        np.testing.assert_allclose(silent, 1.0, rtol=1e-5)
+        loud = ducking_envelope(stereo(20000, MIX_SAMPLE_RATE), -12)
+        np.testing.assert_allclose(loud, 10 ** (-12 / 20), rtol=1e-5)
+
+    def test_ducking_envelope_dips_under_speech_only(self):
+        narration = np.concatenate([stereo(0, MIX_SAMPLE_RATE), stereo(20000, MIX_SAMPLE_RATE)])
+        envelope = ducking_envelope(narration, -12)
+        self.assertAlmostEqual(float(envelope[0]), 1.0, places=5)
+        self.assertAlmostEqual(float(envelope[-1]), 10 ** (-12 / 20), places=5)
+        self.assertTrue(np.all(np.diff(envelope) <= 1e-6))
+
+    def test_loops_music_under_silence(self):
+        music = stereo(1000, MIX_CROSSFADE_FRAMES * 4)
+        mixed = mix_background_music(stereo(0, len(music) * 3), music.tobytes(), 0)
+        self.assertEqual(mixed.shape, (len(music) * 3, MIX_CHANNELS))
+        self.assertTrue(np.all(mixed == 1000))
+
+    def test_applies_volume_and_clips(self):
+        music = stereo(30000, 1000)
+        quiet = mix_background_music(stereo(0, 1000), music.tobytes(), -6)
+        self.assertTrue(np.all(np.abs(quiet.astype(np.int32) - 15036) <= 1))
+        clipped = mix_background_music(stereo(30000, 1000), music.tobytes(), 0)
+        self.assertTrue(np.all(clipped == 32767))
+
+    def test_ducks_music_under_speech(self):
+        narration = stereo(20000, MIX_SAMPLE_RATE)
+        mixed = mix_background_music(narration, stereo(1000, MIX_SAMPLE_RATE).tobytes(), 0, ducking_db=-12)
+        expected = 20000 + 1000 * 10 ** (-12 / 20)
+        self.assertTrue(np.all(np.abs(mixed.astype(np.float64) - expected) <= 1))
+
+    def test_rejects_empty_music(self):
+        with self.assertRaises(ValueError):
+            mix_background_music(stereo(0, 10), b'', 0)
+
+    def test_working_memory_does_not_grow_with_duration(self):
+        music = stereo(1000, MIX_SAMPLE_RATE * 10).tobytes()
+        overheads = []
+        for seconds in (60, 240):
+            narration = stereo(20000, MIX_SAMPLE_RATE * seconds)
+            tracemalloc.start()
+            try:
+                mixed = mix_background_music(narration, music, -6, ducking_db=-12)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            overheads.append(peak - mixed.nbytes)
+        # Only the output grows with the narration; everything else is bounded by the block size.
+        self.assertLess(overheads[1], 8 * 1024 * 1024)
+        self.assertLess(overheads[1], overheads[0] * 1.5)
+
+
+class UpstreamClientTests(SimpleTestCase):
+    def client(self, *outcomes, **kwargs):
+        options = dict(max_retries=2, backoff_base=0, failure_threshold=2, reset_timeout=0.05)
+        options.update(kwargs)
+        client = UpstreamClient('test', **options)
+        self.calls = []
+        queue = list(outcomes)
+
+        def send(method, url, **request_kwargs):
+            self.calls.append((method, url))
+            outcome = queue.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return FakeResponse(outcome)
+
+        client.session.request = send
+        return client
+
+    def test_post_is_not_retried_after_it_was_sent(self):
+        client = self.client(500)
+        self.assertEqual(client.post('https://api.example/songs').status_code, 500)
+        client = self.client(ReadTimeout('slow'))
+        with self.assertRaises(ReadTimeout):
+            client.post('https://api.example/songs')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_post_is_retried_when_never_sent_or_asked_to(self):
+        client = self.client(ConnectTimeout('down'), 503, 200, failure_threshold=5)
+        self.assertEqual(client.post('https://api.example/songs').status_code, 200)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_get_is_retried_after_server_errors(self):
+        client = self.client(500, ReadTimeout('slow'), 200, failure_threshold=5)
+        self.assertEqual(client.get('https://api.example/file').status_code, 200)
+        self.assertEqual(client.stats()['retries'], 2)
+
+    def test_circuit_opens_then_lets_one_trial_through(self):
+        client = self.client(500, 500, 500, 200, max_retries=0)
+        url = 'https://api.example/songs'
+        client.get(url)
+        client.get(url)
+        with self.assertRaises(UpstreamUnavailableError):
+            client.get(url)
+        self.assertTrue(client.stats()['circuits']['https://api.example/songs']['open'])
+        time.sleep(0.06)
+        # The half-open trial fails, so the circuit opens again straight away.
+        client.get(url)
+        with self.assertRaises(UpstreamUnavailableError):
+            client.get(url)
+        time.sleep(0.06)
+        self.assertEqual(client.get(url).status_code, 200)
+        circuit = client.stats()['circuits']['https://api.example/songs']
+        self.assertEqual(circuit, {'open': False, 'half_open': False, 'consecutive_failures': 0})
+        self.assertEqual(client.stats()['short_circuited'], 2)
+
+    def test_each_endpoint_has_its_own_circuit(self):
+        client = self.client(500, 500, 200, max_retries=0)
+        client.post('https://dev.example/songs')
+        client.post('https://dev.example/songs')
+        with self.assertRaises(UpstreamUnavailableError):
+            client.post('https://dev.example/songs?retry=1')
+        self.assertEqual(client.post('https://prod.example/songs').status_code, 200)
+
+    def test_circuit_per_host_covers_every_path(self):
+        client = self.client(500, 500, max_retries=0, circuit_per_host=True)
+        client.get('https://cdn.example/a.mp3')
+        client.get('https://cdn.example/b.mp3')
+        with self.assertRaises(UpstreamUnavailableError):
+            client.get('https://cdn.example/c.mp3')
+
+
+class NegotiationCacheTests(SimpleTestCase):
+    attempts = [(('a', 'json-0'), {}), (('a', 'json-1'), {}), (('b', 'json-0'), {})]
+
+    def test_learned_variant_is_tried_first(self):
+        cache = NegotiationCache(ttl_seconds=60, max_failures=2)
+        self.assertEqual(cache.order('loudly', self.attempts), self.attempts)
+        cache.record_success('loudly', ('b', 'json-0'))
+        self.assertEqual([variant for variant, _ in cache.order('loudly', self.attempts)],
+                         [('b', 'json-0'), ('a', 'json-0'), ('a', 'json-1')])
+
+    def test_winner_is_demoted_after_repeated_failures(self):
+        cache = NegotiationCache(ttl_seconds=60, max_failures=2)
+        cache.record_success('loudly', ('a', 'json-1'))
+        cache.record_failure('loudly', ('a', 'json-1'))
+        cache.record_failure('loudly', ('b', 'json-0'))
+        self.assertEqual(cache.get('loudly'), ('a', 'json-1'))
+        cache.record_failure('loudly', ('a', 'json-1'))
+        self.assertIsNone(cache.get('loudly'))
+
+    def test_success_resets_the_failure_count(self):
+        cache = NegotiationCache(ttl_seconds=60, max_failures=2)
+        cache.record_success('loudly', ('a', 'json-1'))
+        cache.record_failure('loudly', ('a', 'json-1'))
+        cache.record_success('loudly', ('a', 'json-1'))
+        cache.record_failure('loudly', ('a', 'json-1'))
+        self.assertEqual(cache.get('loudly'), ('a', 'json-1'))
+
+    def test_winner_expires(self):
+        cache = NegotiationCache(ttl_seconds=-1, max_failures=2)
+        cache.record_success('loudly', ('a', 'json-1'))
+        self.assertIsNone(cache.get('loudly'))
+
+
+class ContentDefinedChunkTests(SimpleTestCase):
+    sentences = [f"Sentence number {index} is about something else." for index in range(80)]
+
+    def test_chunks_keep_every_sentence_within_the_budget(self):
+        text = ' '.join(self.sentences)
+        chunks = content_defined_chunks(text, 300)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk.encode('utf-8')) <= 300 for chunk in chunks))
+        self.assertEqual(' '.join(chunks), text)
+
+    def test_an_edit_only_changes_the_chunks_around_it(self):
+        original = content_defined_chunks(' '.join(self.sentences), 5000)
+        edited_sentences = list(self.sentences)
+        edited_sentences[40] = 'This sentence was rewritten by the editor.'
+        edited = content_defined_chunks(' '.join(edited_sentences), 5000)
+        self.assertGreater(len(original), 3)
+        self.assertLessEqual(len(set(edited) - set(original)), 2)
+        self.assertGreaterEqual(len(set(edited) & set(original)), len(original) - 2)
+
+    @mock.patch('api.views.TTS_CHUNK_TARGET_SENTENCES', 1)
+    def test_every_sentence_can_be_a_boundary(self):
+        self.assertEqual(content_defined_chunks('One. Two! Three?', 5000), ['One.', 'Two!', 'Three?'])
+
+    def test_urdu_sentences_split_on_urdu_full_stop(self):
+        chunks = content_defined_chunks('پہلا جملہ۔دوسرا جملہ۔', 5000)
+        self.assertEqual(' '.join(chunks), 'پہلا جملہ۔ دوسرا جملہ۔')
+
+
+class BatchRenderRequestTests(SimpleTestCase):
+    def error_message(self, data):
+        renders, options, error = parse_batch_render_request(data)
+        self.assertIsNone(renders)
+        self.assertEqual(error.status_code, 400)
+        return json.loads(error.content)['error']['message']
+
+    def test_one_text_is_rendered_with_every_voice(self):
+        renders, options, error = parse_batch_render_request({
+            'text': 'سلام', 'detected_gender': 'female',
+            'voice_settings_list': [{'voice_name': 'a'}, {'voice_name': 'b', 'tts_provider': 'gpt4o_mini'}],
+        })
+        self.assertIsNone(error)
+        self.assertEqual([render['voice_settings']['voice_name'] for render in renders], ['a', 'b'])
+        self.assertEqual([render['tts_provider'] for render in renders], ['google', 'gpt4o_mini'])
+        self.assertTrue(all(render['detected_gender'] == 'female' for render in renders))
+        self.assertEqual(options['output'], 'zip')
+
+    def test_segments_default_to_one_stitched_file(self):
+        renders, options, error = parse_batch_render_request({
+            'tts_provider': 'gpt4o_mini',
+            'segments': [
+                {'text': 'Hello', 'voice_settings': {}, 'detected_gender': 'male'},
+                {'text': 'Hi', 'voice_settings': {}, 'tts_provider': 'google'},
+            ],
+        })
+        self.assertIsNone(error)
+        self.assertEqual([render['tts_provider'] for render in renders], ['gpt4o_mini', 'google'])
+        self.assertEqual([render['detected_gender'] for render in renders], ['male', 'unknown'])
+        self.assertEqual(options, {'output': 'stitched', 'output_format': 'mp3', 'bitrate': None, 'segment_gap_ms': 300})
+
+    def test_rejects_invalid_bodies(self):
+        self.assertEqual(self.error_message({'segments': []}), 'Invalid segments')
+        self.assertEqual(self.error_message({'segments': [{'text': 'Hello'}]}), 'Invalid segment')
+        self.assertEqual(self.error_message({'voice_settings_list': [{}]}), 'No text provided.')
+        self.assertEqual(self.error_message({'text': 'Hello', 'voice_settings_list': ['voice']}), 'Invalid voice settings.')
+        self.assertEqual(self.error_message({'text': 'Hello', 'voice_settings_list': [{'tts_provider': 'other'}]}),
+                         'Invalid TTS provider')
+
+    def test_rejects_too_many_renders_and_too_much_text(self):
+        too_many = [{}] * (MAX_BATCH_RENDERS + 1)
+        self.assertEqual(self.error_message({'text': 'Hello', 'voice_settings_list': too_many}), 'Too many renders')
+        segments = [{'text': 'x' * (MAX_TEXT_LENGTH // 2 + 1), 'voice_settings': {}}] * 2
+        self.assertEqual(self.error_message({'segments': segments}), 'Text exceeds maximum length')
+
+    def test_rejects_invalid_output_options(self):
+        body = {'text': 'Hello', 'voice_settings_list': [{}]}
+        self.assertEqual(self.error_message(dict(body, output='tar')), 'Invalid output')
+        self.assertEqual(self.error_message(dict(body, segment_gap_ms=True)), 'Invalid segment gap')
+        self.assertEqual(self.error_message(dict(body, segment_gap_ms=6000)), 'Invalid segment gap')
+
+
+class VoiceDirectiveTests(SimpleTestCase):
+    def test_round_trips_through_instructions(self):
+        directive = VoiceDirective(
+            emotion='calm', emotion_intensity=60, secondary_emotion='neutral', secondary_emotion_intensity=20,
+            tone='warm', style='sports-coach', pacing=120, pause_frequency='low', emphasis_words=('alpha', 'beta'),
+        )
+        self.assertEqual(compile_voice_directive(directive.to_instructions()), directive)
+
+    def test_round_trips_every_tone_including_hyphenated(self):
+        self.assertIn('solution-focused', VALID_TONES)
+        for tone in VALID_TONES:
+            with self.subTest(tone=tone):
+                directive = VoiceDirective(emotion='neutral', tone=tone)
+                self.assertEqual(compile_voice_directive(directive.to_instructions()).tone, tone)
+
+    def test_alternate_tone_format(self):
+        directive = compile_voice_directive('Speak with a soothing tone and a slight smile')
+        self.assertEqual((directive.tone, directive.emotion), ('soothing', 'happiness'))
+
+    def test_invalid_instructions_raise(self):
+        with self.assertRaises(ValueError):
+            compile_voice_directive('Read this out loud')
+        with self.assertRaises(ValueError):
+            compile_voice_directive('Speak in a neutral tone with 70% intensity, grumpy tone, conversational style.')
+
+
+def pdf_bytes(page_count):
+    # Each page's width encodes its index, so shards can be traced back to the source pages.
+    writer = PdfWriter()
+    for index in range(page_count):
+        writer.add_blank_page(width=100 + index, height=100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def shard_page_numbers(content):
+    return [int(page.mediabox.width) - 100 for page in PdfReader(io.BytesIO(content)).pages]
+
+
+class PdfShardTests(SimpleTestCase):
+    def setUp(self):
+        self.reader = PdfReader(io.BytesIO(pdf_bytes(8)))
+
+    def test_pages_that_fit_stay_in_one_shard(self):
+        pieces = render_pdf_shards(self.reader, [1, 3, 4])
+        self.assertEqual(len(pieces), 1)
+        pages, content = pieces[0]
+        self.assertEqual(pages, [1, 3, 4])
+        self.assertEqual(shard_page_numbers(content), [1, 3, 4])
+
+    def test_halves_until_each_shard_fits(self):
+        two_page_bytes = len(render_pdf_shards(self.reader, [0, 1])[0][1])
+        with mock.patch('api.views.PDF_SHARD_MAX_BYTES', two_page_bytes + 16):
+            pieces = render_pdf_shards(self.reader, list(range(8)))
+        self.assertEqual([pages for pages, _ in pieces], [[0, 1], [2, 3], [4, 5], [6, 7]])
+        self.assertTrue(all(len(content) <= two_page_bytes + 16 for _, content in pieces))
+        self.assertEqual([shard_page_numbers(content) for _, content in pieces], [[0, 1], [2, 3], [4, 5], [6, 7]])
+
+    @mock.patch('api.views.PDF_SHARD_MAX_BYTES', 10)
+    def test_single_page_over_the_limit_is_an_error(self):
+        with self.assertRaises(ValueError):
+            render_pdf_shards(self.reader, [2])
+
+    @mock.patch('api.views.PDF_SHARD_MAX_PAGES', 3)
+    def test_ocr_returns_one_text_per_page_in_order(self):
+        def fake_ocr(content):
+            return [f"page {number}" for number in shard_page_numbers(content)]
+
+        with mock.patch('api.views.ocr_pdf_shard', side_effect=fake_ocr) as ocr:
+            texts = ocr_pdf(self.reader, [0, 2, 3, 5, 6, 7, 1])
+        self.assertEqual(texts, ['page 0', 'page 2', 'page 3', 'page 5', 'page 6', 'page 7', 'page 1'])
+        self.assertEqual(ocr.call_count, 3)
+
+    @mock.patch('api.views.MAX_PDF_PAGES', 5)
+    def test_open_pdf_enforces_the_page_limit(self):
+        with self.assertRaises(ValueError):
+            open_pdf(io.BytesIO(pdf_bytes(8)))
+        self.assertEqual(len(open_pdf(io.BytesIO(pdf_bytes(5))).pages), 5)
+
+
+def text_pdf_bytes(page_texts):
+    """A PDF with one page per entry, drawing the text in Helvetica; an empty entry gives a blank page."""
+    writer = PdfWriter()
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    })
+    for text in page_texts:
+        page = writer.add_blank_page(width=300, height=300)
+        if text:
+            stream = DecodedStreamObject()
+            stream.set_data(f"BT /F1 12 Tf 20 250 Td ({text}) Tj ET".encode('latin-1'))
+            page.replace_contents(stream)
+            page[NameObject('/Resources')] = DictionaryObject({
+                NameObject('/Font'): DictionaryObject({NameObject('/F1'): font}),
+            })
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+class TextLayerTests(SimpleTestCase):
+    def test_enough_clean_text_is_usable(self):
+        self.assertTrue(text_layer_usable('یہ ایک مکمل صفحہ ہے جس میں متن موجود ہے', 20, 0.02))
+
+    def test_whitespace_does_not_count_towards_the_minimum(self):
+        self.assertFalse(text_layer_usable('a b c d e' + ' ' * 40, 20, 0.02))
+
+    def test_legacy_font_glyph_codes_are_not_usable(self):
+        private_use = ''.join(chr(0xE000 + index) for index in range(30))
+        self.assertFalse(text_layer_usable(private_use, 20, 0.02))
+        presentation_forms = 'ﺍﺏﺕﺙ' * 10
+        self.assertFalse(text_layer_usable(presentation_forms, 20, 0.02))
+
+    def test_a_few_suspect_characters_are_tolerated(self):
+        text = 'x' * 99 + '\ufffd'
+        self.assertTrue(text_layer_usable(text, 20, 0.02))
+        self.assertFalse(text_layer_usable(text, 20, 0.0))
+
+    def test_extracts_digital_pages_and_leaves_the_rest_for_ocr(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'mixed.pdf')
+        with open(path, 'wb') as f:
+            f.write(text_pdf_bytes(['This page was typed in a word processor.', '', 'Too short']))
+        self.assertEqual(
+            extract_pdf_text_layer(path, [0, 1, 2], 20, 0.02),
+            ['This page was typed in a word processor.', None, None],
+        )
+        self.assertEqual(extract_pdf_text_layer(path, [2], 5, 0.02), ['Too short'])
+
+
+class ImagePreprocessingTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def save(self, name, image, **kwargs):
+        path = os.path.join(self.directory, name)
+        image.save(path, **kwargs)
+        return path
+
+    def preprocess(self, path, max_frames=10):
+        return preprocess_image(path, 300, 3500, 40 * 1000000, 90, max_frames)
+
+    def open_page(self, content):
+        image = Image.open(io.BytesIO(content))
+        image.load()
+        return image
+
+    def test_high_dpi_scan_is_downsampled_to_grayscale(self):
+        noise = np.random.default_rng(0).integers(0, 256, (1200, 800, 3), dtype=np.uint8)
+        path = self.save('scan.jpg', Image.fromarray(noise), dpi=(600, 600), quality=95)
+        pages = self.preprocess(path)
+        self.assertEqual(len(pages), 1)
+        content, mime_type = pages[0]
+        self.assertEqual(mime_type, 'image/jpeg')
+        page = self.open_page(content)
+        self.assertEqual(page.mode, 'L')
+        self.assertEqual(page.size, (400, 600))
+
+    def test_long_edge_is_capped(self):
+        path = self.save('wide.png', Image.new('RGB', (5000, 1000), 'white'))
+        page = self.open_page(self.preprocess(path)[0][0])
+        self.assertEqual(page.size, (3500, 700))
+
+    def test_transparent_areas_become_white(self):
+        path = self.save('logo.png', Image.new('RGBA', (4000, 40), (0, 0, 0, 0)))
+        page = self.open_page(self.preprocess(path)[0][0])
+        self.assertEqual(page.getextrema(), (255, 255))
+
+    def test_every_frame_becomes_a_page(self):
+        frames = [Image.new('L', (50, 50), shade) for shade in (0, 128, 255)]
+        path = self.save('pages.tiff', frames[0], save_all=True, append_images=frames[1:])
+        self.assertEqual(len(self.preprocess(path)), 3)
+        with self.assertRaises(ValueError):
+            self.preprocess(path, max_frames=2)
+
+    def test_small_image_is_sent_unchanged(self):
+        path = self.save('tiny.png', Image.new('L', (20, 20), 255))
+        self.assertIsNone(self.preprocess(path))
+
+
+class LexiconClassifierTests(SimpleTestCase):
+    def setUp(self):
+        self.classifier = LexiconClassifier({'happy': {'خوش': 2, 'hasna': 1}, 'sad': ['اداس', 'rona']})
+
+    def test_confidence_is_the_margin_scaled_by_evidence(self):
+        label, confidence = self.classifier.classify(['خوش', 'خوش', 'اداس', 'other'])
+        self.assertEqual(label, 'happy')
+        self.assertAlmostEqual(confidence, (4 - 1) / 4 * (1 - np.exp(-4 / LEXICON_EVIDENCE_SCALE)))
+
+    def test_no_hits_is_no_answer(self):
+        self.assertEqual(self.classifier.classify(['other', 'words']), (None, 0.0))
+        self.assertEqual(self.classifier.classify([]), (None, 0.0))
+
+    def test_a_tie_has_no_confidence(self):
+        self.assertEqual(self.classifier.classify(['hasna', 'rona'])[1], 0.0)
+
+    def test_tokens_are_folded_like_the_lexicon(self):
+        self.assertEqual(self.classifier.classify(lexicon_tokens('وہ خُوش ہے اور haaasna'))[0], 'happy')
+
+    def test_confident_answers_are_kept_and_unsure_ones_dropped(self):
+        (gender, gender_confidence), _ = classify_with_lexicons(
+            'وہ لڑکی اپنی ماں کے ساتھ بازار گئی تھی اور وہ خوش ہو کر واپس آئی'
+        )
+        self.assertEqual(gender, 'female')
+        self.assertGreater(gender_confidence, 0.6)
+        (gender, _), (emotion, _) = classify_with_lexicons('This text has no clues.')
+        self.assertIsNone(gender)
+        self.assertIsNone(emotion)
+
+
+def window_labels(emotion, gender, source='lexicon'):
+    return {'emotion': emotion, 'emotion_source': source, 'gender': gender, 'gender_source': source}
+
+
+class WindowReduceTests(SimpleTestCase):
+    def test_only_ok_files_are_windowed(self):
+        long_text = ('یہ ایک جملہ ہے۔ ' * 4000).strip()
+        ok = {'status': 'ok', 'text': long_text}
+        failed = {'status': 'error', 'text': 'ignored'}
+        windows = plan_analysis_windows([failed, ok])
+        self.assertGreater(len(windows), 1)
+        self.assertTrue(all(result is ok for result, _ in windows))
+        self.assertTrue(all(len(window.encode('utf-8')) <= MAP_REDUCE_WINDOW_BYTES for _, window in windows))
+
+    def test_votes_are_weighted_by_window_length_per_file_and_overall(self):
+        first = {'status': 'ok', 'text': ''}
+        second = {'status': 'ok', 'text': ''}
+        windows = [(first, 'a' * 10), (first, 'b' * 30), (second, 'c' * 25)]
+        labels = [window_labels('Joy', 'male'), window_labels('Sadness', 'unknown'), window_labels('Joy', 'female')]
+        emotion, emotion_source, gender, gender_source = reduce_window_labels(windows, labels)
+        self.assertEqual((first['emotion'], first['gender'], first['windows']), ('Sadness', 'male', 2))
+        self.assertEqual((second['emotion'], second['gender'], second['windows']), ('Joy', 'female', 1))
+        # 35 characters of Joy beat 30 of Sadness; the unknown window does not vote on gender.
+        self.assertEqual((emotion, gender), ('Joy', 'female'))
+        self.assertEqual((emotion_source, gender_source), ('lexicon', 'lexicon'))
+
+    def test_mixed_sources_and_no_votes(self):
+        result = {'status': 'ok', 'text': ''}
+        windows = [(result, 'abc'), (result, 'def')]
+        labels = [window_labels(None, 'unknown', 'lexicon'), window_labels(None, 'unknown', 'gemini')]
+        emotion, emotion_source, gender, gender_source = reduce_window_labels(windows, labels)
+        self.assertEqual((emotion, gender), ('No clear emotion detected', 'unknown'))
+        self.assertEqual((emotion_source, gender_source), ('mixed', 'mixed'))
+        self.assertEqual(reduce_window_labels([], []), ('No clear emotion detected', None, 'unknown', None))
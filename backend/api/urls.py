@@ -4,7 +4,14 @@ from . import views
 urlpatterns = [
     path('api/analyze-files/', views.analyze_files, name='analyze_files'),
     path('api/generate-audio/', views.generate_audio, name='generate_audio'),
+    path('api/generate-audio/batch/', views.generate_audio_batch, name='generate_audio_batch'),
     path('api/available-voices/', views.available_voices, name='available_voices'),
+    path('api/music-jobs/', views.submit_music_job, name='submit_music_job'),
+    path('api/music-jobs/<uuid:job_id>/', views.music_job_status, name='music_job_status'),
+    path('api/pool-stats/', views.pool_stats, name='pool_stats'),
+    path('api/async/analyze-files/', views.analyze_files_async, name='analyze_files_async'),
+    path('api/async/generate-audio/', views.generate_audio_async, name='generate_audio_async'),
+    path('api/async/prompt-based-music-generation', views.generate_music_with_prompt_async, name='prompt_based_music_generation_async'),
     path('api/prompt-based-music-generation', views.generate_music_with_prompt, name='prompt_based_music_generation'),
     # path('api/music-structures/', views.get_music_structures, name='music_structures'),
     # path('api/catalog-songs/', views.get_catalog_songs, name='catalog_songs'),
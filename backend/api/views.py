@@ -1,798 +1,4372 @@
-import os
-import json
-import docx
-import tempfile
-import requests
-import logging
-import hashlib
-import time
-import re
-from django.http import JsonResponse, HttpResponse
-from django.core.files.storage import FileSystemStorage
-from django.conf import settings
-from django.core.cache import cache
-from rest_framework.decorators import api_view, throttle_classes
-from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
-from google.cloud import documentai_v1 as documentai
-from google.cloud import texttospeech
-from google.api_core.client_options import ClientOptions
-import google.generativeai as genai
-from google.oauth2 import service_account
-from dotenv import load_dotenv
-from requests.exceptions import RequestException
-from pydub import AudioSegment
-from django.views.decorators.csrf import csrf_exempt
-import io
-
-load_dotenv()
-
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
-
-PROJECT_ID = os.getenv('PROJECT_ID', '585624190112')
-LOCATION = os.getenv('LOCATION', 'us')
-PROCESSOR_ID = os.getenv('PROCESSOR_ID', '867de035aee8db09')
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY', '')
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
-LOUDLY_API_KEY = os.getenv('LOUDLY_API_KEY', 'yfZX66sUgEGqQLrHpI-ysbcTNrMozGnXtqPlyD-6NXQ')
-SECRET_KEY = os.getenv('SECRET_KEY', '')
-GPT4O_MINI_TTS_API_KEY = os.getenv('OPENAI_API_KEY', '')
-genai.configure(api_key=GOOGLE_API_KEY)
-
-MAX_FILE_SIZE_ONLINE = 20 * 1024 * 1024
-MAX_FILE_SIZE_BATCH = 1 * 1024 * 1024 * 1024
-MAX_IMAGE_RESOLUTION = 40 * 1000000
-MAX_FILES_PER_BATCH = 5000
-MAX_PAGES_ONLINE_DEFAULT = 15
-MAX_PAGES_IMAGELESS = 30
-MAX_TEXT_LENGTH = 10000
-
-EMOTION_MAPPING = {
-    "neutral": "neutral",
-    "sympathetic": "sympathetic",
-    "sincere": "sincere",
-    "calm": "calm",
-    "serene": "serene",
-    "sadness": "sad",
-    "happiness": "happy",
-    "fear": "fearful",
-    "horror": "horrified",
-    "surprise": "surprised",
-    "anger": "angry",
-    "rage": "enraged",
-    "love": "loving",
-    "excitement": "excited",
-    "anxiety": "anxious",
-    "disgust": "disgusted"
-}
-
-def load_urdu_dictionary(file_path=os.path.join(settings.BASE_DIR, 'api', 'urdu_words.txt')):
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return set(line.strip() for line in f if line.strip())
-    except FileNotFoundError:
-        logger.error(f"Could not find Urdu dictionary at {file_path}")
-        return set()
-
-urdu_dictionary = load_urdu_dictionary()
-
-def create_error_response(code, message, details=None):
-    response = {'error': {'code': code, 'message': message}}
-    if details:
-        response['error']['details'] = details
-    logger.error(f"Error {code}: {message} - Details: {details}")
-    return JsonResponse(response, status=code)
-
-def process_document(file_path, mime_type, is_batch=False):
-    try:
-        credentials_path = "/home/abdulqadeer/Downloads/ai-titude/credentials.json"
-        if not os.path.exists(credentials_path):
-            raise FileNotFoundError("Google Cloud credentials file not found")
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        client_options = ClientOptions(api_endpoint=f"{LOCATION}-documentai.googleapis.com")
-        client = documentai.DocumentProcessorServiceClient(client_options=client_options, credentials=credentials)
-        name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
-        
-        with open(file_path, "rb") as f:
-            file_content = f.read()
-
-        file_size = len(file_content)
-        max_file_size = MAX_FILE_SIZE_BATCH if is_batch else MAX_FILE_SIZE_ONLINE
-        if file_size > max_file_size:
-            limit_mb = max_file_size // (1024 * 1024)
-            raise ValueError(f"File size exceeds the {'batch' if is_batch else 'online'} processing limit of {limit_mb} MB.")
-
-        raw_document = documentai.RawDocument(content=file_content, mime_type=mime_type)
-        request = documentai.ProcessRequest(name=name, raw_document=raw_document)
-        result = client.process_document(request=request)
-        document = result.document
-
-        page_count = len(document.pages)
-        max_pages = MAX_PAGES_IMAGELESS if 'imageless_mode' in request else MAX_PAGES_ONLINE_DEFAULT
-        if page_count > max_pages:
-            raise ValueError(f"Document exceeds the page limit of {max_pages} pages for {'imageless' if 'imageless_mode' in request else 'standard'} mode.")
-        return document
-    except FileNotFoundError as e:
-        logger.error(f"Document AI error: {str(e)}")
-        raise
-    except ValueError as ve:
-        logger.error(f"Document AI validation error: {str(ve)}")
-        raise
-    except Exception as e:
-        logger.error(f"Failed to process document with Document AI: {str(e)}")
-        raise
-
-def format_extracted_text(document):
-    return document.text
-
-def extract_text_from_file(file_path, file_extension):
-    try:
-        mime_type_map = {
-            'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png',
-            'bmp': 'image/bmp', 'tiff': 'image/tiff', 'tif': 'image/tiff',
-            'gif': 'image/gif', 'pdf': 'application/pdf',
-        }
-        if file_extension in mime_type_map:
-            mime_type = mime_type_map[file_extension]
-            document = process_document(file_path, mime_type)
-            if document:
-                return format_extracted_text(document)
-        elif file_extension == 'docx':
-            doc = docx.Document(file_path)
-            return "\n".join([paragraph.text for paragraph in doc.paragraphs if paragraph.text.strip()])
-        elif file_extension == 'txt':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        else:
-            raise ValueError("Unsupported file type. Supported types are: jpg, png, pdf, docx, txt.")
-    except ValueError as ve:
-        logger.error(f"Text extraction error: {str(ve)}")
-        raise
-    except Exception as e:
-        logger.error(f"Error extracting text from file: {str(e)}")
-        raise
-
-def get_gemini_response(prompt, document_text):
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        content = [document_text, prompt]
-        response = model.generate_content(content)
-        if not response.text:
-            raise ValueError("Gemini API returned an empty response.")
-        return response.text
-    except ValueError as ve:
-        logger.error(f"Gemini error: {str(ve)}")
-        raise
-    except Exception as e:
-        logger.error(f"Error with Gemini API: {str(e)}")
-        raise
-
-def filter_unethical_text_with_prompt(text):
-    prompt = f"""
-    Analyze the following text and remove any vulgar, abusive, or unethical words or phrases in Urdu or any other language.
-    Return only the cleaned text without any explanations or markers, preserving the original meaning as much as possible.
-    If no unethical content is found, return the text as is.
-    Text: "{text}"
-    """
-    try:
-        cleaned_text = get_gemini_response(prompt, text)
-        return cleaned_text.strip() if cleaned_text else text
-    except Exception as e:
-        logger.error(f"Failed to filter unethical text: {str(e)}")
-        raise
-
-def detect_emotions_with_ai(text):
-    emotion_list = list(EMOTION_MAPPING.keys())
-    prompt = f"""
-    Analyze the following text and identify the single most prominent emotion from this list: {', '.join(emotion_list)}.
-    The text may be in Urdu, English, or a mix of both or any other language. Provide only the most dominant emotion as a single word or phrase.
-    Text: "{text}"
-    """
-    try:
-        response = get_gemini_response(prompt, text)
-        return response.strip() if response else "No clear emotion detected"
-    except Exception as e:
-        logger.error(f"Failed to detect emotion: {str(e)}")
-        raise
-
-def detect_gender_with_ai(text):
-    prompt = f"""
-    Analyze the following Urdu text and determine the gender of the subject (male, female, or unknown).
-    Look for gender-specific indicators such as pronouns (e.g., "وہ" with context), verb conjugations (e.g., "گیا" for male, "گئی" for female),
-    or nouns (e.g., "لڑکا" for male, "لڑکی" for female). Return only the detected gender as "male", "female", or "unknown".
-    Text: "{text}"
-    """
-    try:
-        response = get_gemini_response(prompt, text)
-        gender = response.strip().lower()
-        if gender not in ["male", "female", "unknown"]:
-            return "unknown"
-        return gender
-    except Exception as e:
-        logger.error(f"Failed to detect gender: {str(e)}")
-        raise
-
-def get_available_voices():
-    try:
-        credentials_path = "/home/abdulqadeer/Downloads/ai-titude/credentials.json"
-        if not os.path.exists(credentials_path):
-            raise FileNotFoundError("Google Cloud credentials file not found")
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        client = texttospeech.TextToSpeechClient(credentials=credentials)
-        voices = client.list_voices().voices
-        language_voices = {}
-        for voice in voices:
-            for language_code in voice.language_codes:
-                if (language_code not in language_voices):
-                    language_voices[language_code] = []
-                language_voices[language_code].append({
-                    'name': voice.name,
-                    'gender': texttospeech.SsmlVoiceGender(voice.ssml_gender).name,
-                    'language_code': language_code
-                })
-        sorted_languages = sorted(language_voices.keys())
-        result = []
-        for lang in sorted_languages:
-            result.append({
-                'language_code': lang,
-                'voices': sorted(language_voices[lang], key=lambda x: (x['gender'], x['name']))
-            })
-        gpt4o_voices = [
-            {
-                'language_code': 'ur-PK',
-                'voices': [
-                    {'name': 'alloy', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'ash', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'ballad', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'coral', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'echo', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'fable', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'onyx', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'nova', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'sage', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'},
-                    {'name': 'shimmer', 'gender': 'NEUTRAL', 'language_code': 'ur-PK'}      
-                ]
-            }
-        ]
-        result.extend(gpt4o_voices)
-        return result
-    except FileNotFoundError as e:
-        logger.error(f"Voice fetch error: {str(e)}")
-        raise
-    except Exception as e:
-        logger.error(f"Error fetching available voices: {str(e)}")
-        raise
-
-@csrf_exempt
-def generate_music_with_prompt(request):
-    """
-    Generate music based on a user-provided prompt and duration using the Loudly API.
-    """
-    if request.method != "POST":
-        return create_error_response(405, "Only POST requests allowed")
-
-    try:
-        # Parse request body
-        body_unicode = request.body.decode("utf-8")
-        body = json.loads(body_unicode)
-        prompt = body.get("prompt")
-        duration = body.get("duration", 90)  # Default to 90 seconds
-        logger.debug(f"Incoming request: prompt={prompt}, duration={duration}")
-
-        # Validate inputs
-        if prompt is None:
-            return create_error_response(400, "Prompt is missing", "The 'prompt' field is required in the request body")
-        if not isinstance(prompt, str):
-            return create_error_response(400, "Invalid prompt type", "Prompt must be a string")
-        prompt = prompt.strip()
-        if not prompt:
-            return create_error_response(400, "Prompt is empty", "Please provide a valid music prompt")
-        if len(prompt) < 5:
-            return create_error_response(400, "Prompt is too short", "Minimum length is 5 characters")
-        if not isinstance(duration, int) or not (30 <= duration <= 420):
-            return create_error_response(400, "Invalid duration", "Duration must be an integer between 30 and 420 seconds")
-
-        # Check Loudly API key
-        if not LOUDLY_API_KEY:
-            return create_error_response(500, "Loudly API key is not configured")
-
-        # Common headers
-        headers = {
-            "API-KEY": LOUDLY_API_KEY,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "User-Agent": "AI-titude/1.0",
-            "Cache-Control": "no-cache"
-        }
-
-        # Try multiple payload formats
-        payload_variations = [
-            {"prompt": prompt, "duration": duration},
-            {"Prompt": prompt, "duration": duration},
-            {"data": {"prompt": prompt, "duration": duration}}
-        ]
-
-        # Try multiple endpoints
-        endpoints = [
-            "https://soundtracks-dev.loudly.com/api/ai/prompt/songs",
-            "https://soundtracks.loudly.com/b2b/ai/prompt/songs"
-        ]
-
-        response = None
-        for endpoint in endpoints:
-            for payload in payload_variations:
-                logger.debug(f"Attempting Loudly API: URL={endpoint}, headers={headers}, payload={payload}")
-                try:
-                    response = requests.post(endpoint, headers=headers, json=payload, timeout=30)
-                    logger.debug(f"Loudly API response: status={response.status_code}, text={response.text}")
-                    
-                    if response.status_code == 200:
-                        try:
-                            response_data = response.json()
-                            if not response_data.get("music_file_path"):
-                                logger.error("Loudly API response missing music_file_path")
-                                return create_error_response(500, "Invalid response from Loudly API", "Missing music_file_path")
-                            logger.info(f"Music generated successfully: {response_data}")
-                            return JsonResponse(response_data, status=200)
-                        except ValueError:
-                            logger.error("Invalid JSON response from Loudly API")
-                            return create_error_response(500, "Invalid JSON response from Loudly API")
-                    
-                    elif response.status_code != 400:
-                        # If not a 400 error, stop trying this endpoint
-                        break
-                    
-                except requests.RequestException as e:
-                    logger.error(f"Network error calling Loudly API at {endpoint}: {str(e)}")
-                    continue
-
-            if response and response.status_code != 200:
-                try:
-                    error_data = response.json()
-                    logger.error(f"Loudly API error at {endpoint}: {error_data}")
-                    return create_error_response(response.status_code, "Failed to generate music", error_data.get("error", response.text))
-                except ValueError:
-                    logger.error(f"Loudly API error at {endpoint}: status={response.status_code}, text={response.text}")
-                    return create_error_response(response.status_code, "Failed to generate music", response.text)
-
-        # If all JSON attempts fail, try form data as a fallback
-        form_headers = {
-            "API-KEY": LOUDLY_API_KEY,
-            "Accept": "application/json",
-            "User-Agent": "AI-titude/1.0",
-            "Cache-Control": "no-cache"
-        }
-        form_data = {"prompt": prompt, "duration": str(duration)}
-        logger.debug(f"Attempting Loudly API with form data: URL={endpoints[0]}, headers={form_headers}, form_data={form_data}")
-        try:
-            response = requests.post(endpoints[0], headers=form_headers, data=form_data, timeout=30)
-            logger.debug(f"Loudly API form data response: status={response.status_code}, text={response.text}")
-            
-            if response.status_code == 200:
-                try:
-                    response_data = response.json()
-                    if not response_data.get("music_file_path"):
-                        logger.error("Loudly API response missing music_file_path")
-                        return create_error_response(500, "Invalid response from Loudly API", "Missing music_file_path")
-                    logger.info(f"Music generated successfully: {response_data}")
-                    return JsonResponse(response_data, status=200)
-                except ValueError:
-                    logger.error("Invalid JSON response from Loudly API")
-                    return create_error_response(500, "Invalid JSON response from Loudly API")
-            
-            try:
-                error_data = response.json()
-                logger.error(f"Loudly API form data error: {error_data}")
-                return create_error_response(response.status_code, "Failed to generate music", error_data.get("error", response.text))
-            except ValueError:
-                logger.error(f"Loudly API form data error: status={response.status_code}, text={response.text}")
-                return create_error_response(response.status_code, "Failed to generate music", response.text)
-        
-        except requests.RequestException as e:
-            logger.error(f"Network error calling Loudly API with form data: {str(e)}")
-            return create_error_response(500, "Network error", str(e))
-
-        # If all attempts fail
-        return create_error_response(400, "Failed to generate music", "All attempts to contact Loudly API failed. Please check API configuration.")
-
-    except json.JSONDecodeError:
-        logger.error("Invalid JSON in request body")
-        return create_error_response(400, "Invalid JSON format in request body")
-    except requests.RequestException as e:
-        logger.error(f"Network error calling Loudly API: {str(e)}")
-        return create_error_response(500, "Network error", str(e))
-    except Exception as e:
-        logger.error(f"Unexpected error in generate_music_with_prompt: {str(e)}", exc_info=True)
-        return create_error_response(500, "An unexpected error occurred", str(e))
-
-def text_to_speech(text, voice_settings_list, base_file_name, detected_gender, tts_provider="google"):
-    logger.debug(f"Starting text_to_speech: provider={tts_provider}, text_length={len(text)}, voice_settings={voice_settings_list}")
-    try:
-        if len(text) > MAX_TEXT_LENGTH:
-            raise ValueError(f"Text exceeds the maximum length of {MAX_TEXT_LENGTH} characters for audio generation.")
-        
-        voice_settings = voice_settings_list[0]
-        
-        if tts_provider == "gpt4o_mini":
-            logger.debug("Using GPT-4o mini TTS")
-            required_fields = ['voice_name']
-            if not all(key in voice_settings for key in required_fields):
-                raise ValueError(f"Invalid voice settings: Missing required fields: {required_fields}")
-            
-            valid_voices = ['alloy', 'ash', 'ballad', 'coral', 'echo', 'fable', 'onyx', 'nova', 'sage', 'shimmer']
-            if voice_settings['voice_name'] not in valid_voices:
-                raise ValueError(f"Invalid voice: {voice_settings['voice_name']}. Supported voices: {valid_voices}")
-            
-            valid_emotions = list(EMOTION_MAPPING.keys())
-            instructions = voice_settings.get('instructions', '').strip()
-            
-            if not instructions:
-                raise ValueError("Instructions are required for GPT-4o mini TTS.")
-            emotion_match = re.search(r'Speak in a (\w+) tone with (\d+)% intensity', instructions)
-            secondary_emotion_match = re.search(r'blended with (\w+) at (\d+)% intensity', instructions)
-            tone_match_standard = re.search(r',\s*(\w+)\s*tone,\s*', instructions)
-            style_match = re.search(r'(\w+(?:-\w+)*) style', instructions)
-            pacing_match = re.search(r'pacing at (\d+)%', instructions)
-            pause_frequency_match = re.search(r'pause frequency set to (\w+)', instructions)
-            emphasis_match = re.search(r'Emphasize the following words: ([\w\s,آ-ی]+)\.', instructions)
-
-            if not emotion_match:
-                alt_emotion_tone_match = re.search(r'Speak with a ([\w\s,]+) tone', instructions)
-                smile_match = re.search(r'and a slight smile', instructions)
-
-                if alt_emotion_tone_match:
-                    tone_description = alt_emotion_tone_match.group(1).lower()
-                    tone_mapping = {
-                        "bright, cheerful": "excited",
-                        "cheerful": "excited",
-                        "bright": "excited",
-                        "calm": "calm",
-                        "soothing": "soothing",
-                    }
-                    emotion_mapping_alt = {
-                        "bright, cheerful": "happiness",
-                        "cheerful": "happiness",
-                        "bright": "happiness",
-                        "calm": "calm",
-                        "soothing": "serene",
-                    }
-                    tone = tone_mapping.get(tone_description, "excited")
-                    emotion = emotion_mapping_alt.get(tone_description, "happiness")
-                    if smile_match:
-                        emotion = "happiness"
-                    emotion_intensity = 70
-                    secondary_emotion = "none"
-                    secondary_emotion_intensity = 0
-                    style = "conversational"
-                    pacing = 100
-                    pause_frequency = "medium"
-                    emphasis_words = None
-                else:
-                    raise ValueError("Invalid instructions format. Expected format: 'Speak in a {emotion} tone with {intensity}% intensity...' or 'Speak with a {tone} tone and a slight smile'")
-            else:
-                emotion = emotion_match.group(1).lower() if emotion_match else None
-                emotion_intensity = int(emotion_match.group(2)) if emotion_match else 70
-                secondary_emotion = secondary_emotion_match.group(1).lower() if secondary_emotion_match else 'none'
-                secondary_emotion_intensity = int(secondary_emotion_match.group(2)) if secondary_emotion_match else 0
-                tone = tone_match_standard.group(1).lower() if tone_match_standard else 'empathetic'
-                style = style_match.group(1).lower() if style_match else 'conversational'
-                pacing = int(pacing_match.group(1)) if pacing_match else 100
-                pause_frequency = pause_frequency_match.group(1).lower() if pause_frequency_match else 'medium'
-                emphasis_words = emphasis_match.group(1).strip() if emphasis_match else None
-
-            if emotion not in valid_emotions:
-                raise ValueError(f"Invalid base emotion: {emotion}. Supported emotions: {valid_emotions}")
-            if secondary_emotion != 'none' and secondary_emotion not in valid_emotions:
-                raise ValueError(f"Invalid secondary emotion: {secondary_emotion}. Supported emotions: {valid_emotions}")
-
-            if not (0 <= emotion_intensity <= 100):
-                raise ValueError(f"Base emotion intensity must be between 0 and 100, got {emotion_intensity}")
-            if not (0 <= secondary_emotion_intensity <= 100):
-                raise ValueError(f"Secondary emotion intensity must be between 0 and 100, got {secondary_emotion_intensity}")
-
-            valid_tones = ['empathetic', 'solution-focused', 'gentle', 'authoritative', 'warm',
-                           'soothing', 'excited', 'noble', 'chaotic', 'calm']
-            if tone not in valid_tones:
-                raise ValueError(f"Invalid tone: {tone}. Supported tones: {valid_tones}")
-
-            valid_styles = ['conversational', 'professional', 'dramatic', 'monotone', 'narrative', 'poetic',
-                            'motivational', 'whispered', 'sarcastic', 'childlike', 'commanding', 'meditative',
-                            'sports-coach', 'bedtime-story', 'medieval-knight', 'mad-scientist', 'patient-teacher',
-                            'auctioneer', 'old-timey', 'chill-surfer']
-            if style not in valid_styles:
-                raise ValueError(f"Invalid style: {style}. Supported styles: {valid_styles}")
-
-            if not (50 <= pacing <= 200):
-                raise ValueError(f"Pacing must be between 50% and 200%, got {pacing}%")
-
-            valid_pause_frequencies = ['low', 'medium', 'high']
-            if pause_frequency not in valid_pause_frequencies:
-                raise ValueError(f"Invalid pause frequency: {pause_frequency}. Supported values: {valid_pause_frequencies}")
-
-            if emphasis_words:
-                words_to_emphasize = [word.strip() for word in emphasis_words.split(',')]
-                for word in words_to_emphasize:
-                    text = text.replace(word, f'<emphasis level="strong">{word}</emphasis>')
-
-            speed = pacing / 100.0
-            if speed < 0.5:
-                speed = 0.5
-            elif speed > 2.0:
-                speed = 2.0
-
-            plain_text = text.replace('.', '. ')
-            print(f"Plain Text Input: {plain_text}")
-
-            headers = {
-                "Authorization": f"Bearer {GPT4O_MINI_TTS_API_KEY}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "model": "gpt-4o-mini-tts",
-                "input": plain_text,
-                "voice": voice_settings['voice_name'],
-                "response_format": "mp3",
-                "speed": speed
-            }
-            if 'instructions' in voice_settings:
-                payload['instructions'] = voice_settings['instructions']
-            
-            logger.debug(f"GPT-4o mini TTS payload: {payload}")
-            
-            response = requests.post(
-                "https://api.openai.com/v1/audio/speech",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"GPT-4o mini TTS API error: {response.status_code} - {response.text}")
-                raise Exception(f"GPT-4o mini TTS API error: {response.text}")
-            
-            final_file_name = f"{base_file_name.rsplit('.', 1)[0]}.mp3"
-            final_temp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-            with open(final_temp.name, "wb") as out:
-                out.write(response.content)
-            logger.debug(f"Saved GPT-4o mini audio to {final_temp.name}")
-            
-            return final_temp.name, final_file_name, None
-        
-        else:
-            logger.debug("Using Google Cloud TTS")
-            required_fields = ['language_code', 'voice_name', 'gender']
-            if not all(key in voice_settings for key in required_fields):
-                raise ValueError(f"Invalid voice settings: Missing required fields: {required_fields}")
-            
-            if detected_gender != "unknown" and detected_gender != voice_settings['gender'].lower():
-                raise ValueError(f"Gender mismatch: Text is detected as {detected_gender}, but selected voice is {voice_settings['gender'].lower()}.")
-            
-            credentials_path = "/home/abdulqadeer/Downloads/ai-titude/credentials.json"
-            if not os.path.exists(credentials_path):
-                raise FileNotFoundError("Google Cloud credentials file not found")
-            credentials = service_account.Credentials.from_service_account_file(credentials_path)
-            client = texttospeech.TextToSpeechClient(credentials=credentials)
-            MAX_BYTES = 5000
-            text = text.replace('\n', ' ').strip()
-            temp_files = []
-            combined = AudioSegment.empty()
-            
-            voice = texttospeech.VoiceSelectionParams(
-                language_code=voice_settings['language_code'],
-                name=voice_settings['voice_name'],
-                ssml_gender=texttospeech.SsmlVoiceGender[voice_settings['gender'].upper()]
-            )
-            audio_config = texttospeech.AudioConfig(
-                audio_encoding=texttospeech.AudioEncoding.MP3,
-                speaking_rate=float(voice_settings.get('speaking_rate', 1.0)),
-                pitch=float(voice_settings.get('pitch', 0.0)),
-                volume_gain_db=float(voice_settings.get('volume_gain_db', 0.0)),
-                effects_profile_id=voice_settings.get('audio_effects', [])
-            )
-            
-            chunks = [text[i:i+MAX_BYTES] for i in range(0, len(text), MAX_BYTES)]
-            for i, chunk in enumerate(chunks):
-                synthesis_input = texttospeech.SynthesisInput(text=chunk)
-                response = client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f"_chunk{i}.mp3")
-                with open(temp_file.name, "wb") as out:
-                    out.write(response.audio_content)
-                temp_files.append(temp_file.name)
-            
-            for temp_file in temp_files:
-                audio_segment = AudioSegment.from_mp3(temp_file)
-                combined += audio_segment
-            
-            final_file_name = f"{base_file_name.rsplit('.', 1)[0]}.mp3"
-            final_temp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-            combined.export(final_temp.name, format="mp3")
-            for temp_file in temp_files:
-                os.unlink(temp_file)
-            logger.debug(f"Saved Google Cloud audio to {final_temp.name}")
-            
-            return final_temp.name, final_file_name, None
-    
-    except FileNotFoundError as e:
-        logger.error(f"TTS error: {str(e)}")
-        raise
-    except ValueError as ve:
-        logger.error(f"TTS validation error: {str(ve)}")
-        raise
-    except Exception as e:
-        logger.error(f"Error generating audio: {str(e)}")
-        raise
-
-class CustomAnonThrottle(AnonRateThrottle):
-    rate = '30/minute'  # Adjust this value based on your needs
-
-class CustomUserThrottle(UserRateThrottle):
-    rate = '60/minute'  # Adjust this value based on your needs
-
-@api_view(['POST'])
-@throttle_classes([CustomAnonThrottle, CustomUserThrottle])
-def analyze_files(request):
-    logger.debug("Received analyze_files request")
-    try:
-        files = request.FILES.getlist('files')
-        if not files:
-            return create_error_response(400, "No files uploaded.", "Please upload at least one file to analyze.")
-        if len(files) > MAX_FILES_PER_BATCH:
-            return create_error_response(400, f"Too many files uploaded.", f"Maximum of {MAX_FILES_PER_BATCH} files allowed.")
-        
-        fs = FileSystemStorage()
-        combined_text = []
-        for file in files:
-            file_extension = file.name.split('.')[-1].lower()
-            if file.size > MAX_FILE_SIZE_ONLINE:
-                return create_error_response(400, f"File '{file.name}' is too large.", f"Maximum file size is 20 MB.")
-            
-            filename = fs.save(file.name, file)
-            file_path = fs.path(filename)
-            try:
-                document_text = extract_text_from_file(file_path, file_extension)
-                if not document_text:
-                    continue
-                prompt = """
-                Extract content in Urdu only, including all diacritic marks such as zair, zabar, pesh, and all other diacritic marks.
-                Output only the extracted Urdu content without explanations.
-                """
-                extracted_text = get_gemini_response(prompt, document_text)
-                if extracted_text:
-                    cleaned_text = filter_unethical_text_with_prompt(extracted_text)
-                    if cleaned_text:
-                        combined_text.append(cleaned_text)
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-        
-        if not combined_text:
-            return create_error_response(400, "No valid text extracted.")
-        
-        extracted_text = "\n\n".join(combined_text)
-        detected_emotion = detect_emotions_with_ai(extracted_text)
-        detected_gender = detect_gender_with_ai(extracted_text)
-        logger.debug(f"Analyze files response: text_length={len(extracted_text)}, emotion={detected_emotion}, gender={detected_gender}")
-        return JsonResponse({
-            'extracted_text': extracted_text,
-            'detected_emotion': detected_emotion,
-            'detected_gender': detected_gender
-        })
-    except Exception as e:
-        logger.error(f"Analyze files error: {str(e)}")
-        return create_error_response(500, "An unexpected error occurred.", str(e))
-
-@api_view(['POST'])
-def generate_audio(request):
-    logger.debug(f"Received generate_audio request: {request.body}")
-    try:
-        data = json.loads(request.body)
-        text = data.get('text', '')
-        voice_settings_list = data.get('voice_settings_list', [])
-        detected_gender = data.get('detected_gender', 'unknown')
-        tts_provider = data.get('tts_provider', 'google')
-        use_background_music = data.get('use_background_music', False)
-        music_file_url = data.get('music_file_url')
-        music_volume_db = data.get('music_volume_db', -20.0)
-
-        # Validate inputs
-        if not text:
-            return create_error_response(400, "No text provided.")
-        if len(text) > MAX_TEXT_LENGTH:
-            return create_error_response(400, "Text exceeds maximum length", f"Maximum {MAX_TEXT_LENGTH} characters allowed")
-        if not voice_settings_list or not isinstance(voice_settings_list, list):
-            return create_error_response(400, "Invalid voice settings.")
-        if tts_provider not in ['google', 'gpt4o_mini']:
-            return create_error_response(400, "Invalid TTS provider", "Choose 'google' or 'gpt4o_mini'")
-        if detected_gender not in ['male', 'female', 'unknown']:
-            return create_error_response(400, "Invalid detected gender", "Must be 'male', 'female', or 'unknown'")
-        if not isinstance(use_background_music, bool):
-            return create_error_response(400, "Invalid use_background_music", "Must be a boolean")
-        if use_background_music and not music_file_url:
-            return create_error_response(400, "Music file URL required", "Provide 'music_file_url' when 'use_background_music' is true")
-        if use_background_music and not isinstance(music_volume_db, (int, float)):
-            return create_error_response(400, "Invalid music volume", "music_volume_db must be a number")
-        if use_background_music and (music_volume_db < -30.0 or music_volume_db > 0.0):
-            return create_error_response(400, "Invalid music volume", "music_volume_db must be between -30.0 and 0.0 dB")
-
-        # Generate audio using text_to_speech
-        base_file_name = "generated_audio"
-        audio_file, audio_file_name, warning = text_to_speech(text, voice_settings_list, base_file_name, detected_gender, tts_provider)
-
-        # Load generated audio
-        audio_segment = AudioSegment.from_mp3(audio_file)
-
-        # Handle background music if enabled
-        if use_background_music and music_file_url:
-            try:
-                logger.debug(f"Processing audio with background music: URL={music_file_url}, volume={music_volume_db}dB")
-                music_response = requests.get(music_file_url, timeout=30)
-                if music_response.status_code != 200:
-                    return create_error_response(400, "Failed to download music file", f"Status: {music_response.status_code}")
-
-                # Load music into pydub
-                music_segment = AudioSegment.from_file(io.BytesIO(music_response.content), format="mp3")
-
-                # Adjust music volume
-                music_segment = music_segment + music_volume_db
-
-                # Loop music to match audio duration if needed
-                audio_duration_ms = len(audio_segment)
-                music_duration_ms = len(music_segment)
-                if music_duration_ms < audio_duration_ms:
-                    loops_needed = int(audio_duration_ms // music_duration_ms) + 1
-                    music_segment = music_segment * loops_needed
-                    logger.debug(f"Looped music {loops_needed} times to match audio duration: {audio_duration_ms}ms")
-
-                # Trim music to match audio duration
-                music_segment = music_segment[:audio_duration_ms]
-
-                # Overlay music
-                audio_segment = audio_segment.overlay(music_segment)
-                logger.debug("Successfully overlaid background music")
-
-            except RequestException as e:
-                logger.error(f"Failed to download music file: {str(e)}")
-                return create_error_response(500, "Failed to download music file", str(e))
-            except Exception as e:
-                logger.error(f"Failed to process music file: {str(e)}")
-                return create_error_response(500, "Failed to process music file", str(e))
-
-        # Save final audio to temporary file
-        final_temp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        audio_segment.export(final_temp.name, format="mp3")
-
-        # Read and return the audio
-        with open(final_temp.name, 'rb') as f:
-            audio_bytes = f.read()
-        os.unlink(final_temp.name)
-        os.unlink(audio_file)  # Clean up the original audio file
-
-        # Set filename based on music usage
-        final_file_name = "generated_audio_with_music.mp3" if use_background_music else "generated_audio.mp3"
-        response = HttpResponse(audio_bytes, content_type='audio/mp3')
-        response['Content-Disposition'] = f'attachment; filename="{final_file_name}"'
-        logger.info(f"Audio generated successfully{' with background music' if use_background_music else ''}")
-        return response
-
-    except json.JSONDecodeError:
-        logger.error("Invalid JSON in request body")
-        return create_error_response(400, "Invalid JSON format in request body")
-    except ValueError as ve:
-        logger.error(f"Generate audio validation error: {str(ve)}")
-        return create_error_response(400, str(ve))
-    except Exception as e:
-        logger.error(f"Generate audio error: {str(e)}")
-        return create_error_response(500, "Failed to generate audio.", str(e))
-
-@api_view(['GET'])
-def available_voices(request):
-    logger.debug("Received available_voices request")
-    try:
-        voices = get_available_voices()
-        if not voices:
-            return create_error_response(500, "No voices available.")
-        logger.debug(f"Returning {len(voices)} voice options")
-        return JsonResponse({'voices': voices})
-    except Exception as e:
-        logger.error(f"Available voices error: {str(e)}")
-        return create_error_response(500, "Failed to fetch available voices.", str(e))
\ No newline at end of file
+import os
+import json
+import docx
+import tempfile
+import requests
+import httpx
+import logging
+import hashlib
+import time
+import re
+import random
+import threading
+import asyncio
+import weakref
+import zipfile
+import mmap
+import unicodedata
+import wave
+import uuid
+import codecs
+import datetime
+import math
+import multiprocessing
+import tracemalloc
+try:
+    import fcntl
+except ImportError:  # Windows development machines run a single process.
+    fcntl = None
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from functools import lru_cache
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait as wait_futures, TimeoutError as FutureTimeoutError
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.core.files.uploadhandler import FileUploadHandler
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from rest_framework.decorators import api_view, throttle_classes
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+from rest_framework.request import Request as DRFRequest
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import APIException, Throttled
+from google.cloud import documentai_v1 as documentai
+from google.cloud import texttospeech
+from google.api_core.client_options import ClientOptions
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from dotenv import load_dotenv
+from requests.exceptions import RequestException, ConnectTimeout, ConnectionError as RequestsConnectionError
+from urllib3.exceptions import NewConnectionError
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from pydub import AudioSegment
+from pypdf import PdfReader, PdfWriter
+import numpy as np
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+import io
+from .models import MusicJob
+from .extraction_workers import extract_pdf_text_layer, preprocess_image
+
+load_dotenv()
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.getenv('PROJECT_ID', '585624190112')
+LOCATION = os.getenv('LOCATION', 'us')
+PROCESSOR_ID = os.getenv('PROCESSOR_ID', '867de035aee8db09')
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY', '')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+LOUDLY_API_KEY = os.getenv('LOUDLY_API_KEY', 'yfZX66sUgEGqQLrHpI-ysbcTNrMozGnXtqPlyD-6NXQ')
+SECRET_KEY = os.getenv('SECRET_KEY', '')
+GPT4O_MINI_TTS_API_KEY = os.getenv('OPENAI_API_KEY', '')
+GOOGLE_CREDENTIALS_PATH = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', "/home/abdulqadeer/Downloads/ai-titude/credentials.json")
+GOOGLE_TOKEN_REFRESH_MARGIN = int(os.getenv('GOOGLE_TOKEN_REFRESH_MARGIN', 300))
+genai.configure(api_key=GOOGLE_API_KEY)
+
+MAX_FILE_SIZE_ONLINE = 20 * 1024 * 1024
+MAX_FILE_SIZE_BATCH = 1 * 1024 * 1024 * 1024
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv('MAX_UPLOAD_REQUEST_BYTES', 512 * 1024 * 1024))
+MAX_IMAGE_RESOLUTION = 40 * 1000000
+MAX_FILES_PER_BATCH = 5000
+MAX_PAGES_ONLINE_DEFAULT = 15
+MAX_PAGES_IMAGELESS = 30
+MAX_PDF_FILE_SIZE = int(os.getenv('MAX_PDF_FILE_SIZE', 200 * 1024 * 1024))
+MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', 2000))
+# PDFs are OCR'd in page shards that each fit the online processing limits.
+PDF_SHARD_MAX_PAGES = int(os.getenv('PDF_SHARD_MAX_PAGES', MAX_PAGES_ONLINE_DEFAULT))
+PDF_SHARD_MAX_BYTES = int(os.getenv('PDF_SHARD_MAX_BYTES', MAX_FILE_SIZE_ONLINE))
+# Pages whose embedded text layer passes the quality check are extracted locally instead of OCR'd.
+PDF_TEXT_LAYER_ENABLED = os.getenv('PDF_TEXT_LAYER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PDF_TEXT_LAYER_MIN_CHARS = int(os.getenv('PDF_TEXT_LAYER_MIN_CHARS', 20))
+PDF_TEXT_LAYER_MAX_SUSPECT_RATIO = float(os.getenv('PDF_TEXT_LAYER_MAX_SUSPECT_RATIO', 0.02))
+PDF_TEXT_LAYER_PAGES_PER_TASK = int(os.getenv('PDF_TEXT_LAYER_PAGES_PER_TASK', 16))
+# Image uploads are downsampled, converted to grayscale and split into frames before OCR.
+IMAGE_PREPROCESSING_ENABLED = os.getenv('IMAGE_PREPROCESSING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+IMAGE_OCR_TARGET_DPI = int(os.getenv('IMAGE_OCR_TARGET_DPI', 300))
+IMAGE_OCR_MAX_EDGE = int(os.getenv('IMAGE_OCR_MAX_EDGE', 3500))
+IMAGE_OCR_JPEG_QUALITY = int(os.getenv('IMAGE_OCR_JPEG_QUALITY', 90))
+IMAGE_OCR_MAX_FRAMES = int(os.getenv('IMAGE_OCR_MAX_FRAMES', 100))
+MAX_TEXT_LENGTH = 10000
+
+ANALYZE_MAX_WORKERS = int(os.getenv('ANALYZE_MAX_WORKERS', 8))
+# Per request: how many of its files or windows may be queued on analyze_executor at once, and how
+# long to wait for one of them before giving up on it. A file that needs OCR in several rounds of
+# shards extends its timeout by PDF_SHARD_TIMEOUT per round.
+ANALYZE_MAX_FANOUT = int(os.getenv('ANALYZE_MAX_FANOUT', 4))
+ANALYZE_TASK_TIMEOUT = int(os.getenv('ANALYZE_TASK_TIMEOUT', 300))
+PDF_SHARD_TIMEOUT = int(os.getenv('PDF_SHARD_TIMEOUT', 120))
+DOCUMENT_AI_MAX_CONCURRENCY = int(os.getenv('DOCUMENT_AI_MAX_CONCURRENCY', 4))
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 8))
+TTS_MAX_CONCURRENCY = int(os.getenv('TTS_MAX_CONCURRENCY', 4))
+LOCAL_EXTRACTION_MAX_WORKERS = int(os.getenv('LOCAL_EXTRACTION_MAX_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_SHARD_MAX_WORKERS = int(os.getenv('PDF_SHARD_MAX_WORKERS', DOCUMENT_AI_MAX_CONCURRENCY))
+BATCH_RENDER_MAX_WORKERS = int(os.getenv('BATCH_RENDER_MAX_WORKERS', 4))
+MAX_BATCH_RENDERS = 16
+# Limits for the asyncio request path, where each in-flight call costs a coroutine rather than a thread.
+ASYNC_UPSTREAM_LIMITS = {
+    'documentai': int(os.getenv('ASYNC_DOCUMENT_AI_MAX_CONCURRENCY', 32)),
+    'gemini': int(os.getenv('ASYNC_GEMINI_MAX_CONCURRENCY', 64)),
+    'texttospeech': int(os.getenv('ASYNC_TTS_MAX_CONCURRENCY', 32)),
+    'openai': int(os.getenv('ASYNC_OPENAI_MAX_CONCURRENCY', 32)),
+    'loudly': int(os.getenv('ASYNC_LOUDLY_MAX_CONCURRENCY', 16)),
+}
+GOOGLE_TTS_MAX_BYTES = 5000
+OPENAI_TTS_MAX_BYTES = 4096
+VOICE_DIRECTIVE_CACHE_SIZE = int(os.getenv('VOICE_DIRECTIVE_CACHE_SIZE', 256))
+# Cut TTS text into chunks at sentences chosen by their content, so an edited text only
+# re-synthesizes the chunks around the edit. When off, sentences are packed into as few
+# requests as possible.
+TTS_SENTENCE_CACHE_ENABLED = os.getenv('TTS_SENTENCE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Average number of sentences per content-defined chunk.
+TTS_CHUNK_TARGET_SENTENCES = int(os.getenv('TTS_CHUNK_TARGET_SENTENCES', 8))
+AUDIO_STREAM_CHUNK_SIZE = 16 * 1024
+AUDIO_OUTPUT_FORMATS = {
+    'mp3': {'container': 'mp3', 'codec': None, 'content_type': 'audio/mp3', 'google': 'MP3', 'openai': 'mp3'},
+    'opus': {'container': 'ogg', 'codec': 'libopus', 'content_type': 'audio/ogg', 'google': 'OGG_OPUS', 'openai': 'opus'},
+    'ogg': {'container': 'ogg', 'codec': 'libopus', 'content_type': 'audio/ogg', 'google': 'OGG_OPUS', 'openai': 'opus'},
+    'wav': {'container': 'wav', 'codec': None, 'content_type': 'audio/wav', 'google': 'LINEAR16', 'openai': 'wav'},
+}
+AUDIO_BITRATES = ['24k', '32k', '48k', '64k', '96k', '128k', '192k']
+OPENAI_TTS_URL = "https://api.openai.com/v1/audio/speech"
+GPT4O_VOICES = ['alloy', 'ash', 'ballad', 'coral', 'echo', 'fable', 'onyx', 'nova', 'sage', 'shimmer']
+GPT4O_VOICE_LANGUAGE = 'ur-PK'
+VOICE_CATALOG_REFRESH_SECONDS = int(os.getenv('VOICE_CATALOG_REFRESH_SECONDS', 6 * 60 * 60))
+VOICE_CATALOG_MAX_VIEWS = int(os.getenv('VOICE_CATALOG_MAX_VIEWS', 256))
+VOICE_CATALOG_MAX_AGE = int(os.getenv('VOICE_CATALOG_MAX_AGE', 3600))
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 16))
+UPSTREAM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('UPSTREAM_CIRCUIT_FAILURE_THRESHOLD', 5))
+UPSTREAM_CIRCUIT_RESET_TIMEOUT = int(os.getenv('UPSTREAM_CIRCUIT_RESET_TIMEOUT', 30))
+# How long a working Loudly endpoint/payload combination is trusted, and how many failures demote it.
+LOUDLY_NEGOTIATION_TTL = int(os.getenv('LOUDLY_NEGOTIATION_TTL', 24 * 60 * 60))
+LOUDLY_NEGOTIATION_MAX_FAILURES = int(os.getenv('LOUDLY_NEGOTIATION_MAX_FAILURES', 3))
+
+MUSIC_JOB_MAX_WORKERS = int(os.getenv('MUSIC_JOB_MAX_WORKERS', 4))
+# Succeeded jobs are reused for identical prompt+duration submissions for this long.
+MUSIC_JOB_RESULT_TTL = int(os.getenv('MUSIC_JOB_RESULT_TTL', 60 * 60))
+# Pending/running jobs untouched for this long (e.g. after a restart) are picked up again.
+MUSIC_JOB_STALE_SECONDS = int(os.getenv('MUSIC_JOB_STALE_SECONDS', 10 * 60))
+# Long-polls hold a worker for their whole wait, so keep them short and let clients poll again.
+MUSIC_JOB_MAX_WAIT = int(os.getenv('MUSIC_JOB_MAX_WAIT', 5))
+
+# Words whose presence sends a sentence to the filter model; see api/urdu_words.txt.
+URDU_BLOCKLIST_PATH = os.getenv('URDU_BLOCKLIST_PATH', os.path.join(settings.BASE_DIR, 'api', 'urdu_words.txt'))
+
+EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'extraction'))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+EXTRACTION_CACHE_TTL = int(os.getenv('EXTRACTION_CACHE_TTL', 30 * 24 * 60 * 60))
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'audio'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+AUDIO_CACHE_TTL = int(os.getenv('AUDIO_CACHE_TTL', 30 * 24 * 60 * 60))
+AUDIO_CACHE_MAX_AGE = int(os.getenv('AUDIO_CACHE_MAX_AGE', 24 * 60 * 60))
+# Bump when synthesis or post-processing changes so old audio is not served for new requests.
+AUDIO_CACHE_VERSION = 1
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'cache', 'uploads'))
+MUSIC_STORE_DIR = os.getenv('MUSIC_STORE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'music'))
+MUSIC_STORE_MAX_BYTES = int(os.getenv('MUSIC_STORE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+MUSIC_STORE_TTL = int(os.getenv('MUSIC_STORE_TTL', 7 * 24 * 60 * 60))
+MUSIC_STORE_MAX_WORKERS = int(os.getenv('MUSIC_STORE_MAX_WORKERS', 2))
+# Background music is stored and mixed as interleaved int16 PCM in this layout. Mixing at 44.1 kHz
+# keeps the music at full quality; narration from lower-rate voices is resampled up to it.
+MIX_SAMPLE_RATE = 44100
+MIX_CHANNELS = 2
+MIX_BLOCK_FRAMES = 64 * 1024
+MIX_CROSSFADE_FRAMES = MIX_SAMPLE_RATE // 20
+MIX_DUCKING_WINDOW_FRAMES = MIX_SAMPLE_RATE // 50
+MIX_DUCKING_SMOOTHING_WINDOWS = 10
+MIX_DUCKING_THRESHOLD = 32768 * 10 ** (-40 / 20)
+# Log the peak memory traced while mixing. tracemalloc slows allocation down and is process-wide,
+# so concurrent mixes share one peak; meant for profiling, not for production.
+MIX_TRACE_MEMORY = os.getenv('MIX_TRACE_MEMORY', 'false').lower() in ('1', 'true', 'yes')
+# Gender and emotion are answered from the local lexicons when their confidence reaches these thresholds.
+LEXICON_CLASSIFIER_ENABLED = os.getenv('LEXICON_CLASSIFIER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+GENDER_LEXICON_MIN_CONFIDENCE = float(os.getenv('GENDER_LEXICON_MIN_CONFIDENCE', 0.6))
+EMOTION_LEXICON_MIN_CONFIDENCE = float(os.getenv('EMOTION_LEXICON_MIN_CONFIDENCE', 0.5))
+# Weighted hits at which the evidence factor of the confidence reaches 1 - 1/e.
+LEXICON_EVIDENCE_SCALE = float(os.getenv('LEXICON_EVIDENCE_SCALE', 4))
+# Bump whenever URDU_EXTRACTION_PROMPT or the filter prompt changes so stale cleaned text is not served.
+EXTRACTION_PROMPT_VERSION = 2
+# Same for COMBINED_ANALYSIS_PROMPT / COMBINED_ANALYSIS_SCHEMA.
+COMBINED_ANALYSIS_PROMPT_VERSION = 2
+# Same for the lexicons and the emotion/gender prompts behind cached map-reduce window labels.
+WINDOW_ANALYSIS_VERSION = 1
+
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-1.5-flash')
+# 'combined' does extraction, filtering, emotion and gender in one structured Gemini call per file,
+# then re-checks the cleaned text against the blocklist and fills labels Gemini left open from the
+# lexicons; it is already per file, so it never switches to 'map_reduce';
+# 'multi' keeps the original extract -> filter -> emotion -> gender sequence of calls and is the
+# default; 'combined' is opt-in per request or through ANALYSIS_MODE;
+# 'map_reduce' classifies each file in bounded windows and votes, so no prompt grows with the batch.
+ANALYSIS_MODES = ['combined', 'multi', 'map_reduce']
+ANALYSIS_MODE = os.getenv('ANALYSIS_MODE', 'multi')
+MAP_REDUCE_WINDOW_BYTES = int(os.getenv('MAP_REDUCE_WINDOW_BYTES', 32 * 1024))
+# 'multi' requests whose joined text is larger than this are analyzed with 'map_reduce' instead.
+MAP_REDUCE_AUTO_THRESHOLD_CHARS = int(os.getenv('MAP_REDUCE_AUTO_THRESHOLD_CHARS', 200000))
+
+URDU_EXTRACTION_PROMPT = """
+    Extract content in Urdu only, including all diacritic marks such as zair, zabar, pesh, and all other diacritic marks.
+    Output only the extracted Urdu content without explanations.
+    """
+
+EMOTION_MAPPING = {
+    "neutral": "neutral",
+    "sympathetic": "sympathetic",
+    "sincere": "sincere",
+    "calm": "calm",
+    "serene": "serene",
+    "sadness": "sad",
+    "happiness": "happy",
+    "fear": "fearful",
+    "horror": "horrified",
+    "surprise": "surprised",
+    "anger": "angry",
+    "rage": "enraged",
+    "love": "loving",
+    "excitement": "excited",
+    "anxiety": "anxious",
+    "disgust": "disgusted"
+}
+
+COMBINED_ANALYSIS_PROMPT = f"""
+    The document above is raw OCR or file text that may mix Urdu with other languages. In a single pass:
+    1. Extract the content in Urdu only, including all diacritic marks such as zair, zabar, pesh, and all other diacritic marks.
+    2. Remove any vulgar, abusive, or unethical words or phrases from it, preserving the original meaning as much as possible.
+    3. Identify the single most prominent emotion of the cleaned text from this list: {', '.join(EMOTION_MAPPING.keys())}.
+    4. Determine the gender of the subject (male, female, or unknown) from pronouns, verb conjugations (e.g., "گیا" for male, "گئی" for female),
+       or nouns (e.g., "لڑکا" for male, "لڑکی" for female).
+    Return the cleaned Urdu text without explanations in "cleaned_text".
+    """
+
+COMBINED_ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'cleaned_text': {'type': 'string'},
+        'emotion': {'type': 'string', 'enum': list(EMOTION_MAPPING.keys())},
+        'gender': {'type': 'string', 'enum': ['male', 'female', 'unknown']},
+    },
+    'required': ['cleaned_text', 'emotion', 'gender'],
+}
+
+def load_urdu_dictionary(file_path=URDU_BLOCKLIST_PATH):
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return set(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    except FileNotFoundError:
+        logger.error(f"Could not find Urdu dictionary at {file_path}; set URDU_BLOCKLIST_PATH or restore api/urdu_words.txt")
+        return set()
+
+urdu_dictionary = load_urdu_dictionary()
+
+# Shared across requests so the total fan-out and the load on each upstream stay bounded per process.
+analyze_executor = ThreadPoolExecutor(max_workers=ANALYZE_MAX_WORKERS, thread_name_prefix='analyze')
+document_ai_semaphore = threading.BoundedSemaphore(DOCUMENT_AI_MAX_CONCURRENCY)
+gemini_semaphore = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_CONCURRENCY, thread_name_prefix='tts')
+# Each batch render fans its chunks out on tts_executor, so renders get their own pool to avoid
+# filling tts_executor with tasks that wait on tts_executor.
+batch_render_executor = ThreadPoolExecutor(max_workers=BATCH_RENDER_MAX_WORKERS, thread_name_prefix='batch-render')
+# PDF shards and image frames are submitted from analyze_executor threads, so they need a pool of their own as well.
+ocr_shard_executor = ThreadPoolExecutor(max_workers=PDF_SHARD_MAX_WORKERS, thread_name_prefix='ocr-shard')
+
+class TaskDeadline:
+    """
+    How long map_bounded waits for one task. The clock starts when the task is first waited on,
+    and the task may extend it once it knows how much work it has (the page count of a PDF).
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._expires_at is None:
+                self._expires_at = time.monotonic() + self.seconds
+
+    def extend(self, seconds):
+        with self._lock:
+            self.seconds += seconds
+            if self._expires_at is not None:
+                self._expires_at += seconds
+
+    def remaining(self):
+        with self._lock:
+            if self._expires_at is None:
+                return self.seconds
+            return self._expires_at - time.monotonic()
+
+_task_context = threading.local()
+
+def run_with_deadline(fn, item, deadline):
+    _task_context.deadline = deadline
+    try:
+        return fn(item)
+    finally:
+        _task_context.deadline = None
+
+def extend_task_deadline(seconds):
+    # Outside map_bounded (the async views, job workers) there is no deadline to extend.
+    deadline = getattr(_task_context, 'deadline', None)
+    if deadline is not None:
+        deadline.extend(seconds)
+
+def task_deadline_passed():
+    deadline = getattr(_task_context, 'deadline', None)
+    return deadline is not None and deadline.remaining() <= 0
+
+def shard_timeout(shard_count):
+    # Shards run PDF_SHARD_MAX_WORKERS at a time, so the wait grows with the number of rounds.
+    return math.ceil(shard_count / PDF_SHARD_MAX_WORKERS) * PDF_SHARD_TIMEOUT
+
+def cancel_futures(futures):
+    for future in futures:
+        future.cancel()
+_local_extraction_pool = None
+_local_extraction_pool_lock = threading.Lock()
+
+def get_local_extraction_pool():
+    # Created on first use. Spawned workers import only api.extraction_workers, not Django.
+    global _local_extraction_pool
+    with _local_extraction_pool_lock:
+        if _local_extraction_pool is None:
+            _local_extraction_pool = ProcessPoolExecutor(
+                max_workers=LOCAL_EXTRACTION_MAX_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _local_extraction_pool
+
+# Urdu full stop and question mark end a sentence on their own; Latin punctuation needs trailing whitespace
+# so decimals and abbreviations stay intact.
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[۔؟])\s*|(?<=[.!?])\s+')
+
+def create_error_response(code, message, details=None):
+    response = {'error': {'code': code, 'message': message}}
+    if details:
+        response['error']['details'] = details
+    logger.error(f"Error {code}: {message} - Details: {details}")
+    return JsonResponse(response, status=code)
+
+class DiskLRUCache:
+    """
+    Size-bounded key/value store on local disk with LRU eviction and a TTL.
+    Each entry is a file named after its key. The file mtime is the write time (used for the TTL)
+    and the atime is the last hit (used for LRU order), so the index can be rebuilt after a restart.
+
+    Worker processes share the directory but each keeps its own index. Keys missing from the index
+    are looked up on disk, so entries written by another process are hits too. The directory's
+    total size is kept in a locked usage file, and the index is re-read from disk before evicting,
+    so max_bytes bounds the directory rather than each process's share of it.
+    """
+
+    USAGE_FILE = '.usage'
+
+    def __init__(self, directory, max_bytes, ttl_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = None
+        self._total_bytes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        if self._index is None:
+            self._scan()
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp') or name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, name, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((name, size) for _, name, size in entries)
+        self._total_bytes = sum(self._index.values())
+
+    def _discard(self, key):
+        """Drop key from the index and the disk. Returns the number of bytes removed from disk."""
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+        path = self._path(key)
+        try:
+            removed = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            return 0
+        return removed
+
+    @contextmanager
+    def _shared_usage(self):
+        """
+        Lock the directory's usage file and yield its byte count as a one-item list; the value is
+        written back on exit. The file is (re)built from a scan when it is missing.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, self.USAGE_FILE), 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            text = f.read().strip()
+            if text.isdigit():
+                usage = [int(text)]
+            else:
+                self._scan()
+                usage = [self._total_bytes]
+            yield usage
+            f.seek(0)
+            f.truncate()
+            f.write(str(max(0, usage[0])))
+
+    def _lookup(self, key):
+        with self._lock:
+            self._load_index()
+            try:
+                stat = os.stat(self._path(key))
+            except OSError:
+                self._discard(key)
+                self.misses += 1
+                return None
+            if time.time() - stat.st_mtime > self.ttl_seconds:
+                removed = self._discard(key)
+                if removed:
+                    with self._shared_usage() as usage:
+                        usage[0] -= removed
+                self.misses += 1
+                return None
+            if key not in self._index:
+                # Written by another worker process since this index was built.
+                self._index[key] = stat.st_size
+                self._total_bytes += stat.st_size
+            self._index.move_to_end(key)
+            self.hits += 1
+            return stat
+
+    def get(self, key):
+        path = self._path(key)
+        stat = self._lookup(key)
+        if stat is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError as e:
+            logger.warning(f"Cache read failed for {key}: {str(e)}")
+            return None
+        return data
+
+    def get_path(self, key):
+        """Like get(), but return the entry's file path (for memory-mapping) instead of its contents."""
+        path = self._path(key)
+        stat = self._lookup(key)
+        if stat is None:
+            return None
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            return None
+        return path
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+            # Same clock as the hit timestamps in get(), so LRU order does not depend on filesystem granularity.
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError as e:
+            logger.warning(f"Cache write failed for {key}: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self._load_index()
+            previous = self._index.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            with self._shared_usage() as usage:
+                usage[0] += len(data) - replaced
+                if usage[0] > self.max_bytes:
+                    # Other processes write here too: evict in LRU order over everything on disk.
+                    self._scan()
+                    while self._total_bytes > self.max_bytes and self._index:
+                        self._discard(next(iter(self._index)))
+                    usage[0] = self._total_bytes
+
+    def get_json(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def set_json(self, key, value):
+        self.set(key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def stats(self):
+        with self._lock:
+            self._load_index()
+            with self._shared_usage() as usage:
+                total_bytes = usage[0]
+            return {
+                'entries': len(self._index),
+                'bytes': total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+extraction_cache = DiskLRUCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MAX_BYTES, EXTRACTION_CACHE_TTL)
+audio_cache = DiskLRUCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_TTL)
+music_cache = DiskLRUCache(MUSIC_STORE_DIR, MUSIC_STORE_MAX_BYTES, MUSIC_STORE_TTL)
+
+UPLOAD_SIGNATURES = [
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'BM', 'bmp'),
+    (b'PK\x03\x04', 'docx'),
+]
+UPLOAD_SNIFF_BYTES = 4096
+
+def sniff_upload_type(head, extension):
+    """
+    Identify an upload from its leading bytes. Returns the file kind used by extract_text_from_file,
+    or None when the content is not a supported type. Plain text has no signature, so it is only
+    accepted for .txt uploads whose head is valid UTF-8.
+    """
+    if extension == 'txt':
+        if b'\x00' in head:
+            return None
+        try:
+            # A multi-byte character may be cut off at the end of the head, so decode without final=True.
+            codecs.getincrementaldecoder('utf-8')().decode(head)
+        except UnicodeDecodeError:
+            return None
+        return 'txt'
+    for signature, kind in UPLOAD_SIGNATURES:
+        if head.startswith(signature):
+            if kind == 'docx' and extension != 'docx':
+                return None
+            return kind
+    return None
+
+def upload_size_limit(kind):
+    # PDFs are split into shards before they are sent upstream, so they may exceed the online limit.
+    return MAX_PDF_FILE_SIZE if kind == 'pdf' else MAX_FILE_SIZE_ONLINE
+
+class SpooledUpload:
+    """
+    An upload streamed into UPLOAD_SPOOL_DIR. The content hash and type were computed while it was
+    written, so nothing downstream reads the file just to identify it. Rejected uploads carry an
+    error and no file. close() removes the spool file; Django calls it when the request ends.
+    """
+
+    def __init__(self, name, size=0, path=None, sha256=None, kind=None, error=None):
+        self.name = name
+        self.size = size
+        self.path = path
+        self.sha256 = sha256
+        self.kind = kind
+        self.error = error
+
+    def close(self):
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+class UploadSpooler:
+    """
+    Writes one upload into the spool chunk by chunk, hashing as it goes. The type is sniffed from
+    the first UPLOAD_SNIFF_BYTES before anything reaches disk, and the upload is abandoned as soon
+    as it passes the size limit for its type, so a rejected file is never buffered whole.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+        self.size = 0
+        self.kind = None
+        self.error = None
+        self._digest = hashlib.sha256()
+        self._head = b''
+        os.makedirs(UPLOAD_SPOOL_DIR, mode=0o700, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR, suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+
+    def _reject(self, message):
+        logger.error(f"Rejected upload '{self.name}': {message}")
+        self.error = message
+        self.abort()
+
+    def _sniff(self):
+        self.kind = sniff_upload_type(self._head, self.extension)
+        if self.kind is None:
+            self._reject("Unsupported file type. Supported types are: jpg, png, bmp, tiff, gif, pdf, docx, txt.")
+            return
+        self._store(self._head)
+        self._head = None
+
+    def _store(self, chunk):
+        self._digest.update(chunk)
+        self._file.write(chunk)
+
+    def write(self, chunk):
+        if self.error:
+            return
+        self.size += len(chunk)
+        max_bytes = upload_size_limit(self.kind)
+        if self.size > max_bytes:
+            self._reject(f"File is too large. Maximum file size is {max_bytes // (1024 * 1024)} MB.")
+        elif self._head is not None:
+            self._head += chunk
+            if len(self._head) >= UPLOAD_SNIFF_BYTES:
+                self._sniff()
+        else:
+            self._store(chunk)
+
+    def finish(self):
+        if not self.error and self._head is not None:
+            if not self._head:
+                self._reject("File is empty.")
+            else:
+                self._sniff()
+        if self.error:
+            return SpooledUpload(self.name, self.size, error=self.error)
+        self._file.close()
+        sha256 = self._digest.hexdigest()
+        shard = os.path.join(UPLOAD_SPOOL_DIR, sha256[:2])
+        os.makedirs(shard, mode=0o700, exist_ok=True)
+        # Named per upload, not just per hash, so concurrent identical uploads do not share a lifetime.
+        path = os.path.join(shard, f"{sha256}-{uuid.uuid4().hex[:8]}.{self.kind}")
+        os.replace(self._temp_path, path)
+        return SpooledUpload(self.name, self.size, path, sha256, self.kind)
+
+    def abort(self):
+        self._head = None
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
+
+class SpoolingUploadHandler(FileUploadHandler):
+    """Multipart upload handler that streams each file part straight into an UploadSpooler."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.spooler = UploadSpooler(self.file_name)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.spooler.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        return self.spooler.finish()
+
+    def upload_interrupted(self):
+        spooler = getattr(self, 'spooler', None)
+        if spooler is not None:
+            spooler.abort()
+
+def use_upload_spool(request):
+    """Route a request's multipart files through the spool. Must run before FILES is read."""
+    django_request = getattr(request, '_request', request)
+    try:
+        django_request.upload_handlers = [SpoolingUploadHandler(django_request)]
+    except AttributeError:
+        # Already parsed (e.g. by a CSRF check); ingest_upload spools Django's copies instead.
+        pass
+
+def upload_request_too_large(request):
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    return content_length > MAX_UPLOAD_REQUEST_BYTES
+
+def ingest_upload(file):
+    if isinstance(file, SpooledUpload):
+        return file
+    max_bytes = max(MAX_FILE_SIZE_ONLINE, MAX_PDF_FILE_SIZE)
+    if file.size is not None and file.size > max_bytes:
+        logger.error(f"File '{file.name}' is too large: {file.size} bytes")
+        return SpooledUpload(file.name, file.size, error=f"File is too large. Maximum file size is {max_bytes // (1024 * 1024)} MB.")
+    spooler = UploadSpooler(file.name)
+    try:
+        for chunk in file.chunks():
+            spooler.write(chunk)
+            if spooler.error:
+                break
+    except Exception:
+        spooler.abort()
+        raise
+    return spooler.finish()
+
+def extraction_cache_key(file_hash, stage):
+    if stage == 'raw':
+        material = f"raw:{file_hash}:{PROCESSOR_ID}"
+    elif stage == 'shard':
+        material = f"shard:{file_hash}:{PROCESSOR_ID}"
+    elif stage == 'combined':
+        material = f"combined:{file_hash}:{PROCESSOR_ID}:{COMBINED_ANALYSIS_PROMPT_VERSION}"
+    elif stage == 'window':
+        material = (f"window:{file_hash}:{WINDOW_ANALYSIS_VERSION}:{LEXICON_CLASSIFIER_ENABLED}:"
+                    f"{GENDER_LEXICON_MIN_CONFIDENCE}:{EMOTION_LEXICON_MIN_CONFIDENCE}")
+    else:
+        material = f"cleaned:{file_hash}:{PROCESSOR_ID}:{EXTRACTION_PROMPT_VERSION}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class GoogleClientRegistry:
+    """
+    Process-wide registry of long-lived Google Cloud clients. Credentials are read from disk once
+    and shared by every client; their access token is refreshed on a background timer ahead of
+    expiry so requests never pay for a token fetch. Clients are created lazily per (kind, endpoint)
+    and reused, since gRPC channels are thread-safe.
+    """
+
+    CLIENT_CLASSES = {
+        'documentai': documentai.DocumentProcessorServiceClient,
+        'texttospeech': texttospeech.TextToSpeechClient,
+    }
+    ASYNC_CLIENT_CLASSES = {
+        'documentai': documentai.DocumentProcessorServiceAsyncClient,
+        'texttospeech': texttospeech.TextToSpeechAsyncClient,
+    }
+    SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+    def __init__(self, credentials_path):
+        self.credentials_path = credentials_path
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._clients = {}
+        # grpc.aio channels belong to the event loop that created them, so async clients are kept per loop.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._client_stats = {}
+        self._token_refreshes = 0
+        self._token_refresh_failures = 0
+
+    def get_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                if not os.path.exists(self.credentials_path):
+                    raise FileNotFoundError("Google Cloud credentials file not found")
+                # Explicit scopes keep the client libraries from making their own scoped copy,
+                # so the background refresh updates the token every client actually uses.
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_path, scopes=self.SCOPES
+                )
+                self._schedule_refresh(0)
+            return self._credentials
+
+    def _schedule_refresh(self, delay):
+        timer = threading.Timer(delay, self._refresh_token)
+        timer.daemon = True
+        timer.start()
+
+    def _refresh_token(self):
+        try:
+            self._credentials.refresh(GoogleAuthRequest())
+            self._token_refreshes += 1
+            expiry = self._credentials.expiry
+            if expiry:
+                delay = (expiry - datetime.datetime.utcnow()).total_seconds() - GOOGLE_TOKEN_REFRESH_MARGIN
+            else:
+                delay = GOOGLE_TOKEN_REFRESH_MARGIN
+        except Exception as e:
+            self._token_refresh_failures += 1
+            logger.error(f"Failed to refresh Google Cloud access token: {str(e)}")
+            delay = 60
+        self._schedule_refresh(max(delay, 30))
+
+    def get_client(self, kind, api_endpoint=None):
+        key = f"{kind}@{api_endpoint or 'default'}"
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._client_stats[key]['reused'] += 1
+                return client
+        credentials = self.get_credentials()
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client_options = ClientOptions(api_endpoint=api_endpoint) if api_endpoint else None
+                client = self.CLIENT_CLASSES[kind](client_options=client_options, credentials=credentials)
+                self._clients[key] = client
+                self._client_stats[key] = {'created': 1, 'reused': 0}
+                logger.info(f"Created Google Cloud client {key}")
+            else:
+                self._client_stats[key]['reused'] += 1
+            return client
+
+    def get_async_client(self, kind, api_endpoint=None):
+        loop = asyncio.get_running_loop()
+        key = f"{kind}_async@{api_endpoint or 'default'}"
+        credentials = self.get_credentials()
+        with self._lock:
+            loop_clients = self._async_clients.setdefault(loop, {})
+            client = loop_clients.get(key)
+            stats = self._client_stats.setdefault(key, {'created': 0, 'reused': 0})
+            if client is None:
+                client_options = ClientOptions(api_endpoint=api_endpoint) if api_endpoint else None
+                client = self.ASYNC_CLIENT_CLASSES[kind](client_options=client_options, credentials=credentials)
+                loop_clients[key] = client
+                stats['created'] += 1
+                logger.info(f"Created Google Cloud async client {key}")
+            else:
+                stats['reused'] += 1
+            return client
+
+    def pop_async_clients(self, loop):
+        """Forget and return the async clients created on loop, for closing when it shuts down."""
+        with self._lock:
+            return list(self._async_clients.pop(loop, {}).values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'credentials_loaded': self._credentials is not None,
+                'token_valid': bool(self._credentials and self._credentials.valid),
+                'token_refreshes': self._token_refreshes,
+                'token_refresh_failures': self._token_refresh_failures,
+                'clients': {key: dict(value) for key, value in self._client_stats.items()},
+            }
+
+google_clients = GoogleClientRegistry(GOOGLE_CREDENTIALS_PATH)
+
+def build_process_request(name, file_path, mime_type, is_batch=False):
+    file_size = os.path.getsize(file_path)
+    max_file_size = MAX_FILE_SIZE_BATCH if is_batch else MAX_FILE_SIZE_ONLINE
+    if file_size > max_file_size:
+        limit_mb = max_file_size // (1024 * 1024)
+        raise ValueError(f"File size exceeds the {'batch' if is_batch else 'online'} processing limit of {limit_mb} MB.")
+
+    # RawDocument takes the content as bytes, so an unprocessed upload is read whole here; this is
+    # the one copy of the file the upload path makes.
+    with open(file_path, "rb") as f:
+        file_content = f.read()
+    return build_content_process_request(name, file_content, mime_type)
+
+def build_content_process_request(name, content, mime_type):
+    if len(content) > MAX_FILE_SIZE_ONLINE:
+        raise ValueError(f"File size exceeds the online processing limit of {MAX_FILE_SIZE_ONLINE // (1024 * 1024)} MB.")
+    raw_document = documentai.RawDocument(content=content, mime_type=mime_type)
+    return documentai.ProcessRequest(name=name, raw_document=raw_document)
+
+def check_processed_document(document, request):
+    page_count = len(document.pages)
+    max_pages = MAX_PAGES_IMAGELESS if 'imageless_mode' in request else MAX_PAGES_ONLINE_DEFAULT
+    if page_count > max_pages:
+        raise ValueError(f"Document exceeds the page limit of {max_pages} pages for {'imageless' if 'imageless_mode' in request else 'standard'} mode.")
+    return document
+
+def process_document(file_path, mime_type, is_batch=False):
+    try:
+        client = google_clients.get_client('documentai', f"{LOCATION}-documentai.googleapis.com")
+        name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+        
+        request = build_process_request(name, file_path, mime_type, is_batch)
+        with document_ai_semaphore:
+            result = client.process_document(request=request)
+        return check_processed_document(result.document, request)
+    except FileNotFoundError as e:
+        logger.error(f"Document AI error: {str(e)}")
+        raise
+    except ValueError as ve:
+        logger.error(f"Document AI validation error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to process document with Document AI: {str(e)}")
+        raise
+
+def process_document_content(content, mime_type):
+    try:
+        client = google_clients.get_client('documentai', f"{LOCATION}-documentai.googleapis.com")
+        name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+        request = build_content_process_request(name, content, mime_type)
+        with document_ai_semaphore:
+            result = client.process_document(request=request)
+        return check_processed_document(result.document, request)
+    except ValueError as ve:
+        logger.error(f"Document AI validation error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to process document with Document AI: {str(e)}")
+        raise
+
+def format_extracted_text(document):
+    return document.text
+
+def document_page_texts(document):
+    """Split a processed document's text into one string per page using the page layout anchors."""
+    page_texts = []
+    for page in document.pages:
+        segments = page.layout.text_anchor.text_segments
+        page_texts.append(''.join(document.text[int(segment.start_index):int(segment.end_index)] for segment in segments))
+    return page_texts
+
+def merge_page_texts(page_texts):
+    return "\n".join(text.strip('\n') for text in page_texts if text and text.strip())
+
+def open_pdf(stream):
+    # Given a path, PdfReader reads the whole file into memory; given an open file it seeks
+    # and reads objects lazily, so the caller keeps the stream open while the reader is in use.
+    try:
+        reader = PdfReader(stream)
+        page_count = len(reader.pages)
+    except Exception as e:
+        raise ValueError(f"Could not read PDF: {str(e)}")
+    if page_count > MAX_PDF_PAGES:
+        raise ValueError(f"PDF exceeds the page limit of {MAX_PDF_PAGES} pages.")
+    return reader
+
+def split_pages(pages, size):
+    return [pages[start:start + size] for start in range(0, len(pages), size)]
+
+def render_pdf_shards(reader, pages):
+    """
+    Write the given pages as standalone PDFs of at most PDF_SHARD_MAX_BYTES, halving the page
+    list until each piece fits. Returns (pages, content) tuples in page order. A PdfReader is not
+    safe to share between threads, so callers render one shard at a time from the document's reader.
+    """
+    pieces = []
+    pending = [pages]
+    while pending:
+        piece = pending.pop()
+        writer = PdfWriter()
+        for index in piece:
+            writer.add_page(reader.pages[index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        content = buffer.getvalue()
+        if len(content) <= PDF_SHARD_MAX_BYTES:
+            pieces.append((piece, content))
+        elif len(piece) > 1:
+            middle = len(piece) // 2
+            pending.extend([piece[middle:], piece[:middle]])
+        else:
+            raise ValueError(f"Page {piece[0] + 1} exceeds the online processing limit of {PDF_SHARD_MAX_BYTES // (1024 * 1024)} MB.")
+    return pieces
+
+def shard_cache_key(content):
+    return extraction_cache_key(hashlib.sha256(content).hexdigest(), 'shard')
+
+def ocr_pdf_shard(content):
+    shard_key = shard_cache_key(content)
+    cached = extraction_cache.get_json(shard_key)
+    if cached is None:
+        document = process_document_content(content, DOCUMENT_AI_MIME_TYPES['pdf'])
+        cached = {'pages': document_page_texts(document)}
+        extraction_cache.set_json(shard_key, cached)
+    return cached['pages']
+
+def gather_shard_results(futures, timeout):
+    # Wait for every shard before raising, so the ones that succeeded are cached for a retry. Shards
+    # still queued or running after timeout seconds are cancelled.
+    _, not_done = wait_futures(futures, timeout=timeout)
+    if not_done:
+        cancel_futures(not_done)
+        raise TimeoutError(f"OCR did not finish within {timeout} seconds")
+    results, errors = [], []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+def ocr_pdf(reader, pages):
+    """
+    OCR any number of PDF pages by splitting them into shards that fit the online limits and
+    processing them concurrently on ocr_shard_executor. Shards are rendered here, from the
+    document's one reader, and at most PDF_SHARD_MAX_WORKERS wait in memory for OCR at a time.
+    Each shard's page texts are cached by the shard's content hash, so a retry only repeats the
+    shards that failed. Returns one text per page.
+    """
+    shards = split_pages(pages, PDF_SHARD_MAX_PAGES)
+    timeout = shard_timeout(len(shards))
+    extend_task_deadline(timeout)
+    started_at = time.monotonic()
+    futures = []
+    in_flight = set()
+    for shard in shards:
+        for _, content in render_pdf_shards(reader, shard):
+            if task_deadline_passed():
+                # map_bounded has already given up on this file; stop sending shards for it.
+                cancel_futures(futures)
+                raise TimeoutError("Analysis timed out before OCR finished")
+            if len(in_flight) >= PDF_SHARD_MAX_WORKERS:
+                _, in_flight = wait_futures(
+                    in_flight, timeout=max(0, started_at + timeout - time.monotonic()), return_when=FIRST_COMPLETED
+                )
+                if len(in_flight) >= PDF_SHARD_MAX_WORKERS:
+                    cancel_futures(futures)
+                    raise TimeoutError(f"OCR did not finish within {timeout} seconds")
+            future = ocr_shard_executor.submit(ocr_pdf_shard, content)
+            in_flight.add(future)
+            futures.append(future)
+    remaining = max(0, started_at + timeout - time.monotonic())
+    return [text for shard_texts in gather_shard_results(futures, remaining) for text in shard_texts]
+
+def read_pdf_text_layer(file_path, page_count):
+    """
+    Extract each page's embedded text in the local extraction pool. Returns one entry per page,
+    None where the page has to be OCR'd. If the pool fails, every page falls back to OCR.
+    """
+    if not PDF_TEXT_LAYER_ENABLED or not page_count:
+        return [None] * page_count
+    try:
+        pool = get_local_extraction_pool()
+        futures = [
+            pool.submit(extract_pdf_text_layer, file_path, batch, PDF_TEXT_LAYER_MIN_CHARS, PDF_TEXT_LAYER_MAX_SUSPECT_RATIO)
+            for batch in split_pages(list(range(page_count)), PDF_TEXT_LAYER_PAGES_PER_TASK)
+        ]
+        return [text for future in futures for text in future.result()]
+    except Exception as e:
+        logger.error(f"PDF text layer extraction failed, falling back to OCR: {str(e)}")
+        return [None] * page_count
+
+def fill_ocr_pages(page_texts, ocr_pages, ocr_texts):
+    for index, text in zip(ocr_pages, ocr_texts):
+        page_texts[index] = text
+    logger.info(f"PDF extraction: {len(page_texts) - len(ocr_pages)} pages from the text layer, {len(ocr_pages)} OCR'd")
+    return merge_page_texts(page_texts)
+
+def extract_pdf_text(file_path):
+    with open(file_path, 'rb') as stream:
+        reader = open_pdf(stream)
+        page_count = len(reader.pages)
+        page_texts = read_pdf_text_layer(file_path, page_count)
+        ocr_pages = [index for index, text in enumerate(page_texts) if text is None]
+        return fill_ocr_pages(page_texts, ocr_pages, ocr_pdf(reader, ocr_pages) if ocr_pages else [])
+
+DOCUMENT_AI_MIME_TYPES = {
+    'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png',
+    'bmp': 'image/bmp', 'tiff': 'image/tiff', 'tif': 'image/tiff',
+    'gif': 'image/gif', 'pdf': 'application/pdf',
+}
+
+def prepare_image_pages(file_path):
+    """
+    Preprocess an image upload in the local extraction pool. Returns (content, mime_type) pages,
+    or None when the file should be sent unchanged: preprocessing is disabled, would not shrink
+    it, or the pool failed.
+    """
+    if not IMAGE_PREPROCESSING_ENABLED:
+        return None
+    try:
+        return get_local_extraction_pool().submit(
+            preprocess_image, file_path, IMAGE_OCR_TARGET_DPI, IMAGE_OCR_MAX_EDGE, MAX_IMAGE_RESOLUTION,
+            IMAGE_OCR_JPEG_QUALITY, IMAGE_OCR_MAX_FRAMES
+        ).result()
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Image preprocessing failed, sending the original: {str(e)}")
+        return None
+
+def ocr_image_page(content, mime_type):
+    page_key = shard_cache_key(content)
+    cached = extraction_cache.get_json(page_key)
+    if cached is None:
+        document = process_document_content(content, mime_type)
+        cached = {'pages': [format_extracted_text(document)]}
+        extraction_cache.set_json(page_key, cached)
+    return cached['pages'][0]
+
+def extract_image_text(file_path, mime_type):
+    pages = prepare_image_pages(file_path)
+    if pages is None:
+        document = process_document(file_path, mime_type)
+        return format_extracted_text(document) if document else None
+    timeout = shard_timeout(len(pages))
+    extend_task_deadline(timeout)
+    futures = [ocr_shard_executor.submit(ocr_image_page, content, page_mime_type) for content, page_mime_type in pages]
+    return merge_page_texts(gather_shard_results(futures, timeout))
+
+def extract_text_from_file(file_path, file_extension):
+    try:
+        if file_extension == 'pdf':
+            return extract_pdf_text(file_path)
+        elif file_extension in DOCUMENT_AI_MIME_TYPES:
+            return extract_image_text(file_path, DOCUMENT_AI_MIME_TYPES[file_extension])
+        elif file_extension == 'docx':
+            doc = docx.Document(file_path)
+            return "\n".join([paragraph.text for paragraph in doc.paragraphs if paragraph.text.strip()])
+        elif file_extension == 'txt':
+            with open(file_path, encoding='utf-8') as f:
+                return f.read()
+        else:
+            raise ValueError("Unsupported file type. Supported types are: jpg, png, pdf, docx, txt.")
+    except ValueError as ve:
+        logger.error(f"Text extraction error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error extracting text from file: {str(e)}")
+        raise
+
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+
+def build_gemini_model(structured=False):
+    generation_config = None
+    if structured:
+        generation_config = {
+            'response_mime_type': 'application/json',
+            'response_schema': COMBINED_ANALYSIS_SCHEMA,
+        }
+    return genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=generation_config)
+
+def get_gemini_model(structured=False):
+    """
+    Return a process-wide GenerativeModel. The structured variant is configured for
+    JSON output following COMBINED_ANALYSIS_SCHEMA.
+    """
+    with _gemini_models_lock:
+        model = _gemini_models.get(structured)
+        if model is None:
+            model = build_gemini_model(structured)
+            _gemini_models[structured] = model
+        return model
+
+def get_gemini_response(prompt, document_text):
+    try:
+        model = get_gemini_model()
+        content = [document_text, prompt]
+        with gemini_semaphore:
+            response = model.generate_content(content)
+        if not response.text:
+            raise ValueError("Gemini API returned an empty response.")
+        return response.text
+    except ValueError as ve:
+        logger.error(f"Gemini error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error with Gemini API: {str(e)}")
+        raise
+
+def parse_combined_analysis(response_text):
+    try:
+        analysis = json.loads(response_text)
+    except ValueError:
+        raise ValueError("Gemini API returned invalid JSON for the combined analysis.")
+    if not isinstance(analysis, dict):
+        raise ValueError("Gemini API returned an unexpected combined analysis payload.")
+    emotion = str(analysis.get('emotion') or '').strip().lower()
+    return {
+        'text': str(analysis.get('cleaned_text') or '').strip(),
+        'emotion': emotion or "No clear emotion detected",
+        'gender': normalize_detected_gender(str(analysis.get('gender') or '')),
+    }
+
+def analyze_text_combined(document_text):
+    """
+    Extraction, filtering, emotion and gender detection in one structured-output call. The
+    document is sent once, as content, rather than also being embedded in the prompt.
+    """
+    try:
+        model = get_gemini_model(structured=True)
+        with gemini_semaphore:
+            response = model.generate_content([document_text, COMBINED_ANALYSIS_PROMPT])
+        if not response.text:
+            raise ValueError("Gemini API returned an empty response.")
+        return parse_combined_analysis(response.text)
+    except ValueError as ve:
+        logger.error(f"Gemini combined analysis error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error with Gemini API: {str(e)}")
+        raise
+
+def weighted_vote(votes, default):
+    totals = {}
+    for label, weight in votes:
+        if label:
+            totals[label] = totals.get(label, 0) + weight
+    if not totals:
+        return default
+    return max(totals, key=totals.get)
+
+def build_filter_prompt(text):
+    return f"""
+    Analyze the following text and remove any vulgar, abusive, or unethical words or phrases in Urdu or any other language.
+    Return only the cleaned text without any explanations or markers, preserving the original meaning as much as possible.
+    If no unethical content is found, return the text as is.
+    Text: "{text}"
+    """
+
+def build_sentence_filter_prompt(sentence_count):
+    return f"""
+    Each numbered line of the text is a separate sentence that may contain vulgar, abusive, or unethical words or phrases in Urdu or any other language.
+    Remove them from each sentence, preserving the original meaning as much as possible, and leave clean sentences unchanged.
+    Return exactly {sentence_count} lines in the same order, each starting with its number followed by a period, without any explanations.
+    """
+
+def number_sentences(sentences):
+    return "\n".join(f"{index}. {sentence}" for index, sentence in enumerate(sentences, 1))
+
+def splice_filtered_sentences(text, spans, response):
+    """Put the model's cleaned sentences back in place of the flagged spans, or None if the reply does not line up."""
+    cleaned = {}
+    for line in (response or '').splitlines():
+        match = NUMBERED_LINE_PATTERN.match(line)
+        if match:
+            cleaned[int(match.group(1))] = match.group(2).strip()
+    if set(cleaned) != set(range(1, len(spans) + 1)):
+        return None
+    parts = []
+    position = 0
+    for index, (start, end) in enumerate(spans, 1):
+        parts.append(text[position:start])
+        parts.append(cleaned[index])
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+def filter_flagged_sentences(text, spans):
+    sentences = [text[start:end] for start, end in spans]
+    response = get_gemini_response(build_sentence_filter_prompt(len(sentences)), number_sentences(sentences))
+    return splice_filtered_sentences(text, spans, response)
+
+def filter_unethical_text_with_prompt(text):
+    """
+    Clean a text of abusive content. When the local blocklist is loaded, only the sentences it flags
+    are sent to Gemini, and clean text is returned without a model call.
+    """
+    try:
+        spans = flag_profane_sentences(text)
+        if spans == []:
+            return text
+        if spans:
+            cleaned_text = filter_flagged_sentences(text, spans)
+            if cleaned_text is not None:
+                return cleaned_text.strip()
+            logger.warning("Sentence filter reply did not match the flagged sentences; filtering the whole text")
+        cleaned_text = get_gemini_response(build_filter_prompt(text), text)
+        return cleaned_text.strip() if cleaned_text else text
+    except Exception as e:
+        logger.error(f"Failed to filter unethical text: {str(e)}")
+        raise
+
+def build_emotion_prompt(text):
+    emotion_list = list(EMOTION_MAPPING.keys())
+    return f"""
+    Analyze the following text and identify the single most prominent emotion from this list: {', '.join(emotion_list)}.
+    The text may be in Urdu, English, or a mix of both or any other language. Provide only the most dominant emotion as a single word or phrase.
+    Text: "{text}"
+    """
+
+def detect_emotions_with_ai(text):
+    prompt = build_emotion_prompt(text)
+    try:
+        response = get_gemini_response(prompt, text)
+        return response.strip() if response else "No clear emotion detected"
+    except Exception as e:
+        logger.error(f"Failed to detect emotion: {str(e)}")
+        raise
+
+def build_gender_prompt(text):
+    return f"""
+    Analyze the following Urdu text and determine the gender of the subject (male, female, or unknown).
+    Look for gender-specific indicators such as pronouns (e.g., "وہ" with context), verb conjugations (e.g., "گیا" for male, "گئی" for female),
+    or nouns (e.g., "لڑکا" for male, "لڑکی" for female). Return only the detected gender as "male", "female", or "unknown".
+    Text: "{text}"
+    """
+
+def normalize_detected_gender(response):
+    gender = response.strip().lower()
+    if gender not in ["male", "female", "unknown"]:
+        return "unknown"
+    return gender
+
+def detect_gender_with_ai(text):
+    prompt = build_gender_prompt(text)
+    try:
+        response = get_gemini_response(prompt, text)
+        return normalize_detected_gender(response)
+    except Exception as e:
+        logger.error(f"Failed to detect gender: {str(e)}")
+        raise
+
+def get_available_voices():
+    try:
+        client = google_clients.get_client('texttospeech')
+        voices = client.list_voices().voices
+        language_voices = {}
+        for voice in voices:
+            for language_code in voice.language_codes:
+                if (language_code not in language_voices):
+                    language_voices[language_code] = []
+                language_voices[language_code].append({
+                    'name': voice.name,
+                    'gender': texttospeech.SsmlVoiceGender(voice.ssml_gender).name,
+                    'language_code': language_code
+                })
+        sorted_languages = sorted(language_voices.keys())
+        result = []
+        for lang in sorted_languages:
+            result.append({
+                'language_code': lang,
+                'voices': sorted(language_voices[lang], key=lambda x: (x['gender'], x['name']))
+            })
+        result.append({
+            'language_code': GPT4O_VOICE_LANGUAGE,
+            'voices': [
+                {'name': name, 'gender': 'NEUTRAL', 'language_code': GPT4O_VOICE_LANGUAGE}
+                for name in GPT4O_VOICES
+            ]
+        })
+        return result
+    except FileNotFoundError as e:
+        logger.error(f"Voice fetch error: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching available voices: {str(e)}")
+        raise
+
+class VoiceCatalog:
+    """
+    Voice list fetched once from Text-to-Speech (with the GPT-4o mini voices merged in) and
+    served as pre-serialized JSON. Each language_code/gender filter is serialized and
+    ETag-ed on first use; a background timer refetches the list and drops the cached views.
+    """
+
+    def __init__(self, loader, refresh_seconds, max_views):
+        self.loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.max_views = max_views
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._groups = None
+        self._views = {}
+        self._loaded_at = None
+        self._refresh_timer = None
+
+    def _load(self):
+        groups = self.loader()
+        with self._lock:
+            self._groups = groups
+            self._views = {}
+            self._loaded_at = time.time()
+        logger.info(f"Voice catalog loaded: {sum(len(group['voices']) for group in groups)} voices")
+
+    def _schedule_refresh(self):
+        if self.refresh_seconds <= 0:
+            return
+        timer = threading.Timer(self.refresh_seconds, self._refresh)
+        timer.daemon = True
+        timer.start()
+        self._refresh_timer = timer
+
+    def _refresh(self):
+        try:
+            self._load()
+        except Exception as e:
+            logger.error(f"Voice catalog refresh failed, keeping previous catalog: {str(e)}")
+        finally:
+            self._schedule_refresh()
+
+    def _get_groups(self):
+        if self._groups is None:
+            with self._load_lock:
+                if self._groups is None:
+                    self._load()
+                    self._schedule_refresh()
+        return self._groups
+
+    def get_view(self, language_code=None, gender=None):
+        """Return (body, etag) for the catalog filtered by language_code and gender."""
+        key = ((language_code or '').strip().lower(), (gender or '').strip().upper())
+        with self._lock:
+            cached = self._views.get(key)
+        if cached:
+            return cached
+        groups = self._get_groups()
+        filtered = []
+        for group in groups:
+            if key[0] and group['language_code'].lower() != key[0]:
+                continue
+            voices = [voice for voice in group['voices'] if not key[1] or voice['gender'] == key[1]]
+            if voices:
+                filtered.append({'language_code': group['language_code'], 'voices': voices})
+        body = json.dumps({'voices': filtered}).encode('utf-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        with self._lock:
+            if len(self._views) >= self.max_views:
+                self._views.clear()
+            self._views[key] = (body, etag)
+        return body, etag
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': self._groups is not None,
+                'loaded_at': self._loaded_at,
+                'cached_views': len(self._views),
+            }
+
+voice_catalog = VoiceCatalog(get_available_voices, VOICE_CATALOG_REFRESH_SECONDS, VOICE_CATALOG_MAX_VIEWS)
+
+def etag_matches(request, etag):
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(',')]
+    return '*' in candidates or any(candidate.removeprefix('W/') == etag for candidate in candidates)
+
+class UpstreamUnavailableError(RequestException):
+    """Raised without contacting the upstream while its circuit breaker is open."""
+
+class UpstreamClient:
+    """
+    Pooled HTTP client for one upstream service. Connections are kept alive in a shared
+    requests.Session; connection errors and retryable statuses are retried with jittered
+    exponential backoff; after repeated failures a circuit breaker fails calls fast until
+    reset_timeout has passed, then lets a single trial request through (half-open) and closes
+    again only if it succeeds. Each endpoint (scheme, host and path, or just the host with
+    circuit_per_host) has its own circuit, so one failing endpoint does not block the others.
+
+    Non-idempotent requests (POST) may already have been acted on when a read times out or a 5xx
+    comes back, so they are only retried when the connection was never made or the upstream
+    explicitly asked to be retried.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    NON_IDEMPOTENT_RETRY_STATUSES = {429, 503}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, name, max_retries=2, backoff_base=0.5, backoff_max=8.0,
+                 failure_threshold=UPSTREAM_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=UPSTREAM_CIRCUIT_RESET_TIMEOUT,
+                 pool_size=UPSTREAM_POOL_SIZE, circuit_per_host=False):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.circuit_per_host = circuit_per_host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._circuits = {}
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0}
+
+    def _circuit(self, url):
+        # Called with self._lock held.
+        parts = urlsplit(url)
+        endpoint = f"{parts.scheme}://{parts.netloc}" + ('' if self.circuit_per_host else parts.path)
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = {
+                'endpoint': endpoint, 'consecutive_failures': 0, 'opened_at': None, 'half_open': False,
+            }
+        return circuit
+
+    def _check_circuit(self, url):
+        with self._lock:
+            circuit = self._circuit(url)
+            if circuit['opened_at'] is None:
+                return
+            now = time.monotonic()
+            if now - circuit['opened_at'] >= self.reset_timeout:
+                # Half-open: this request is the trial. Restarting the clock keeps every other caller
+                # failing fast until it reports back, or until another reset_timeout if it never does.
+                circuit['opened_at'] = now
+                circuit['half_open'] = True
+                return
+            self._stats['short_circuited'] += 1
+        raise UpstreamUnavailableError(f"{self.name} is unavailable after repeated failures; retry in a few seconds.")
+
+    def _record_success(self, url):
+        with self._lock:
+            circuit = self._circuit(url)
+            if circuit['opened_at'] is not None:
+                logger.info(f"Closing circuit for upstream {self.name} at {circuit['endpoint']}")
+            circuit['consecutive_failures'] = 0
+            circuit['opened_at'] = None
+            circuit['half_open'] = False
+
+    def _record_failure(self, url):
+        with self._lock:
+            circuit = self._circuit(url)
+            self._stats['failures'] += 1
+            circuit['consecutive_failures'] += 1
+            if circuit['half_open'] or circuit['consecutive_failures'] >= self.failure_threshold:
+                if circuit['opened_at'] is None:
+                    logger.warning(f"Opening circuit for upstream {self.name} at {circuit['endpoint']}")
+                circuit['opened_at'] = time.monotonic()
+                circuit['half_open'] = False
+
+    def _backoff_delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = min(self.backoff_max, float(retry_after))
+        with self._lock:
+            self._stats['retries'] += 1
+        return delay
+
+    @staticmethod
+    def _is_connect_error(error):
+        # httpx raises these before the request is written, so like a requests connect failure
+        # they are safe to retry for any method.
+        if isinstance(error, (ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, RequestsConnectionError) and isinstance(reason, NewConnectionError)
+
+    def _retry_policy(self, method, max_retries):
+        attempts = (self.max_retries if max_retries is None else max_retries) + 1
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        return attempts, idempotent, self.RETRY_STATUSES if idempotent else self.NON_IDEMPOTENT_RETRY_STATUSES
+
+    def _start_attempt(self, url):
+        self._check_circuit(url)
+        with self._lock:
+            self._stats['requests'] += 1
+
+    def _should_retry_error(self, url, error, retries_left, idempotent):
+        self._record_failure(url)
+        if not retries_left or not (idempotent or self._is_connect_error(error)):
+            return False
+        logger.warning(f"{self.name} request failed ({str(error)}), retrying")
+        return True
+
+    def _should_retry_response(self, url, response, retries_left, retry_statuses):
+        if response.status_code not in self.RETRY_STATUSES:
+            self._record_success(url)
+            return False
+        self._record_failure(url)
+        if not retries_left or response.status_code not in retry_statuses:
+            return False
+        logger.warning(f"{self.name} returned {response.status_code}, retrying")
+        return True
+
+    def request(self, method, url, max_retries=None, **kwargs):
+        attempts, idempotent, retry_statuses = self._retry_policy(method, max_retries)
+        for attempt in range(attempts):
+            retries_left = attempt + 1 < attempts
+            self._start_attempt(url)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except RequestException as e:
+                if not self._should_retry_error(url, e, retries_left, idempotent):
+                    raise
+                time.sleep(self._backoff_delay(attempt))
+                continue
+            if not self._should_retry_response(url, response, retries_left, retry_statuses):
+                return response
+            response.close()
+            time.sleep(self._backoff_delay(attempt, response))
+
+    async def async_request(self, method, url, max_retries=None, limit=None, **kwargs):
+        """
+        request() on the event loop's shared httpx client, with the same circuit and retry policy.
+        limit is an optional asyncio semaphore held while each attempt is in flight, not while backing off.
+        """
+        attempts, idempotent, retry_statuses = self._retry_policy(method, max_retries)
+        for attempt in range(attempts):
+            retries_left = attempt + 1 < attempts
+            self._start_attempt(url)
+            try:
+                if limit is None:
+                    response = await get_async_http_client().request(method, url, **kwargs)
+                else:
+                    async with limit:
+                        response = await get_async_http_client().request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                if not self._should_retry_error(url, e, retries_left, idempotent):
+                    raise
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+            if not self._should_retry_response(url, response, retries_left, retry_statuses):
+                return response
+            await response.aclose()
+            await asyncio.sleep(self._backoff_delay(attempt, response))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            circuits = {
+                endpoint: {
+                    'open': circuit['opened_at'] is not None,
+                    'half_open': circuit['half_open'],
+                    'consecutive_failures': circuit['consecutive_failures'],
+                }
+                for endpoint, circuit in self._circuits.items()
+            }
+            return dict(self._stats, circuits=circuits)
+
+class NegotiationCache:
+    """
+    Remembers which request variant last worked for an upstream so later calls try it first.
+    A winner expires after ttl_seconds and is dropped after max_failures consecutive failures.
+    """
+
+    def __init__(self, ttl_seconds, max_failures):
+        self.ttl_seconds = ttl_seconds
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._winners = {}
+
+    def get(self, name):
+        with self._lock:
+            entry = self._winners.get(name)
+            if entry is None:
+                return None
+            if time.monotonic() - entry['learned_at'] > self.ttl_seconds:
+                del self._winners[name]
+                return None
+            return entry['variant']
+
+    def order(self, name, attempts):
+        winner = self.get(name)
+        if winner is None:
+            return list(attempts)
+        return sorted(attempts, key=lambda attempt: attempt[0] != winner)
+
+    def record_success(self, name, variant):
+        with self._lock:
+            entry = self._winners.get(name)
+            if entry is None or entry['variant'] != variant:
+                logger.info(f"Learned {name} request variant {variant}")
+                self._winners[name] = {'variant': variant, 'learned_at': time.monotonic(), 'failures': 0}
+            else:
+                entry['failures'] = 0
+
+    def record_failure(self, name, variant):
+        with self._lock:
+            entry = self._winners.get(name)
+            if entry is None or entry['variant'] != variant:
+                return
+            entry['failures'] += 1
+            if entry['failures'] >= self.max_failures:
+                logger.info(f"Demoting {name} request variant {variant} after {entry['failures']} failures")
+                del self._winners[name]
+
+    def stats(self):
+        with self._lock:
+            return {name: {'variant': list(entry['variant']), 'failures': entry['failures']} for name, entry in self._winners.items()}
+
+# Loudly generation is not idempotent, so only one retry; like OpenAI speech it is a POST and is only
+# retried when it cannot have reached the upstream. File downloads are safe to repeat.
+loudly_client = UpstreamClient('loudly', max_retries=1)
+openai_client = UpstreamClient('openai', max_retries=2)
+# Tracks are downloaded from many URLs on a few hosts, so the download circuits are per host.
+music_download_client = UpstreamClient('music-download', max_retries=2, circuit_per_host=True)
+UPSTREAM_CLIENTS = [loudly_client, openai_client, music_download_client]
+upstream_negotiation = NegotiationCache(LOUDLY_NEGOTIATION_TTL, LOUDLY_NEGOTIATION_MAX_FAILURES)
+
+LOUDLY_ENDPOINTS = [
+    "https://soundtracks-dev.loudly.com/api/ai/prompt/songs",
+    "https://soundtracks.loudly.com/b2b/ai/prompt/songs"
+]
+
+LOUDLY_FORM_HEADERS = {
+    "API-KEY": LOUDLY_API_KEY,
+    "Accept": "application/json",
+    "User-Agent": "AI-titude/1.0",
+    "Cache-Control": "no-cache"
+}
+
+LOUDLY_JSON_HEADERS = dict(LOUDLY_FORM_HEADERS, **{"Content-Type": "application/json"})
+
+def loudly_payload_variations(prompt, duration):
+    # Loudly has accepted each of these shapes at some point; they are tried in order.
+    return [
+        {"prompt": prompt, "duration": duration},
+        {"Prompt": prompt, "duration": duration},
+        {"data": {"prompt": prompt, "duration": duration}}
+    ]
+
+class MusicAssetError(Exception):
+    def __init__(self, status_code, message, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.details = details
+
+class MusicAssetStore:
+    """
+    Background music tracks, downloaded once per URL and decoded to interleaved int16 PCM at
+    MIX_SAMPLE_RATE/MIX_CHANNELS in an on-disk LRU cache. open() hands out a read-only memory map,
+    so mixing starts without a download or an MP3 decode. Concurrent loads of one URL share a
+    single download.
+    """
+
+    def __init__(self, cache, max_workers):
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='music-store')
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def key(self, url):
+        material = f"music:{url}:{MIX_SAMPLE_RATE}:{MIX_CHANNELS}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _download(self, url):
+        response = music_download_client.get(url, timeout=30)
+        if response.status_code != 200:
+            raise MusicAssetError(400, "Failed to download music file", f"Status: {response.status_code}")
+        try:
+            track = AudioSegment.from_file(io.BytesIO(response.content))
+        except Exception as e:
+            raise MusicAssetError(500, "Failed to process music file", str(e))
+        pcm = track.set_frame_rate(MIX_SAMPLE_RATE).set_channels(MIX_CHANNELS).set_sample_width(2).raw_data
+        if not pcm:
+            raise MusicAssetError(400, "Failed to process music file", "Music file contains no audio")
+        logger.info(f"Decoded music track {url}: {len(pcm)} bytes of PCM")
+        return pcm
+
+    def _materialize(self, url, key):
+        try:
+            path = self.cache.get_path(key)
+            if path:
+                return path
+            pcm = self._download(url)
+            self.cache.set(key, pcm)
+            # Tracks the cache cannot hold are still returned, just not kept.
+            return self.cache.get_path(key) or pcm
+        except Exception as e:
+            logger.error(f"Failed to load music track {url}: {str(e)}")
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _submit(self, url, key):
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self._materialize, url, key)
+                self._pending[key] = future
+        return future
+
+    def prefetch(self, url):
+        """Start downloading and decoding a track in the background."""
+        if url and url.startswith(('http://', 'https://')):
+            self._submit(url, self.key(url))
+
+    def open(self, url):
+        """Return the track as a read-only mmap of int16 PCM frames. The caller closes it."""
+        key = self.key(url)
+        for _ in range(2):
+            result = self.cache.get_path(key) or self._submit(url, key).result()
+            if isinstance(result, bytes):
+                buffer = mmap.mmap(-1, len(result))
+                buffer.write(result)
+                buffer.seek(0)
+                return buffer
+            try:
+                with open(result, 'rb') as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                # Evicted between lookup and open; load it again.
+                continue
+        raise MusicAssetError(500, "Failed to process music file", "Music track was evicted while loading")
+
+music_store = MusicAssetStore(music_cache, MUSIC_STORE_MAX_WORKERS)
+
+class MusicGenerationError(Exception):
+    def __init__(self, status_code, message, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.details = details
+
+def parse_loudly_music_response(response):
+    try:
+        response_data = response.json()
+    except ValueError:
+        logger.error("Invalid JSON response from Loudly API")
+        raise MusicGenerationError(500, "Invalid JSON response from Loudly API")
+    if not response_data.get("music_file_path"):
+        logger.error("Loudly API response missing music_file_path")
+        raise MusicGenerationError(500, "Invalid response from Loudly API", "Missing music_file_path")
+    logger.info(f"Music generated successfully: {response_data}")
+    return response_data
+
+def loudly_error(response, attempt):
+    try:
+        error_data = response.json()
+        logger.error(f"Loudly API error at {attempt}: {error_data}")
+        return MusicGenerationError(response.status_code, "Failed to generate music", error_data.get("error", response.text))
+    except ValueError:
+        logger.error(f"Loudly API error at {attempt}: status={response.status_code}, text={response.text}")
+        return MusicGenerationError(response.status_code, "Failed to generate music", response.text)
+
+def parse_music_request(body):
+    prompt = body.get("prompt")
+    duration = body.get("duration", 90)  # Default to 90 seconds
+    logger.debug(f"Incoming request: prompt={prompt}, duration={duration}")
+
+    # Validate inputs
+    if prompt is None:
+        return None, None, create_error_response(400, "Prompt is missing", "The 'prompt' field is required in the request body")
+    if not isinstance(prompt, str):
+        return None, None, create_error_response(400, "Invalid prompt type", "Prompt must be a string")
+    prompt = prompt.strip()
+    if not prompt:
+        return None, None, create_error_response(400, "Prompt is empty", "Please provide a valid music prompt")
+    if len(prompt) < 5:
+        return None, None, create_error_response(400, "Prompt is too short", "Minimum length is 5 characters")
+    if not isinstance(duration, int) or not (30 <= duration <= 420):
+        return None, None, create_error_response(400, "Invalid duration", "Duration must be an integer between 30 and 420 seconds")
+    return prompt, duration, None
+
+def loudly_attempts(prompt, duration):
+    """
+    Every (endpoint, payload shape) combination Loudly may accept, as ((endpoint, variant), request kwargs)
+    pairs in the default order: JSON payloads per endpoint, then form data as a last resort.
+    """
+    attempts = []
+    for endpoint in LOUDLY_ENDPOINTS:
+        for index, payload in enumerate(loudly_payload_variations(prompt, duration)):
+            attempts.append(((endpoint, f"json-{index}"), {'headers': LOUDLY_JSON_HEADERS, 'json': payload}))
+    form_data = {"prompt": prompt, "duration": str(duration)}
+    attempts.append(((LOUDLY_ENDPOINTS[0], 'form'), {'headers': LOUDLY_FORM_HEADERS, 'data': form_data}))
+    return attempts
+
+class LoudlyNegotiation:
+    """
+    The attempt sequence for one Loudly generation, shared by the sync and async views so only the
+    transport differs. The endpoint/payload combination that worked last is tried first; otherwise
+    combinations are tried in order, moving on after a 400 and skipping the rest of an endpoint
+    after any other error.
+    """
+
+    def __init__(self, prompt, duration):
+        if not LOUDLY_API_KEY:
+            raise MusicGenerationError(500, "Loudly API key is not configured")
+        self.attempts = upstream_negotiation.order('loudly', loudly_attempts(prompt, duration))
+        self.failed_endpoints = set()
+        self.last_error = None
+
+    def __iter__(self):
+        """Yield (variant, request kwargs) for each attempt still worth making."""
+        for variant, request_kwargs in self.attempts:
+            if variant[0] in self.failed_endpoints:
+                continue
+            logger.debug(f"Attempting Loudly API: URL={variant[0]}, variant={variant[1]}")
+            yield variant, dict(request_kwargs, timeout=30)
+
+    def network_error(self, variant, error):
+        logger.error(f"Network error calling Loudly API at {variant[0]}: {str(error)}")
+        upstream_negotiation.record_failure('loudly', variant)
+        self.failed_endpoints.add(variant[0])
+        self.last_error = MusicGenerationError(500, "Network error", str(error))
+
+    def response(self, variant, response):
+        """Return the Loudly response data on success, or None to move on to the next attempt."""
+        logger.debug(f"Loudly API response: status={response.status_code}, text={response.text}")
+        if response.status_code == 200:
+            response_data = parse_loudly_music_response(response)
+            upstream_negotiation.record_success('loudly', variant)
+            music_store.prefetch(response_data['music_file_path'])
+            return response_data
+
+        upstream_negotiation.record_failure('loudly', variant)
+        self.last_error = loudly_error(response, variant[0])
+        if response.status_code != 400:
+            # If not a 400 error, stop trying this endpoint
+            self.failed_endpoints.add(variant[0])
+        return None
+
+    def error(self):
+        if self.last_error is not None:
+            return self.last_error
+        return MusicGenerationError(400, "Failed to generate music", "All attempts to contact Loudly API failed. Please check API configuration.")
+
+def request_loudly_music(prompt, duration):
+    """Generate music with the Loudly API. Returns the Loudly response data or raises MusicGenerationError."""
+    negotiation = LoudlyNegotiation(prompt, duration)
+    for variant, request_kwargs in negotiation:
+        try:
+            response = loudly_client.post(variant[0], **request_kwargs)
+        except RequestException as e:
+            negotiation.network_error(variant, e)
+            continue
+        response_data = negotiation.response(variant, response)
+        if response_data is not None:
+            return response_data
+    raise negotiation.error()
+
+@csrf_exempt
+def generate_music_with_prompt(request):
+    """
+    Generate music based on a user-provided prompt and duration using the Loudly API.
+    """
+    if request.method != "POST":
+        return create_error_response(405, "Only POST requests allowed")
+
+    try:
+        # Parse request body
+        body_unicode = request.body.decode("utf-8")
+        body = json.loads(body_unicode)
+        prompt, duration, error_response = parse_music_request(body)
+        if error_response:
+            return error_response
+
+        response_data = request_loudly_music(prompt, duration)
+        return JsonResponse(response_data, status=200)
+
+    except MusicGenerationError as e:
+        return create_error_response(e.status_code, e.message, e.details)
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except Exception as e:
+        logger.error(f"Unexpected error in generate_music_with_prompt: {str(e)}", exc_info=True)
+        return create_error_response(500, "An unexpected error occurred", str(e))
+
+music_job_executor = ThreadPoolExecutor(max_workers=MUSIC_JOB_MAX_WORKERS, thread_name_prefix='music-job')
+_active_music_jobs = set()
+_music_job_lock = threading.Lock()
+_music_job_finished = threading.Condition()
+
+def music_job_dedupe_key(prompt, duration):
+    return hashlib.sha256(f"{prompt}\x00{duration}".encode('utf-8')).hexdigest()
+
+def find_reusable_music_job(dedupe_key):
+    fresh_after = timezone.now() - datetime.timedelta(seconds=MUSIC_JOB_RESULT_TTL)
+    return MusicJob.objects.filter(dedupe_key=dedupe_key).filter(
+        Q(status__in=[MusicJob.STATUS_PENDING, MusicJob.STATUS_RUNNING]) |
+        Q(status=MusicJob.STATUS_SUCCEEDED, updated_at__gte=fresh_after)
+    ).order_by('-created_at').first()
+
+def enqueue_music_job(job_id):
+    with _music_job_lock:
+        if str(job_id) in _active_music_jobs:
+            return
+        _active_music_jobs.add(str(job_id))
+    music_job_executor.submit(run_music_job, job_id)
+
+def run_music_job(job_id):
+    try:
+        jobs = MusicJob.objects.filter(id=job_id)
+        # Claim the job in the database; another process may have queued the same job.
+        claimed = jobs.filter(status=MusicJob.STATUS_PENDING).update(
+            status=MusicJob.STATUS_RUNNING, attempts=F('attempts') + 1, updated_at=timezone.now())
+        if not claimed:
+            logger.debug(f"Music job {job_id} is no longer pending, not running it")
+            return
+        job = jobs.get()
+        try:
+            result = request_loudly_music(job.prompt, job.duration)
+        except MusicGenerationError as e:
+            jobs.update(status=MusicJob.STATUS_FAILED, error=e.message, error_details=str(e.details or ''),
+                        error_status=e.status_code, updated_at=timezone.now())
+        except Exception as e:
+            logger.error(f"Unexpected error in music job {job_id}: {str(e)}", exc_info=True)
+            jobs.update(status=MusicJob.STATUS_FAILED, error="An unexpected error occurred", error_details=str(e),
+                        error_status=500, updated_at=timezone.now())
+        else:
+            jobs.update(status=MusicJob.STATUS_SUCCEEDED, result=result, error='', error_details='',
+                        error_status=None, updated_at=timezone.now())
+    except Exception as e:
+        logger.error(f"Music job {job_id} could not be run: {str(e)}", exc_info=True)
+    finally:
+        with _music_job_lock:
+            _active_music_jobs.discard(str(job_id))
+        with _music_job_finished:
+            _music_job_finished.notify_all()
+        # Worker threads are reused, so release this thread's DB connection explicitly.
+        connection.close()
+
+def resume_stale_music_job(job):
+    if job.status not in (MusicJob.STATUS_PENDING, MusicJob.STATUS_RUNNING):
+        return
+    with _music_job_lock:
+        if str(job.id) in _active_music_jobs:
+            return
+    if (timezone.now() - job.updated_at).total_seconds() > MUSIC_JOB_STALE_SECONDS:
+        # Only the request whose update still sees the stale row re-queues it.
+        requeued = MusicJob.objects.filter(id=job.id, status=job.status, updated_at=job.updated_at).update(
+            status=MusicJob.STATUS_PENDING, updated_at=timezone.now())
+        if requeued:
+            logger.warning(f"Re-queueing stale music job {job.id}")
+            enqueue_music_job(job.id)
+
+def serialize_music_job(job, deduplicated=False):
+    data = {
+        'job_id': str(job.id),
+        'status': job.status,
+        'prompt': job.prompt,
+        'duration': job.duration,
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat(),
+    }
+    if job.status == MusicJob.STATUS_SUCCEEDED:
+        data['result'] = job.result
+    elif job.status == MusicJob.STATUS_FAILED:
+        data['error'] = {'code': job.error_status, 'message': job.error, 'details': job.error_details}
+    if deduplicated:
+        data['deduplicated'] = True
+    return data
+
+@csrf_exempt
+def submit_music_job(request):
+    """
+    Queue a prompt-based music generation job and return its ID immediately. Identical
+    prompt+duration submissions return the job that is already queued, running or recently done.
+    """
+    if request.method != "POST":
+        return create_error_response(405, "Only POST requests allowed")
+
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+        prompt, duration, error_response = parse_music_request(body)
+        if error_response:
+            return error_response
+        if not LOUDLY_API_KEY:
+            return create_error_response(500, "Loudly API key is not configured")
+
+        dedupe_key = music_job_dedupe_key(prompt, duration)
+        existing = find_reusable_music_job(dedupe_key)
+        if existing is None:
+            try:
+                with transaction.atomic():
+                    job = MusicJob.objects.create(prompt=prompt, duration=duration, dedupe_key=dedupe_key)
+            except IntegrityError:
+                # Another worker queued the same prompt in between; the unique constraint kept it to one job.
+                existing = find_reusable_music_job(dedupe_key)
+                if existing is None:
+                    raise
+        if existing is not None:
+            logger.debug(f"Music job deduplicated to {existing.id}")
+            resume_stale_music_job(existing)
+            return JsonResponse(serialize_music_job(existing, deduplicated=True), status=200)
+
+        enqueue_music_job(job.id)
+        logger.info(f"Queued music job {job.id}")
+        return JsonResponse(serialize_music_job(job), status=202)
+
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except Exception as e:
+        logger.error(f"Unexpected error in submit_music_job: {str(e)}", exc_info=True)
+        return create_error_response(500, "An unexpected error occurred", str(e))
+
+def music_job_status(request, job_id):
+    """
+    Return the state of a music job. With ?wait=N the request long-polls for up to N seconds
+    (capped at MUSIC_JOB_MAX_WAIT) until the job succeeds or fails.
+    """
+    if request.method != "GET":
+        return create_error_response(405, "Only GET requests allowed")
+
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        wait = math.nan
+    if not math.isfinite(wait):
+        return create_error_response(400, "Invalid wait", "wait must be a number of seconds")
+    wait = min(max(wait, 0.0), MUSIC_JOB_MAX_WAIT)
+
+    try:
+        job = MusicJob.objects.get(id=job_id)
+    except MusicJob.DoesNotExist:
+        return create_error_response(404, "Music job not found")
+
+    resume_stale_music_job(job)
+    deadline = time.monotonic() + wait
+    while job.status in (MusicJob.STATUS_PENDING, MusicJob.STATUS_RUNNING):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Woken by jobs finishing in this process; the timeout covers jobs run by other workers.
+        with _music_job_finished:
+            _music_job_finished.wait(timeout=min(remaining, 1.0))
+        job.refresh_from_db()
+    return JsonResponse(serialize_music_job(job))
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_SPLIT_PATTERN.split(text) if sentence and sentence.strip()]
+
+def split_oversized_text(text, max_bytes):
+    pieces = []
+    current = ''
+    current_bytes = 0
+    for word in text.split():
+        word_bytes = len(word.encode('utf-8'))
+        while word_bytes > max_bytes:
+            # A single "word" larger than the budget: fall back to a character split.
+            cut = len(word.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore'))
+            if current:
+                pieces.append(current)
+                current, current_bytes = '', 0
+            pieces.append(word[:cut])
+            word = word[cut:]
+            word_bytes = len(word.encode('utf-8'))
+        if not word:
+            continue
+        needed = word_bytes + (1 if current else 0)
+        if current and current_bytes + needed > max_bytes:
+            pieces.append(current)
+            current, current_bytes = word, word_bytes
+        else:
+            current = f"{current} {word}" if current else word
+            current_bytes += needed
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_text_by_sentences(text, max_bytes):
+    """
+    Pack whole sentences into chunks of at most max_bytes UTF-8 bytes (the unit the TTS APIs
+    limit on). Only sentences that are larger than the budget on their own are split further.
+    """
+    chunks = []
+    current = ''
+    current_bytes = 0
+    for sentence in split_sentences(text):
+        for piece in split_oversized_text(sentence, max_bytes):
+            piece_bytes = len(piece.encode('utf-8'))
+            needed = piece_bytes + (1 if current else 0)
+            if current and current_bytes + needed > max_bytes:
+                chunks.append(current)
+                current, current_bytes = piece, piece_bytes
+            else:
+                current = f"{current} {piece}" if current else piece
+                current_bytes += needed
+    if current:
+        chunks.append(current)
+    return chunks
+
+def strip_id3_tags(data):
+    if len(data) >= 10 and data[:3] == b'ID3':
+        size = ((data[6] & 0x7f) << 21) | ((data[7] & 0x7f) << 14) | ((data[8] & 0x7f) << 7) | (data[9] & 0x7f)
+        footer = 10 if data[5] & 0x10 else 0
+        data = data[10 + size + footer:]
+    if len(data) >= 128 and data[-128:-125] == b'TAG':
+        data = data[:-128]
+    return data
+
+MP3_BITRATES_KBPS = {
+    'mpeg1': (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    'mpeg2': (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def mp3_header_frame_length(data):
+    """
+    Return the length of the leading frame when it is a Xing/Info or VBRI header frame, else 0.
+    Encoders write one of these before the audio with the frame count and duration of the whole
+    stream, so it is wrong for anything but the file it came from.
+    """
+    if len(data) < 4 or data[0] != 0xff or data[1] & 0xe0 != 0xe0:
+        return 0
+    version = (data[1] >> 3) & 3
+    layer = (data[1] >> 1) & 3
+    bitrate_index = data[2] >> 4
+    sample_rate_index = (data[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return 0
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES_KBPS['mpeg1' if mpeg1 else 'mpeg2'][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[2] >> 1) & 1
+    frame_length = (144 if mpeg1 else 72) * bitrate // sample_rate + padding
+    mono = data[3] >> 6 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing_offset = 4 + side_info
+    if data[xing_offset:xing_offset + 4] in (b'Xing', b'Info') or data[36:40] == b'VBRI':
+        return frame_length if len(data) >= frame_length else 0
+    return 0
+
+def concat_mp3_bytes(chunks):
+    """
+    Join MP3 streams at the frame level. MP3 frames are self-contained, so dropping the per-chunk
+    ID3 tags and Xing/Info header frames is enough to produce one playable stream without decoding
+    and re-encoding. The header frames are dropped from the first chunk too: its counts describe
+    that chunk only, and without one players fall back to the frame headers of the joined stream.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    frames = []
+    for chunk in chunks:
+        chunk = strip_id3_tags(chunk)
+        frames.append(chunk[mp3_header_frame_length(chunk):])
+    return b''.join(frames)
+
+def concat_wav_bytes(chunks):
+    """Join LINEAR16 WAV files by copying their PCM frames under a single header."""
+    if len(chunks) == 1:
+        return chunks[0]
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as writer:
+        for index, chunk in enumerate(chunks):
+            with wave.open(io.BytesIO(chunk), 'rb') as reader:
+                if index == 0:
+                    writer.setparams(reader.getparams())
+                writer.writeframes(reader.readframes(reader.getnframes()))
+    return output.getvalue()
+
+def join_synthesized_audio(plan, pieces):
+    # A single chunk may arrive as slices of one response body; otherwise each piece is a whole file.
+    if len(plan['chunks']) == 1:
+        return b''.join(pieces)
+    if plan['encoding'] == 'wav':
+        return concat_wav_bytes(pieces)
+    return concat_mp3_bytes(pieces)
+
+def encode_audio_segment(audio_segment, output_format, bitrate=None):
+    spec = AUDIO_OUTPUT_FORMATS[output_format]
+    buffer = io.BytesIO()
+    audio_segment.export(buffer, format=spec['container'], codec=spec['codec'], bitrate=bitrate)
+    return buffer.getvalue()
+
+def transcode_audio(audio_bytes, source_format, output_format, bitrate=None):
+    source = AUDIO_OUTPUT_FORMATS[source_format]['container']
+    audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes), format=source)
+    return encode_audio_segment(audio_segment, output_format, bitrate)
+
+def google_synthesis_input(chunk, input_type='text'):
+    if input_type == 'ssml':
+        return texttospeech.SynthesisInput(ssml=chunk)
+    return texttospeech.SynthesisInput(text=chunk)
+
+def synthesize_google_chunk(client, chunk, voice, audio_config, input_type='text'):
+    synthesis_input = google_synthesis_input(chunk, input_type)
+    response = client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
+    return response.audio_content
+
+def iter_gpt4o_mini_speech(headers, payload):
+    response = openai_client.post(
+        OPENAI_TTS_URL,
+        headers=headers,
+        json=payload,
+        timeout=30,
+        stream=True
+    )
+    try:
+        if response.status_code != 200:
+            logger.error(f"GPT-4o mini TTS API error: {response.status_code} - {response.text}")
+            raise Exception(f"GPT-4o mini TTS API error: {response.text}")
+        for piece in response.iter_content(chunk_size=AUDIO_STREAM_CHUNK_SIZE):
+            if piece:
+                yield piece
+    finally:
+        response.close()
+
+def synthesize_gpt4o_mini_chunk(headers, payload):
+    response = openai_client.post(OPENAI_TTS_URL, headers=headers, json=payload, timeout=30)
+    if response.status_code != 200:
+        logger.error(f"GPT-4o mini TTS API error: {response.status_code} - {response.text}")
+        raise Exception(f"GPT-4o mini TTS API error: {response.text}")
+    return response.content
+
+def tts_segment_params(plan):
+    if plan['provider'] == 'gpt4o_mini':
+        params = {key: value for key, value in plan['payload'].items() if key not in ('input', 'instructions')}
+        params['directive'] = asdict(plan['directive'])
+        # Free-text instructions may say more than the directive captures, so they stay in the key.
+        if plan['directive'].source == 'instructions':
+            params['instructions'] = plan['payload']['instructions']
+        return params
+    return {
+        'input_type': plan['input_type'],
+        'voice': texttospeech.VoiceSelectionParams.to_dict(plan['voice']),
+        'audio_config': texttospeech.AudioConfig.to_dict(plan['audio_config']),
+    }
+
+def tts_segment_cache_key(plan, chunk):
+    material = json.dumps({
+        'version': AUDIO_CACHE_VERSION,
+        'provider': plan['provider'],
+        'text': chunk,
+        'params': tts_segment_params(plan),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def synthesize_tts_segment(plan, chunk, client=None):
+    """Synthesize one chunk of a plan, reusing its audio from an earlier request when possible."""
+    segment_key = tts_segment_cache_key(plan, chunk)
+    cached = audio_cache.get(segment_key)
+    if cached is not None:
+        return cached
+    if plan['provider'] == 'gpt4o_mini':
+        audio = synthesize_gpt4o_mini_chunk(plan['headers'], dict(plan['payload'], input=chunk))
+    else:
+        audio = synthesize_google_chunk(client, chunk, plan['voice'], plan['audio_config'], plan['input_type'])
+    audio_cache.set(segment_key, audio)
+    return audio
+
+def iter_tts_segments(plan):
+    client = google_clients.get_client('texttospeech') if plan['provider'] == 'google' else None
+    # Every chunk is submitted up front; results are yielded in text order as soon as each is ready.
+    futures = [tts_executor.submit(synthesize_tts_segment, plan, chunk, client) for chunk in plan['chunks']]
+    is_mp3 = plan['encoding'] == 'mp3'
+    try:
+        for future in futures:
+            audio = future.result()
+            yield strip_id3_tags(audio) if is_mp3 else audio
+    finally:
+        for future in futures:
+            future.cancel()
+
+def is_chunk_boundary(sentence):
+    digest = hashlib.blake2b(sentence.encode('utf-8'), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') % TTS_CHUNK_TARGET_SENTENCES == 0
+
+def content_defined_chunks(text, max_bytes):
+    """
+    Pack sentences into chunks of at most max_bytes, ending a chunk after every sentence whose hash
+    marks it as a boundary. Boundaries depend only on the sentence text, so an edit changes the
+    chunk it falls in (and at most the chunks up to the next boundary) while the rest of the text
+    keeps the same chunks and their cached audio.
+    """
+    chunks = []
+    current = ''
+    current_bytes = 0
+    for sentence in split_sentences(text):
+        for piece in split_oversized_text(sentence, max_bytes):
+            piece_bytes = len(piece.encode('utf-8'))
+            needed = piece_bytes + (1 if current else 0)
+            if current and current_bytes + needed > max_bytes:
+                chunks.append(current)
+                current, current_bytes = piece, piece_bytes
+            else:
+                current = f"{current} {piece}" if current else piece
+                current_bytes += needed
+        if current and is_chunk_boundary(sentence):
+            chunks.append(current)
+            current, current_bytes = '', 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_tts_text(text, max_bytes):
+    if TTS_SENTENCE_CACHE_ENABLED:
+        return content_defined_chunks(text, max_bytes)
+    return chunk_text_by_sentences(text, max_bytes)
+
+VALID_EMOTIONS = frozenset(EMOTION_MAPPING)
+VALID_TONES = frozenset([
+    'empathetic', 'solution-focused', 'gentle', 'authoritative', 'warm',
+    'soothing', 'excited', 'noble', 'chaotic', 'calm'
+])
+VALID_STYLES = frozenset([
+    'conversational', 'professional', 'dramatic', 'monotone', 'narrative', 'poetic',
+    'motivational', 'whispered', 'sarcastic', 'childlike', 'commanding', 'meditative',
+    'sports-coach', 'bedtime-story', 'medieval-knight', 'mad-scientist', 'patient-teacher',
+    'auctioneer', 'old-timey', 'chill-surfer'
+])
+VALID_PAUSE_FREQUENCIES = frozenset(['low', 'medium', 'high'])
+# "Speak with a {tone} tone" instructions name a tone description instead of an emotion.
+ALT_TONE_MAPPING = {
+    "bright, cheerful": ("excited", "happiness"),
+    "cheerful": ("excited", "happiness"),
+    "bright": ("excited", "happiness"),
+    "calm": ("calm", "calm"),
+    "soothing": ("soothing", "serene"),
+}
+EMOTION_PATTERN = re.compile(r'Speak in a (\w+) tone with (\d+)% intensity')
+SECONDARY_EMOTION_PATTERN = re.compile(r'blended with (\w+) at (\d+)% intensity')
+TONE_PATTERN = re.compile(r',\s*(\w+(?:-\w+)*)\s*tone,\s*')
+STYLE_PATTERN = re.compile(r'(\w+(?:-\w+)*) style')
+PACING_PATTERN = re.compile(r'pacing at (\d+)%')
+PAUSE_FREQUENCY_PATTERN = re.compile(r'pause frequency set to (\w+)')
+EMPHASIS_PATTERN = re.compile(r'Emphasize the following words: ([\w\s,آ-ی]+)\.')
+ALT_TONE_PATTERN = re.compile(r'Speak with a ([\w\s,]+) tone')
+SMILE_PATTERN = re.compile(r'and a slight smile')
+
+@dataclass(frozen=True)
+class VoiceDirective:
+    """Parsed GPT-4o mini delivery settings. Hashable, so it can be memoized and used in cache keys."""
+    emotion: str
+    emotion_intensity: int = 70
+    secondary_emotion: str = 'none'
+    secondary_emotion_intensity: int = 0
+    tone: str = 'empathetic'
+    style: str = 'conversational'
+    pacing: int = 100
+    pause_frequency: str = 'medium'
+    emphasis_words: tuple = ()
+    source: str = 'instructions'
+
+    @property
+    def speed(self):
+        return min(max(self.pacing / 100.0, 0.5), 2.0)
+
+    def validate(self):
+        if self.emotion not in VALID_EMOTIONS:
+            raise ValueError(f"Invalid base emotion: {self.emotion}. Supported emotions: {sorted(VALID_EMOTIONS)}")
+        if self.secondary_emotion != 'none' and self.secondary_emotion not in VALID_EMOTIONS:
+            raise ValueError(f"Invalid secondary emotion: {self.secondary_emotion}. Supported emotions: {sorted(VALID_EMOTIONS)}")
+        if not (0 <= self.emotion_intensity <= 100):
+            raise ValueError(f"Base emotion intensity must be between 0 and 100, got {self.emotion_intensity}")
+        if not (0 <= self.secondary_emotion_intensity <= 100):
+            raise ValueError(f"Secondary emotion intensity must be between 0 and 100, got {self.secondary_emotion_intensity}")
+        if self.tone not in VALID_TONES:
+            raise ValueError(f"Invalid tone: {self.tone}. Supported tones: {sorted(VALID_TONES)}")
+        if self.style not in VALID_STYLES:
+            raise ValueError(f"Invalid style: {self.style}. Supported styles: {sorted(VALID_STYLES)}")
+        if not (50 <= self.pacing <= 200):
+            raise ValueError(f"Pacing must be between 50% and 200%, got {self.pacing}%")
+        if self.pause_frequency not in VALID_PAUSE_FREQUENCIES:
+            raise ValueError(f"Invalid pause frequency: {self.pause_frequency}. Supported values: {sorted(VALID_PAUSE_FREQUENCIES)}")
+        return self
+
+    def to_instructions(self):
+        parts = [f"Speak in a {self.emotion} tone with {self.emotion_intensity}% intensity"]
+        if self.secondary_emotion != 'none':
+            parts.append(f"blended with {self.secondary_emotion} at {self.secondary_emotion_intensity}% intensity")
+        parts.extend([f"{self.tone} tone", f"{self.style} style", f"pacing at {self.pacing}%", f"pause frequency set to {self.pause_frequency}"])
+        instructions = ', '.join(parts) + '.'
+        if self.emphasis_words:
+            instructions += f" Emphasize the following words: {', '.join(self.emphasis_words)}."
+        return instructions
+
+@lru_cache(maxsize=VOICE_DIRECTIVE_CACHE_SIZE)
+def compile_voice_directive(instructions):
+    """Parse free-text GPT-4o mini instructions into a validated VoiceDirective."""
+    emphasis_match = EMPHASIS_PATTERN.search(instructions)
+    emphasis_words = tuple(word.strip() for word in emphasis_match.group(1).split(',') if word.strip()) if emphasis_match else ()
+
+    emotion_match = EMOTION_PATTERN.search(instructions)
+    if not emotion_match:
+        alt_emotion_tone_match = ALT_TONE_PATTERN.search(instructions)
+        if not alt_emotion_tone_match:
+            raise ValueError("Invalid instructions format. Expected format: 'Speak in a {emotion} tone with {intensity}% intensity...' or 'Speak with a {tone} tone and a slight smile'")
+        tone, emotion = ALT_TONE_MAPPING.get(alt_emotion_tone_match.group(1).lower(), ("excited", "happiness"))
+        if SMILE_PATTERN.search(instructions):
+            emotion = "happiness"
+        return VoiceDirective(emotion=emotion, tone=tone, emphasis_words=()).validate()
+
+    secondary_emotion_match = SECONDARY_EMOTION_PATTERN.search(instructions)
+    tone_match = TONE_PATTERN.search(instructions)
+    style_match = STYLE_PATTERN.search(instructions)
+    pacing_match = PACING_PATTERN.search(instructions)
+    pause_frequency_match = PAUSE_FREQUENCY_PATTERN.search(instructions)
+    return VoiceDirective(
+        emotion=emotion_match.group(1).lower(),
+        emotion_intensity=int(emotion_match.group(2)),
+        secondary_emotion=secondary_emotion_match.group(1).lower() if secondary_emotion_match else 'none',
+        secondary_emotion_intensity=int(secondary_emotion_match.group(2)) if secondary_emotion_match else 0,
+        tone=tone_match.group(1).lower() if tone_match else 'empathetic',
+        style=style_match.group(1).lower() if style_match else 'conversational',
+        pacing=int(pacing_match.group(1)) if pacing_match else 100,
+        pause_frequency=pause_frequency_match.group(1).lower() if pause_frequency_match else 'medium',
+        emphasis_words=emphasis_words,
+    ).validate()
+
+def voice_directive_from_dict(data):
+    """Build a VoiceDirective from the structured JSON form, e.g. {"emotion": "calm", "pacing": 90}."""
+    if not isinstance(data, dict) or not isinstance(data.get('emotion'), str):
+        raise ValueError("Invalid directive: an object with at least an 'emotion' string is required")
+    fields = {
+        'emotion': str, 'emotion_intensity': int, 'secondary_emotion': str, 'secondary_emotion_intensity': int,
+        'tone': str, 'style': str, 'pacing': int, 'pause_frequency': str,
+    }
+    unknown = set(data) - set(fields) - {'emphasis_words'}
+    if unknown:
+        raise ValueError(f"Invalid directive: unknown fields {sorted(unknown)}")
+    values = {}
+    for name, kind in fields.items():
+        if name in data:
+            if isinstance(data[name], bool) or not isinstance(data[name], kind):
+                raise ValueError(f"Invalid directive: '{name}' must be a {'number' if kind is int else 'string'}")
+            values[name] = data[name].lower() if kind is str else data[name]
+    emphasis_words = data.get('emphasis_words', [])
+    if not isinstance(emphasis_words, list) or not all(isinstance(word, str) for word in emphasis_words):
+        raise ValueError("Invalid directive: 'emphasis_words' must be a list of strings")
+    values['emphasis_words'] = tuple(word.strip() for word in emphasis_words if word.strip())
+    return VoiceDirective(source='directive', **values).validate()
+
+def voice_directive_from_settings(voice_settings):
+    if 'directive' in voice_settings:
+        return voice_directive_from_dict(voice_settings['directive'])
+    instructions = voice_settings.get('instructions', '')
+    if not isinstance(instructions, str) or not instructions.strip():
+        raise ValueError("Instructions are required for GPT-4o mini TTS.")
+    return compile_voice_directive(instructions.strip())
+
+def directive_instructions(voice_settings, directive):
+    # Free-text instructions are sent as written; structured directives are rendered to the sentence form.
+    if directive.source == 'instructions':
+        return voice_settings['instructions']
+    return directive.to_instructions()
+
+class MultiPatternMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of patterns. find() scans the text once and returns
+    non-overlapping (start, end) spans, preferring the leftmost match and then the longest one,
+    so a term that contains another is matched whole instead of nesting.
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [()]
+        for pattern in {pattern for pattern in patterns if pattern}:
+            node = 0
+            for char in pattern:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append(())
+                node = child
+            self._outputs[node] = (len(pattern),)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+                queue.append(child)
+
+    def __bool__(self):
+        return len(self._goto) > 1
+
+    def find(self, text):
+        matches = []
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length in self._outputs[node]:
+                matches.append((index + 1 - length, index + 1))
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+        selected = []
+        position = 0
+        for start, end in matches:
+            if start >= position:
+                selected.append((start, end))
+                position = end
+        return selected
+
+# Dropped before matching: tatweel, zero-width characters and soft hyphens that can be slipped inside a word.
+MATCH_IGNORED_CHARS = frozenset('\u0640\u00ad\u200b\u200c\u200d\u200e\u200f\u2060\ufeff')
+# Arabic letter forms that Urdu text uses interchangeably, plus Roman Urdu and leetspeak spellings.
+MATCH_CHAR_FOLDS = {
+    '\u064a': '\u06cc', '\u0649': '\u06cc', '\u0643': '\u06a9', '\u0647': '\u06c1', '\u0629': '\u06c1',
+    '\u06c3': '\u06c1', '\u06d5': '\u06c1',
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's', 'v': 'w', 'q': 'k',
+}
+# Flagged text is escalated a sentence or line at a time.
+PROFANITY_SPAN_SEPARATOR_PATTERN = re.compile(r'(?<=[۔؟])\s*|(?<=[.!?])\s+|\n\s*')
+NUMBERED_LINE_PATTERN = re.compile(r'^\s*(\d+)[.)]\s?(.*)$')
+
+@lru_cache(maxsize=4096)
+def fold_match_char(char):
+    if char in MATCH_IGNORED_CHARS:
+        return ''
+    # NFKC maps presentation forms and fullwidth letters to plain ones; NFD then exposes diacritics to drop.
+    decomposed = unicodedata.normalize('NFD', unicodedata.normalize('NFKC', char))
+    folded = ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return ''.join(MATCH_CHAR_FOLDS.get(c, c) for c in folded)
+
+def fold_for_matching(text):
+    """
+    Fold text for blocklist and lexicon matching: diacritics, letter variants and leetspeak are normalized and
+    repeated letters collapse to one, so "کُتّا" matches "کتا" and "kuuutta" matches "kutta".
+    Returns the folded text and, for each of its characters, the index it came from in the input.
+    """
+    folded = []
+    positions = []
+    for index, char in enumerate(text):
+        for folded_char in fold_match_char(char):
+            if folded and folded_char == folded[-1] and folded_char.isalpha():
+                continue
+            folded.append(folded_char)
+            positions.append(index)
+    return ''.join(folded), positions
+
+def build_profanity_matcher(words):
+    matcher = MultiPatternMatcher(fold_for_matching(word)[0] for word in words)
+    if not matcher:
+        logger.warning("Profanity blocklist is empty; every extracted text will be sent to the filter model")
+    return matcher
+
+profanity_matcher = build_profanity_matcher(urdu_dictionary)
+
+def find_profanity(text, matcher=None):
+    """(start, end) spans in text of blocklisted words that stand as whole words."""
+    matcher = profanity_matcher if matcher is None else matcher
+    folded, positions = fold_for_matching(text)
+    spans = []
+    for start, end in matcher.find(folded):
+        if start > 0 and folded[start - 1].isalnum():
+            continue
+        if end < len(folded) and folded[end].isalnum():
+            continue
+        spans.append((positions[start], positions[end - 1] + 1))
+    return spans
+
+def sentence_spans(text):
+    spans = []
+    position = 0
+    for match in PROFANITY_SPAN_SEPARATOR_PATTERN.finditer(text):
+        if match.start() > position:
+            spans.append((position, match.start()))
+        position = max(position, match.end())
+    if position < len(text):
+        spans.append((position, len(text)))
+    return spans
+
+def flag_profane_sentences(text):
+    """
+    Sentence spans that contain a blocklisted word, found in one pass over the text. Returns None
+    when no blocklist is loaded, since clean text cannot then be told apart from flagged text.
+    """
+    if not profanity_matcher:
+        return None
+    matches = find_profanity(text)
+    if not matches:
+        return []
+    flagged = []
+    match_index = 0
+    for start, end in sentence_spans(text):
+        while match_index < len(matches) and matches[match_index][1] <= start:
+            match_index += 1
+        if match_index < len(matches) and matches[match_index][0] < end:
+            flagged.append((start, end))
+    return flagged
+
+# Nouns name the subject outright and weigh more than verb and auxiliary agreement, which can follow other nouns.
+GENDER_LEXICON = {
+    'male': {
+        'لڑکا': 2, 'لڑکے': 2, 'آدمی': 2, 'مرد': 2, 'بیٹا': 2, 'بھائی': 2, 'باپ': 2, 'ابو': 2, 'والد': 2,
+        'شوہر': 2, 'دادا': 2, 'نانا': 2, 'چچا': 2, 'ماموں': 2, 'صاحب': 2, 'بادشاہ': 2, 'شہزادہ': 2,
+        'گیا': 1, 'تھا': 1, 'رہا': 1, 'ہوا': 1, 'آیا': 1, 'لگا': 1, 'چکا': 1, 'سکتا': 1, 'کرتا': 1,
+        'جاتا': 1, 'آتا': 1, 'دیتا': 1, 'لیتا': 1, 'کہتا': 1, 'سوچتا': 1, 'بولا': 1, 'والا': 1,
+        'he': 2, 'him': 2, 'his': 2, 'man': 2, 'boy': 2,
+    },
+    'female': {
+        'لڑکی': 2, 'لڑکیاں': 2, 'عورت': 2, 'خاتون': 2, 'بیٹی': 2, 'بہن': 2, 'ماں': 2, 'امی': 2, 'والدہ': 2,
+        'بیوی': 2, 'بیگم': 2, 'دادی': 2, 'نانی': 2, 'چچی': 2, 'خالہ': 2, 'ملکہ': 2, 'شہزادی': 2,
+        'گئی': 1, 'تھی': 1, 'تھیں': 1, 'رہی': 1, 'ہوئی': 1, 'آئی': 1, 'لگی': 1, 'چکی': 1, 'سکتی': 1,
+        'کرتی': 1, 'جاتی': 1, 'آتی': 1, 'دیتی': 1, 'لیتی': 1, 'کہتی': 1, 'سوچتی': 1, 'بولی': 1, 'والی': 1,
+        'she': 2, 'her': 2, 'hers': 2, 'woman': 2, 'girl': 2,
+    },
+}
+EMOTION_LEXICON = {
+    'sympathetic': ('ہمدردی', 'ہمدرد', 'بیچارہ', 'بیچاری', 'ترس', 'sympathy', 'compassion'),
+    'sincere': ('خلوص', 'مخلص', 'سچائی', 'دیانت', 'ایمانداری', 'sincere', 'honest'),
+    'calm': ('سکون', 'پرسکون', 'خاموشی', 'آرام', 'ٹھہراؤ', 'calm', 'quiet'),
+    'serene': ('اطمینان', 'طمانیت', 'پرامن', 'سکینت', 'serene', 'peaceful'),
+    'sadness': ('غم', 'دکھ', 'اداس', 'اداسی', 'افسوس', 'آنسو', 'رونا', 'رویا', 'روئی', 'غمگین', 'sad', 'sorrow', 'tears'),
+    'happiness': ('خوش', 'خوشی', 'مسکراہٹ', 'مسکرایا', 'مسکرائی', 'ہنسی', 'مسرت', 'happy', 'joy', 'smile'),
+    'fear': ('ڈر', 'خوف', 'ڈرا', 'ڈری', 'خوفزدہ', 'سہما', 'سہمی', 'fear', 'afraid', 'scared'),
+    'horror': ('دہشت', 'ہولناک', 'وحشت', 'خوفناک', 'لرزہ', 'horror', 'terrified', 'dread'),
+    'surprise': ('حیران', 'حیرت', 'تعجب', 'ششدر', 'اچانک', 'surprise', 'surprised', 'shocked'),
+    'anger': ('غصہ', 'غصے', 'ناراض', 'ناراضگی', 'برہم', 'خفا', 'anger', 'angry', 'annoyed'),
+    'rage': ('طیش', 'غضب', 'قہر', 'غضبناک', 'rage', 'furious', 'fury'),
+    'love': ('محبت', 'پیار', 'عشق', 'چاہت', 'محبوب', 'محبوبہ', 'love', 'beloved'),
+    'excitement': ('جوش', 'پرجوش', 'ولولہ', 'بےتاب', 'excited', 'thrilled', 'eager'),
+    'anxiety': ('پریشان', 'پریشانی', 'فکر', 'بےچین', 'بےچینی', 'گھبراہٹ', 'اضطراب', 'تشویش', 'anxious', 'worried', 'nervous'),
+    'disgust': ('نفرت', 'گھن', 'کراہت', 'بیزار', 'بیزاری', 'disgust', 'disgusted', 'revolting'),
+}
+LEXICON_TOKEN_PATTERN = re.compile(r'\w+')
+REPEATED_LETTER_PATTERN = re.compile(r'([^\W\d_])\1+')
+
+def fold_for_lexicon(text):
+    # Same folding as fold_for_matching without the position map, done with translate() so it stays fast on whole corpora.
+    table = {ord(char): fold_match_char(char) for char in set(text)}
+    return REPEATED_LETTER_PATTERN.sub(r'\1', text.translate(table))
+
+def lexicon_tokens(text):
+    return LEXICON_TOKEN_PATTERN.findall(fold_for_lexicon(text))
+
+class LexiconClassifier:
+    """
+    Scores text against weighted per-label word lists. Tokens are folded like the profanity
+    blocklist, then counted with a single bincount over the lexicon vocabulary and projected onto the
+    labels with one matrix product. classify() reports the winning label with a confidence that is
+    its margin over the runner-up, scaled down when there are only a few hits.
+    """
+
+    def __init__(self, lexicon):
+        self.labels = list(lexicon)
+        self.vocabulary = {}
+        entries = []
+        for label_index, words in enumerate(lexicon.values()):
+            weighted = words.items() if isinstance(words, dict) else ((word, 1) for word in words)
+            for word, weight in weighted:
+                token = fold_for_lexicon(word)
+                entries.append((self.vocabulary.setdefault(token, len(self.vocabulary)), label_index, weight))
+        self.weights = np.zeros((len(self.vocabulary), len(self.labels)))
+        for token_index, label_index, weight in entries:
+            self.weights[token_index, label_index] += weight
+
+    def scores(self, tokens):
+        ids = np.fromiter((self.vocabulary.get(token, -1) for token in tokens), dtype=np.int64, count=len(tokens))
+        counts = np.bincount(ids[ids >= 0], minlength=len(self.vocabulary))
+        return counts @ self.weights
+
+    def classify(self, tokens):
+        scores = self.scores(tokens)
+        ranked = np.argsort(scores)[::-1]
+        top = scores[ranked[0]]
+        if top <= 0:
+            return None, 0.0
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else 0.0
+        confidence = (top - runner_up) / top * (1 - np.exp(-top / LEXICON_EVIDENCE_SCALE))
+        return self.labels[ranked[0]], float(confidence)
+
+gender_classifier = LexiconClassifier(GENDER_LEXICON)
+emotion_classifier = LexiconClassifier(EMOTION_LEXICON)
+
+def classify_with_lexicons(text):
+    """
+    Local gender and emotion for text. Each is (label, confidence), with label None when the lexicon
+    is not confident enough and the question has to go to Gemini.
+    """
+    if not LEXICON_CLASSIFIER_ENABLED:
+        return (None, 0.0), (None, 0.0)
+    tokens = lexicon_tokens(text)
+    gender, gender_confidence = gender_classifier.classify(tokens)
+    emotion, emotion_confidence = emotion_classifier.classify(tokens)
+    logger.debug(f"Lexicon classification: gender={gender} ({gender_confidence:.2f}), emotion={emotion} ({emotion_confidence:.2f})")
+    if gender_confidence < GENDER_LEXICON_MIN_CONFIDENCE:
+        gender = None
+    if emotion_confidence < EMOTION_LEXICON_MIN_CONFIDENCE:
+        emotion = None
+    return (gender, gender_confidence), (emotion, emotion_confidence)
+
+def detect_emotion_and_gender(text):
+    """Returns (emotion, emotion_source, gender, gender_source); Gemini only answers what the lexicons could not."""
+    (gender, _), (emotion, _) = classify_with_lexicons(text)
+    emotion_source = gender_source = 'lexicon'
+    if emotion is None:
+        emotion, emotion_source = detect_emotions_with_ai(text), 'gemini'
+    if gender is None:
+        gender, gender_source = detect_gender_with_ai(text), 'gemini'
+    return emotion, emotion_source, gender, gender_source
+
+@lru_cache(maxsize=VOICE_DIRECTIVE_CACHE_SIZE)
+def emphasis_matcher(words):
+    return MultiPatternMatcher(words)
+
+def mark_emphasis(text, matcher, escape_xml=False):
+    escape = xml_escape if escape_xml else str
+    parts = []
+    position = 0
+    for start, end in matcher.find(text):
+        parts.append(escape(text[position:start]))
+        parts.append(f'<emphasis level="strong">{escape(text[start:end])}</emphasis>')
+        position = end
+    parts.append(escape(text[position:]))
+    return ''.join(parts)
+
+def build_ssml(text, matcher):
+    return f"<speak>{mark_emphasis(text, matcher, escape_xml=True)}</speak>"
+
+def fit_ssml_chunk(chunk, matcher, max_bytes):
+    """SSML documents for a text chunk, split further when markup pushes it over max_bytes."""
+    ssml = build_ssml(chunk, matcher)
+    chunk_bytes = len(chunk.encode('utf-8'))
+    if len(ssml.encode('utf-8')) <= max_bytes:
+        return [ssml]
+    pieces = split_oversized_text(chunk, chunk_bytes // 2 + 1)
+    if len(pieces) < 2:
+        return [ssml]
+    return [document for piece in pieces for document in fit_ssml_chunk(piece, matcher, max_bytes)]
+
+def normalize_tts_text(text):
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n')
+    return re.sub(r'[^\S\n]+', ' ', text).strip()
+
+def build_tts_plan(text, voice_settings_list, detected_gender, tts_provider="google", encoding="mp3"):
+    """
+    Validate a TTS request and describe the upstream calls it needs, without making them.
+    Shared by the threaded and asyncio synthesis paths. plan['chunks'] are the texts sent
+    upstream, one request each. plan['encoding'] is the format the provider will return, which
+    differs from the requested one only when Opus output would have to be stitched from
+    several chunks (WAV is requested instead).
+    """
+    logger.debug(f"Starting text_to_speech: provider={tts_provider}, text_length={len(text)}, voice_settings={voice_settings_list}")
+    try:
+        if len(text) > MAX_TEXT_LENGTH:
+            raise ValueError(f"Text exceeds the maximum length of {MAX_TEXT_LENGTH} characters for audio generation.")
+        
+        text = normalize_tts_text(text)
+        voice_settings = voice_settings_list[0]
+        
+        if tts_provider == "gpt4o_mini":
+            logger.debug("Using GPT-4o mini TTS")
+            required_fields = ['voice_name']
+            if not all(key in voice_settings for key in required_fields):
+                raise ValueError(f"Invalid voice settings: Missing required fields: {required_fields}")
+            
+            if voice_settings['voice_name'] not in GPT4O_VOICES:
+                raise ValueError(f"Invalid voice: {voice_settings['voice_name']}. Supported voices: {GPT4O_VOICES}")
+            
+            directive = voice_directive_from_settings(voice_settings)
+            if directive.emphasis_words:
+                text = mark_emphasis(text, emphasis_matcher(directive.emphasis_words))
+
+            plain_text = text.replace('.', '. ')
+            logger.debug(f"Plain Text Input: {plain_text}")
+            chunks = split_tts_text(plain_text, OPENAI_TTS_MAX_BYTES) if TTS_SENTENCE_CACHE_ENABLED else [plain_text]
+            if AUDIO_OUTPUT_FORMATS[encoding]['container'] == 'ogg' and len(chunks) > 1:
+                encoding = 'wav'
+
+            headers = {
+                "Authorization": f"Bearer {GPT4O_MINI_TTS_API_KEY}",
+                "Content-Type": "application/json"
+            }
+            payload = {
+                "model": "gpt-4o-mini-tts",
+                "input": plain_text,
+                "voice": voice_settings['voice_name'],
+                "response_format": AUDIO_OUTPUT_FORMATS[encoding]['openai'],
+                "speed": directive.speed,
+                "instructions": directive_instructions(voice_settings, directive)
+            }
+            
+            logger.debug(f"GPT-4o mini TTS payload: {payload}")
+            
+            return {'provider': 'gpt4o_mini', 'encoding': encoding, 'chunks': chunks, 'headers': headers, 'payload': payload, 'directive': directive}
+        
+        else:
+            logger.debug("Using Google Cloud TTS")
+            required_fields = ['language_code', 'voice_name', 'gender']
+            if not all(key in voice_settings for key in required_fields):
+                raise ValueError(f"Invalid voice settings: Missing required fields: {required_fields}")
+            
+            if detected_gender != "unknown" and detected_gender != voice_settings['gender'].lower():
+                raise ValueError(f"Gender mismatch: Text is detected as {detected_gender}, but selected voice is {voice_settings['gender'].lower()}.")
+            
+            emphasis_words = voice_settings.get('emphasis_words', [])
+            if not isinstance(emphasis_words, list) or not all(isinstance(word, str) for word in emphasis_words):
+                raise ValueError("Invalid voice settings: emphasis_words must be a list of strings")
+            emphasis_words = tuple(sorted({word.strip() for word in emphasis_words if word.strip()}))
+            
+            text = text.replace('\n', ' ').strip()
+            chunks = split_tts_text(text, GOOGLE_TTS_MAX_BYTES)
+            input_type = 'text'
+            if emphasis_words:
+                # Plain text is kept for voices without SSML support; SSML is only sent when there is markup.
+                matcher = emphasis_matcher(emphasis_words)
+                chunks = [ssml for chunk in chunks for ssml in fit_ssml_chunk(chunk, matcher, GOOGLE_TTS_MAX_BYTES)]
+                input_type = 'ssml'
+            logger.debug(f"Synthesizing {len(chunks)} Google Cloud chunks")
+            if AUDIO_OUTPUT_FORMATS[encoding]['container'] == 'ogg' and len(chunks) > 1:
+                encoding = 'wav'
+            
+            voice = texttospeech.VoiceSelectionParams(
+                language_code=voice_settings['language_code'],
+                name=voice_settings['voice_name'],
+                ssml_gender=texttospeech.SsmlVoiceGender[voice_settings['gender'].upper()]
+            )
+            audio_config = texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding[AUDIO_OUTPUT_FORMATS[encoding]['google']],
+                speaking_rate=float(voice_settings.get('speaking_rate', 1.0)),
+                pitch=float(voice_settings.get('pitch', 0.0)),
+                volume_gain_db=float(voice_settings.get('volume_gain_db', 0.0)),
+                effects_profile_id=voice_settings.get('audio_effects', [])
+            )
+            
+            return {'provider': 'google', 'encoding': encoding, 'chunks': chunks, 'input_type': input_type, 'voice': voice, 'audio_config': audio_config}
+    
+    except FileNotFoundError as e:
+        logger.error(f"TTS error: {str(e)}")
+        raise
+    except ValueError as ve:
+        logger.error(f"TTS validation error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error generating audio: {str(e)}")
+        raise
+
+def iter_tts_plan(plan):
+    if plan['provider'] == 'gpt4o_mini' and len(plan['chunks']) == 1:
+        # A single request is relayed as it downloads; its result is cached as the whole request.
+        return iter_gpt4o_mini_speech(plan['headers'], plan['payload'])
+    return iter_tts_segments(plan)
+
+def tts_cache_key(plan):
+    params = {'chunks': plan['chunks'], 'segment': tts_segment_params(plan)}
+    material = json.dumps({
+        'version': AUDIO_CACHE_VERSION,
+        'provider': plan['provider'],
+        'params': params,
+        'output_format': plan['output_format'],
+        'bitrate': plan['bitrate'],
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def plan_speech(text, voice_settings_list, detected_gender, tts_provider="google", output_format="mp3", bitrate=None):
+    """
+    Build the TTS plan for a request and attach its audio cache key: a hash of exactly what is
+    sent upstream (normalized text, voice, rate, pitch, effects, instructions) plus the output
+    format and bitrate. The key doubles as the response ETag.
+    """
+    plan = build_tts_plan(text, voice_settings_list, detected_gender, tts_provider, 'wav' if bitrate else output_format)
+    plan['output_format'] = output_format
+    plan['bitrate'] = bitrate
+    plan['cache_key'] = tts_cache_key(plan)
+    return plan
+
+def finish_synthesized_audio(plan, pieces):
+    """
+    Join the provider output into one file in the requested format. When the provider produced
+    that format natively its bytes are returned untouched; ffmpeg only runs for an explicit
+    bitrate or Opus output that had to be stitched from several chunks.
+    """
+    audio_content = join_synthesized_audio(plan, pieces)
+    output_format = plan['output_format']
+    if plan['bitrate'] or AUDIO_OUTPUT_FORMATS[plan['encoding']]['container'] != AUDIO_OUTPUT_FORMATS[output_format]['container']:
+        audio_content = transcode_audio(audio_content, plan['encoding'], output_format, plan['bitrate'])
+    return audio_content
+
+def synthesize_speech(plan):
+    cached = audio_cache.get(plan['cache_key'])
+    if cached is not None:
+        logger.debug(f"Audio cache hit: {plan['cache_key']}")
+        return cached
+    try:
+        audio_content = finish_synthesized_audio(plan, list(iter_tts_plan(plan)))
+    except Exception as e:
+        logger.error(f"Error generating audio: {str(e)}")
+        raise
+    audio_cache.set(plan['cache_key'], audio_content)
+    return audio_content
+
+def text_to_speech(text, voice_settings_list, base_file_name, detected_gender, tts_provider="google",
+                   output_format="mp3", bitrate=None):
+    plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider, output_format, bitrate)
+    audio_content = synthesize_speech(plan)
+    final_file_name = f"{base_file_name.rsplit('.', 1)[0]}.{output_format}"
+    logger.debug(f"Generated {len(audio_content)} bytes of {tts_provider} audio ({output_format})")
+    return audio_content, final_file_name, None
+
+def load_raw_document_text(upload):
+    raw_key = extraction_cache_key(upload.sha256, 'raw')
+    cached_raw = extraction_cache.get_json(raw_key)
+    if cached_raw is not None:
+        return cached_raw['text']
+    document_text = extract_text_from_file(upload.path, upload.kind)
+    extraction_cache.set_json(raw_key, {'text': document_text or ''})
+    return document_text
+
+def extract_cleaned_text_from_upload(upload):
+    """
+    Run OCR, Urdu extraction and filtering for one upload, reusing cached results for
+    byte-identical files so repeat uploads cost no Document AI or Gemini calls.
+    """
+    cleaned_key = extraction_cache_key(upload.sha256, 'cleaned')
+    cached = extraction_cache.get_json(cleaned_key)
+    if cached is not None:
+        logger.debug(f"Extraction cache hit for '{upload.name}' ({upload.sha256})")
+        return cached['text']
+
+    document_text = load_raw_document_text(upload)
+    cleaned_text = ''
+    if document_text:
+        extracted_text = get_gemini_response(URDU_EXTRACTION_PROMPT, document_text)
+        if extracted_text:
+            cleaned_text = filter_unethical_text_with_prompt(extracted_text) or ''
+    extraction_cache.set_json(cleaned_key, {'text': cleaned_text})
+    return cleaned_text
+
+def refine_combined_analysis(analysis):
+    """
+    Apply the blocklist and lexicons to a combined-mode result: sentences Gemini left blocklisted
+    words in are filtered again, and the lexicons answer where Gemini gave no emotion or gender.
+    """
+    text = analysis['text']
+    spans = flag_profane_sentences(text)
+    if spans:
+        cleaned_text = filter_flagged_sentences(text, spans)
+        if cleaned_text is not None:
+            text = cleaned_text.strip()
+        else:
+            logger.warning("Sentence filter reply did not match the flagged sentences; keeping the combined result")
+    return dict(analysis, text=text, **combined_lexicon_labels(analysis, text))
+
+def combined_lexicon_labels(analysis, text):
+    (gender, _), (emotion, _) = classify_with_lexicons(text)
+    labels = {'emotion_source': 'gemini', 'gender_source': 'gemini'}
+    if analysis['emotion'] == "No clear emotion detected" and emotion is not None:
+        labels.update(emotion=emotion, emotion_source='lexicon')
+    if analysis['gender'] == 'unknown' and gender is not None:
+        labels.update(gender=gender, gender_source='lexicon')
+    return labels
+
+def analyze_upload_combined(upload):
+    combined_key = extraction_cache_key(upload.sha256, 'combined')
+    cached = extraction_cache.get_json(combined_key)
+    if cached is not None:
+        logger.debug(f"Combined analysis cache hit for '{upload.name}' ({upload.sha256})")
+        return cached
+
+    document_text = load_raw_document_text(upload)
+    analysis = {'text': '', 'emotion': None, 'gender': 'unknown'}
+    if document_text:
+        analysis = refine_combined_analysis(analyze_text_combined(document_text))
+    extraction_cache.set_json(combined_key, analysis)
+    return analysis
+
+def analyze_uploaded_file(file, analysis_mode='multi'):
+    """
+    Per-file unit of work for the analyze executor. Failures are captured in the result
+    so one bad upload does not abort the rest of the batch.
+    """
+    upload = None
+    try:
+        upload = ingest_upload(file)
+        if upload.error:
+            return {'name': file.name, 'status': 'error', 'error': upload.error}
+        if analysis_mode == 'combined':
+            analysis = analyze_upload_combined(upload)
+        else:
+            analysis = {'text': extract_cleaned_text_from_upload(upload)}
+    except Exception as e:
+        logger.error(f"Failed to analyze '{file.name}': {str(e)}")
+        return {'name': file.name, 'status': 'error', 'error': str(e)}
+    finally:
+        file.close()
+        if upload is not None:
+            upload.close()
+    if not analysis['text']:
+        return {'name': file.name, 'status': 'empty'}
+    return dict(analysis, name=file.name, status='ok')
+
+def summarize_combined_results(file_results):
+    # Each file was classified on its own; the corpus label is the length-weighted majority.
+    ok_results = [result for result in file_results if result['status'] == 'ok']
+    detected_emotion = weighted_vote(
+        [(result['emotion'], len(result['text'])) for result in ok_results], "No clear emotion detected"
+    )
+    detected_gender = weighted_vote(
+        [(result['gender'], len(result['text'])) for result in ok_results if result['gender'] != 'unknown'], "unknown"
+    )
+    emotion_source = combined_source(result['emotion_source'] for result in ok_results)
+    gender_source = combined_source(result['gender_source'] for result in ok_results)
+    return detected_emotion, emotion_source, detected_gender, gender_source
+
+def window_cache_key(window):
+    return extraction_cache_key(hashlib.sha256(window.encode('utf-8')).hexdigest(), 'window')
+
+def classify_window(window):
+    window_key = window_cache_key(window)
+    labels = extraction_cache.get_json(window_key)
+    if labels is None:
+        emotion, emotion_source, gender, gender_source = detect_emotion_and_gender(window)
+        labels = {'emotion': emotion, 'emotion_source': emotion_source, 'gender': gender, 'gender_source': gender_source}
+        extraction_cache.set_json(window_key, labels)
+    return labels
+
+def plan_analysis_windows(file_results):
+    return [
+        (result, window)
+        for result in file_results if result['status'] == 'ok'
+        for window in chunk_text_by_sentences(result['text'], MAP_REDUCE_WINDOW_BYTES)
+    ]
+
+def combined_source(sources):
+    sources = set(sources)
+    if not sources:
+        return None
+    return sources.pop() if len(sources) == 1 else 'mixed'
+
+def reduce_window_labels(windows, window_labels):
+    """
+    Length-weighted vote of the window labels, per file (written into each file result) and over
+    the whole corpus. Returns (emotion, emotion_source, gender, gender_source) for the corpus.
+    """
+    per_file = {}
+    for (result, window), labels in zip(windows, window_labels):
+        per_file.setdefault(id(result), (result, []))[1].append((labels, len(window)))
+    for result, votes in per_file.values():
+        result['emotion'] = weighted_vote([(labels['emotion'], weight) for labels, weight in votes], "No clear emotion detected")
+        result['gender'] = weighted_vote(
+            [(labels['gender'], weight) for labels, weight in votes if labels['gender'] != 'unknown'], "unknown"
+        )
+        result['windows'] = len(votes)
+    votes = [(labels, len(window)) for (_, window), labels in zip(windows, window_labels)]
+    detected_emotion = weighted_vote([(labels['emotion'], weight) for labels, weight in votes], "No clear emotion detected")
+    detected_gender = weighted_vote(
+        [(labels['gender'], weight) for labels, weight in votes if labels['gender'] != 'unknown'], "unknown"
+    )
+    emotion_source = combined_source(labels['emotion_source'] for labels in window_labels)
+    gender_source = combined_source(labels['gender_source'] for labels in window_labels)
+    return detected_emotion, emotion_source, detected_gender, gender_source
+
+def wait_for_task(future, deadline):
+    deadline.start()
+    while not future.done():
+        # The task may have extended its deadline while we waited, so check again before giving up.
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise FutureTimeoutError()
+        wait_futures([future], timeout=remaining)
+    return future.result()
+
+def map_bounded(fn, items, on_timeout=None):
+    """
+    fn(item) for each item on analyze_executor, in order, keeping at most ANALYZE_MAX_FANOUT of them
+    submitted at a time so one large request cannot queue ahead of every other. A result that is not
+    ready ANALYZE_TASK_TIMEOUT seconds (plus any extension the task asked for) after it is waited on
+    is replaced by on_timeout(item), or raises TimeoutError when on_timeout is None.
+    """
+    items = list(items)
+    pending = deque()
+    results = []
+    try:
+        while len(results) < len(items):
+            while len(results) + len(pending) < len(items) and len(pending) < ANALYZE_MAX_FANOUT:
+                deadline = TaskDeadline(ANALYZE_TASK_TIMEOUT)
+                item = items[len(results) + len(pending)]
+                pending.append((analyze_executor.submit(run_with_deadline, fn, item, deadline), deadline))
+            future, deadline = pending.popleft()
+            try:
+                results.append(wait_for_task(future, deadline))
+            except FutureTimeoutError:
+                future.cancel()
+                logger.error(f"Analyze task timed out after {deadline.seconds}s")
+                if on_timeout is None:
+                    raise TimeoutError(f"Analysis did not finish within {deadline.seconds} seconds")
+                results.append(on_timeout(items[len(results)]))
+    finally:
+        for future, _ in pending:
+            future.cancel()
+    return results
+
+def map_reduce_analysis(file_results):
+    """
+    Classify every file in windows of at most MAP_REDUCE_WINDOW_BYTES in parallel on analyze_executor,
+    then reduce with a length-weighted vote. Window labels are cached by content hash, so a file seen
+    before costs nothing, and no single prompt grows with the size of the batch.
+    """
+    windows = plan_analysis_windows(file_results)
+    window_labels = map_bounded(classify_window, [window for _, window in windows])
+    logger.info(f"Map-reduce analysis: {len(windows)} windows over {len(file_results)} files")
+    return reduce_window_labels(windows, window_labels)
+
+class CustomAnonThrottle(AnonRateThrottle):
+    rate = '30/minute'  # Adjust this value based on your needs
+
+class CustomUserThrottle(UserRateThrottle):
+    rate = '60/minute'  # Adjust this value based on your needs
+
+@api_view(['POST'])
+@throttle_classes([CustomAnonThrottle, CustomUserThrottle])
+def analyze_files(request):
+    logger.debug("Received analyze_files request")
+    try:
+        if upload_request_too_large(request):
+            return create_error_response(413, "Upload is too large.", f"Maximum request size is {MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024)} MB.")
+        use_upload_spool(request)
+        files = request.FILES.getlist('files')
+        if not files:
+            return create_error_response(400, "No files uploaded.", "Please upload at least one file to analyze.")
+        if len(files) > MAX_FILES_PER_BATCH:
+            return create_error_response(400, "Too many files uploaded.", f"Maximum of {MAX_FILES_PER_BATCH} files allowed.")
+        
+        analysis_mode = request.data.get('analysis_mode', ANALYSIS_MODE)
+        if analysis_mode not in ANALYSIS_MODES:
+            return create_error_response(400, "Invalid analysis mode", f"Choose one of: {', '.join(ANALYSIS_MODES)}")
+        
+        file_results = map_bounded(
+            lambda file: analyze_uploaded_file(file, analysis_mode), files,
+            on_timeout=lambda file: {'name': file.name, 'status': 'error', 'error': "Timed out"}
+        )
+        combined_text = [result['text'] for result in file_results if result['status'] == 'ok']
+        
+        if not combined_text:
+            failures = [result for result in file_results if result['status'] == 'error']
+            return create_error_response(400, "No valid text extracted.", failures or None)
+        
+        extracted_text = "\n\n".join(combined_text)
+        if analysis_mode == 'multi' and len(extracted_text) > MAP_REDUCE_AUTO_THRESHOLD_CHARS:
+            logger.info(f"Switching to map_reduce analysis for {len(extracted_text)} characters of text")
+            analysis_mode = 'map_reduce'
+        if analysis_mode == 'combined':
+            detected_emotion, emotion_source, detected_gender, gender_source = summarize_combined_results(file_results)
+        elif analysis_mode == 'map_reduce':
+            detected_emotion, emotion_source, detected_gender, gender_source = map_reduce_analysis(file_results)
+        else:
+            detected_emotion, emotion_source, detected_gender, gender_source = detect_emotion_and_gender(extracted_text)
+        for result in file_results:
+            result.pop('text', None)
+        logger.debug(f"Analyze files response: text_length={len(extracted_text)}, emotion={detected_emotion} ({emotion_source}), gender={detected_gender} ({gender_source})")
+        return JsonResponse({
+            'extracted_text': extracted_text,
+            'detected_emotion': detected_emotion,
+            'detected_gender': detected_gender,
+            'emotion_source': emotion_source,
+            'gender_source': gender_source,
+            'analysis_mode': analysis_mode,
+            'files': file_results
+        })
+    except Exception as e:
+        logger.error(f"Analyze files error: {str(e)}")
+        return create_error_response(500, "An unexpected error occurred.", str(e))
+
+def set_audio_cache_headers(response, etag):
+    response['ETag'] = f'"{etag}"'
+    response['Cache-Control'] = f'private, max-age={AUDIO_CACHE_MAX_AGE}'
+    return response
+
+def stream_generated_audio(text, voice_settings_list, detected_gender, tts_provider):
+    plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider)
+    cached = audio_cache.get(plan['cache_key'])
+    if cached is not None:
+        return build_audio_response(cached, False, etag=plan['cache_key'])
+    audio_stream = iter_tts_plan(plan)
+    # Pull the first chunk before responding so upstream errors on the first request still
+    # produce a proper error status instead of a truncated 200.
+    first_chunk = next(audio_stream, b'')
+
+    def relay():
+        pieces = [first_chunk]
+        try:
+            yield first_chunk
+            for piece in audio_stream:
+                pieces.append(piece)
+                yield piece
+            audio_cache.set(plan['cache_key'], join_synthesized_audio(plan, pieces))
+        except Exception as e:
+            logger.error(f"Audio stream aborted: {str(e)}")
+        finally:
+            audio_stream.close()
+
+    response = StreamingHttpResponse(relay(), content_type='audio/mp3')
+    response['Content-Disposition'] = 'attachment; filename="generated_audio.mp3"'
+    set_audio_cache_headers(response, plan['cache_key'])
+    logger.info(f"Streaming {tts_provider} audio")
+    return response
+
+def check_output_format(output_format, bitrate):
+    if output_format not in AUDIO_OUTPUT_FORMATS:
+        return create_error_response(400, "Invalid output format", f"Choose one of: {', '.join(AUDIO_OUTPUT_FORMATS)}")
+    if bitrate is not None and bitrate not in AUDIO_BITRATES:
+        return create_error_response(400, "Invalid bitrate", f"Choose one of: {', '.join(AUDIO_BITRATES)}")
+    if bitrate and output_format == 'wav':
+        return create_error_response(400, "Invalid bitrate", "WAV output is uncompressed and takes no bitrate")
+    return None
+
+def parse_generate_audio_request(data):
+    """
+    Validate a generate-audio request body. Returns (params, None) on success or
+    (None, error_response) so sync and async views share the same rules and messages.
+    """
+    params = {
+        'text': data.get('text', ''),
+        'voice_settings_list': data.get('voice_settings_list', []),
+        'detected_gender': data.get('detected_gender', 'unknown'),
+        'tts_provider': data.get('tts_provider', 'google'),
+        'use_background_music': data.get('use_background_music', False),
+        'music_file_url': data.get('music_file_url'),
+        'music_volume_db': data.get('music_volume_db', -20.0),
+        'music_ducking_db': data.get('music_ducking_db'),
+        'stream': data.get('stream', False),
+        'output_format': data.get('output_format', 'mp3'),
+        'bitrate': data.get('bitrate'),
+    }
+    text = params['text']
+    use_background_music = params['use_background_music']
+    music_volume_db = params['music_volume_db']
+
+    if not text:
+        return None, create_error_response(400, "No text provided.")
+    if len(text) > MAX_TEXT_LENGTH:
+        return None, create_error_response(400, "Text exceeds maximum length", f"Maximum {MAX_TEXT_LENGTH} characters allowed")
+    if not params['voice_settings_list'] or not isinstance(params['voice_settings_list'], list):
+        return None, create_error_response(400, "Invalid voice settings.")
+    if params['tts_provider'] not in ['google', 'gpt4o_mini']:
+        return None, create_error_response(400, "Invalid TTS provider", "Choose 'google' or 'gpt4o_mini'")
+    if params['detected_gender'] not in ['male', 'female', 'unknown']:
+        return None, create_error_response(400, "Invalid detected gender", "Must be 'male', 'female', or 'unknown'")
+    if not isinstance(use_background_music, bool):
+        return None, create_error_response(400, "Invalid use_background_music", "Must be a boolean")
+    if use_background_music and not params['music_file_url']:
+        return None, create_error_response(400, "Music file URL required", "Provide 'music_file_url' when 'use_background_music' is true")
+    if use_background_music and not isinstance(music_volume_db, (int, float)):
+        return None, create_error_response(400, "Invalid music volume", "music_volume_db must be a number")
+    if use_background_music and (music_volume_db < -30.0 or music_volume_db > 0.0):
+        return None, create_error_response(400, "Invalid music volume", "music_volume_db must be between -30.0 and 0.0 dB")
+    music_ducking_db = params['music_ducking_db']
+    if music_ducking_db is not None and (isinstance(music_ducking_db, bool) or not isinstance(music_ducking_db, (int, float))):
+        return None, create_error_response(400, "Invalid music ducking", "music_ducking_db must be a number")
+    if music_ducking_db is not None and (music_ducking_db < -30.0 or music_ducking_db > 0.0):
+        return None, create_error_response(400, "Invalid music ducking", "music_ducking_db must be between -30.0 and 0.0 dB")
+    if not isinstance(params['stream'], bool):
+        return None, create_error_response(400, "Invalid stream", "Must be a boolean")
+    if params['stream'] and use_background_music:
+        return None, create_error_response(400, "Streaming not available", "Background music needs the full narration, so 'stream' cannot be combined with 'use_background_music'")
+    error_response = check_output_format(params['output_format'], params['bitrate'])
+    if error_response:
+        return None, error_response
+    if params['stream'] and (params['output_format'] != 'mp3' or params['bitrate']):
+        return None, create_error_response(400, "Streaming not available", "Streaming is only available for mp3 output at the provider bitrate")
+    return params, None
+
+def read_wav_frames(wav_bytes):
+    """Decode 16-bit PCM WAV into an int16 (frames, channels) array resampled to MIX_SAMPLE_RATE."""
+    with wave.open(io.BytesIO(wav_bytes), 'rb') as reader:
+        if reader.getsampwidth() != 2:
+            raise ValueError("Only 16-bit PCM narration can be mixed")
+        channels = reader.getnchannels()
+        frame_rate = reader.getframerate()
+        data = reader.readframes(reader.getnframes())
+    frames = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+    if frame_rate == MIX_SAMPLE_RATE or not len(frames):
+        return frames
+    positions = np.arange(int(len(frames) * MIX_SAMPLE_RATE / frame_rate)) * (frame_rate / MIX_SAMPLE_RATE)
+    source = np.arange(len(frames))
+    resampled = np.stack([np.interp(positions, source, frames[:, channel]) for channel in range(channels)], axis=1)
+    return np.round(resampled).astype(np.int16)
+
+def ducking_envelope(narration, ducking_db):
+    """
+    Music gain per MIX_DUCKING_WINDOW_FRAMES window: ducking_db while the narration's RMS is above
+    MIX_DUCKING_THRESHOLD, 0 dB otherwise, smoothed so the music dips slightly ahead of speech.
+    """
+    window = MIX_DUCKING_WINDOW_FRAMES
+    rms = np.empty(-(-len(narration) // window), dtype=np.float32)
+    # Whole windows per block, about MIX_BLOCK_FRAMES, so the float copy stays the size of one mixing block.
+    block = window * max(1, MIX_BLOCK_FRAMES // window)
+    for start in range(0, len(narration), block):
+        piece = narration[start:start + block].astype(np.float32).mean(axis=1)
+        windows = -(-len(piece) // window)
+        padded = np.zeros(windows * window, dtype=np.float32)
+        padded[:len(piece)] = piece
+        rms[start // window:start // window + windows] = np.sqrt((padded.reshape(windows, window) ** 2).mean(axis=1))
+    if not len(rms):
+        return np.ones(0, dtype=np.float32)
+    gains = np.where(rms > MIX_DUCKING_THRESHOLD, np.float32(10 ** (ducking_db / 20)), np.float32(1.0))
+    smoothing = MIX_DUCKING_SMOOTHING_WINDOWS
+    kernel = np.ones(smoothing, dtype=np.float32) / smoothing
+    # Extend the ends with their own gain; zero padding would pull the music down at the start and end.
+    padded = np.pad(gains, (smoothing // 2, (smoothing - 1) // 2), mode='edge')
+    return np.convolve(padded, kernel, mode='valid').astype(np.float32)
+
+def mix_background_music(narration, music_pcm, music_volume_db, ducking_db=None):
+    """
+    Mix narration frames (int16, MIX_SAMPLE_RATE) with a music track read straight from its PCM
+    buffer, in fixed-size blocks. The music is looped by modular indexing, with a short
+    crossfade precomputed once for the seam between repetitions, and optionally ducked under
+    speech. Returns int16 (frames, MIX_CHANNELS).
+    """
+    started = time.perf_counter()
+    if MIX_TRACE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    music = np.frombuffer(music_pcm, dtype=np.int16).reshape(-1, MIX_CHANNELS)
+    try:
+        total = len(narration)
+        track_length = len(music)
+        if not track_length:
+            raise ValueError("Music track contains no audio")
+        output = np.empty((total, MIX_CHANNELS), dtype=np.int16)
+        gain = np.float32(10 ** (music_volume_db / 20))
+
+        period = track_length
+        crossfade = min(MIX_CROSSFADE_FRAMES, track_length // 2)
+        seam = None
+        if track_length < total and crossfade:
+            period = track_length - crossfade
+            fade_in = np.linspace(0.0, 1.0, crossfade, dtype=np.float32)[:, None]
+            seam = music[:crossfade] * fade_in + music[period:] * (1.0 - fade_in)
+
+        envelope = None
+        if ducking_db is not None:
+            envelope = ducking_envelope(narration, ducking_db)
+            window_centres = np.arange(len(envelope)) * MIX_DUCKING_WINDOW_FRAMES + MIX_DUCKING_WINDOW_FRAMES / 2
+
+        for start in range(0, total, MIX_BLOCK_FRAMES):
+            positions = np.arange(start, min(start + MIX_BLOCK_FRAMES, total))
+            indices = positions % period
+            block = music[indices].astype(np.float32)
+            if seam is not None:
+                in_seam = (indices < crossfade) & (positions >= period)
+                block[in_seam] = seam[indices[in_seam]]
+            block *= gain
+            if envelope is not None:
+                block *= np.interp(positions, window_centres, envelope).astype(np.float32)[:, None]
+            block += narration[positions[0]:positions[-1] + 1]
+            np.rint(block, out=block)
+            np.clip(block, -32768, 32767, out=block)
+            output[positions[0]:positions[-1] + 1] = block
+    finally:
+        # Drop the view so the caller can close the memory map.
+        del music
+    memory = ''
+    if MIX_TRACE_MEMORY:
+        memory = f", peak traced memory {tracemalloc.get_traced_memory()[1] / (1024 * 1024):.1f} MiB"
+    logger.info(f"Mixed {total / MIX_SAMPLE_RATE:.1f}s of audio in {(time.perf_counter() - started) * 1000:.0f} ms{memory}")
+    return output
+
+def encode_pcm_frames(frames, output_format, bitrate=None):
+    if output_format == 'wav':
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as writer:
+            writer.setnchannels(frames.shape[1])
+            writer.setsampwidth(2)
+            writer.setframerate(MIX_SAMPLE_RATE)
+            writer.writeframes(frames.tobytes())
+        return buffer.getvalue()
+    audio_segment = AudioSegment(data=frames.tobytes(), sample_width=2, frame_rate=MIX_SAMPLE_RATE, channels=frames.shape[1])
+    return encode_audio_segment(audio_segment, output_format, bitrate)
+
+def build_audio_response(audio_bytes, use_background_music, output_format="mp3", etag=None):
+    # Set filename based on music usage
+    final_file_name = f"generated_audio_with_music.{output_format}" if use_background_music else f"generated_audio.{output_format}"
+    response = HttpResponse(audio_bytes, content_type=AUDIO_OUTPUT_FORMATS[output_format]['content_type'])
+    response['Content-Disposition'] = f'attachment; filename="{final_file_name}"'
+    set_audio_cache_headers(response, etag or hashlib.sha256(audio_bytes).hexdigest())
+    logger.info(f"Audio generated successfully{' with background music' if use_background_music else ''}")
+    return response
+
+@api_view(['POST'])
+def generate_audio(request):
+    logger.debug(f"Received generate_audio request: {request.body}")
+    try:
+        data = json.loads(request.body)
+        params, error_response = parse_generate_audio_request(data)
+        if error_response:
+            return error_response
+        text = params['text']
+        voice_settings_list = params['voice_settings_list']
+        detected_gender = params['detected_gender']
+        tts_provider = params['tts_provider']
+        use_background_music = params['use_background_music']
+        music_file_url = params['music_file_url']
+        music_volume_db = params['music_volume_db']
+        output_format = params['output_format']
+        bitrate = params['bitrate']
+
+        if params['stream']:
+            return stream_generated_audio(text, voice_settings_list, detected_gender, tts_provider)
+
+        base_file_name = "generated_audio"
+        if not use_background_music:
+            # Passthrough: the provider already produced the requested format.
+            plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider, output_format, bitrate)
+            audio_content = synthesize_speech(plan)
+            return build_audio_response(audio_content, use_background_music, output_format, etag=plan['cache_key'])
+
+        # Mixing needs PCM anyway, so ask the provider for WAV and skip an MP3 decode
+        audio_content, audio_file_name, warning = text_to_speech(text, voice_settings_list, base_file_name, detected_gender, tts_provider, 'wav')
+        mixed_frames = read_wav_frames(audio_content)
+
+        # Handle background music if enabled
+        if use_background_music and music_file_url:
+            try:
+                logger.debug(f"Processing audio with background music: URL={music_file_url}, volume={music_volume_db}dB")
+                with music_store.open(music_file_url) as music_pcm:
+                    mixed_frames = mix_background_music(mixed_frames, music_pcm, music_volume_db, params['music_ducking_db'])
+            except MusicAssetError as e:
+                return create_error_response(e.status_code, e.message, e.details)
+            except RequestException as e:
+                logger.error(f"Failed to download music file: {str(e)}")
+                return create_error_response(500, "Failed to download music file", str(e))
+            except Exception as e:
+                logger.error(f"Failed to process music file: {str(e)}")
+                return create_error_response(500, "Failed to process music file", str(e))
+
+        audio_bytes = encode_pcm_frames(mixed_frames, output_format, bitrate)
+        return build_audio_response(audio_bytes, use_background_music, output_format)
+
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except ValueError as ve:
+        logger.error(f"Generate audio validation error: {str(ve)}")
+        return create_error_response(400, str(ve))
+    except Exception as e:
+        logger.error(f"Generate audio error: {str(e)}")
+        return create_error_response(500, "Failed to generate audio.", str(e))
+
+def parse_batch_render_request(data):
+    """
+    Validate a batch render body: either one text rendered with every entry of voice_settings_list,
+    or a list of segments with their own text and voice settings (e.g. dialogue lines per speaker).
+    Returns (renders, options, None) on success or (None, None, error_response).
+    """
+    default_provider = data.get('tts_provider', 'google')
+    segments = data.get('segments')
+    if segments is not None:
+        if not isinstance(segments, list) or not segments:
+            return None, None, create_error_response(400, "Invalid segments", "segments must be a non-empty list")
+        renders = []
+        for index, segment in enumerate(segments):
+            if not isinstance(segment, dict) or not segment.get('text') or not isinstance(segment.get('voice_settings'), dict):
+                return None, None, create_error_response(400, "Invalid segment", f"Segment {index} needs 'text' and 'voice_settings'")
+            renders.append({
+                'text': segment['text'],
+                'voice_settings': segment['voice_settings'],
+                'tts_provider': segment.get('tts_provider', default_provider),
+                'detected_gender': segment.get('detected_gender', 'unknown'),
+            })
+        if sum(len(render['text']) for render in renders) > MAX_TEXT_LENGTH:
+            return None, None, create_error_response(400, "Text exceeds maximum length", f"Maximum {MAX_TEXT_LENGTH} characters allowed across all segments")
+        default_output = 'stitched'
+    else:
+        text = data.get('text', '')
+        voice_settings_list = data.get('voice_settings_list', [])
+        if not text:
+            return None, None, create_error_response(400, "No text provided.")
+        if not voice_settings_list or not isinstance(voice_settings_list, list) or not all(isinstance(voice_settings, dict) for voice_settings in voice_settings_list):
+            return None, None, create_error_response(400, "Invalid voice settings.")
+        renders = [{
+            'text': text,
+            'voice_settings': voice_settings,
+            'tts_provider': voice_settings.get('tts_provider', default_provider),
+            'detected_gender': data.get('detected_gender', 'unknown'),
+        } for voice_settings in voice_settings_list]
+        default_output = 'zip'
+
+    if len(renders) > MAX_BATCH_RENDERS:
+        return None, None, create_error_response(400, "Too many renders", f"Maximum of {MAX_BATCH_RENDERS} voices or segments per request")
+    for index, render in enumerate(renders):
+        if render['tts_provider'] not in ['google', 'gpt4o_mini']:
+            return None, None, create_error_response(400, "Invalid TTS provider", f"Render {index}: choose 'google' or 'gpt4o_mini'")
+        if render['detected_gender'] not in ['male', 'female', 'unknown']:
+            return None, None, create_error_response(400, "Invalid detected gender", f"Render {index}: must be 'male', 'female', or 'unknown'")
+
+    options = {
+        'output': data.get('output', default_output),
+        'output_format': data.get('output_format', 'mp3'),
+        'bitrate': data.get('bitrate'),
+        'segment_gap_ms': data.get('segment_gap_ms', 300),
+    }
+    if options['output'] not in ['stitched', 'zip']:
+        return None, None, create_error_response(400, "Invalid output", "Choose 'stitched' or 'zip'")
+    error_response = check_output_format(options['output_format'], options['bitrate'])
+    if error_response:
+        return None, None, error_response
+    gap = options['segment_gap_ms']
+    if isinstance(gap, bool) or not isinstance(gap, (int, float)) or not (0 <= gap <= 5000):
+        return None, None, create_error_response(400, "Invalid segment gap", "segment_gap_ms must be a number between 0 and 5000")
+    return renders, options, None
+
+def stitch_renders(wav_renders, gap_ms, output_format, bitrate=None):
+    # Renders can come from different providers and voices, so they are joined as PCM, not as MP3 frames.
+    gap = np.zeros((int(MIX_SAMPLE_RATE * gap_ms / 1000), 1), dtype=np.int16)
+    parts = []
+    for index, wav_bytes in enumerate(wav_renders):
+        frames = read_wav_frames(wav_bytes)
+        if frames.shape[1] > 1:
+            frames = np.round(frames.mean(axis=1, keepdims=True)).astype(np.int16)
+        if index:
+            parts.append(gap)
+        parts.append(frames)
+    return encode_pcm_frames(np.concatenate(parts), output_format, bitrate)
+
+def build_render_archive(renders, audio_files, output_format):
+    buffer = io.BytesIO()
+    # Audio is already compressed (or is WAV, which the client expects raw), so entries are stored.
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for index, (render, audio) in enumerate(zip(renders, audio_files)):
+            voice_name = re.sub(r'[^\w.-]+', '_', str(render['voice_settings'].get('voice_name', 'voice')))
+            archive.writestr(f"{index + 1:02d}_{voice_name}.{output_format}", audio)
+    response = HttpResponse(buffer.getvalue(), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="generated_audio_batch.zip"'
+    logger.info(f"Batch of {len(audio_files)} renders generated successfully")
+    return response
+
+@api_view(['POST'])
+def generate_audio_batch(request):
+    """
+    Render several voices or dialogue segments in one request. Every render is validated before
+    any synthesis starts, then all of them are synthesized concurrently. The result is one
+    stitched track or a zip of per-render files.
+    """
+    logger.debug("Received generate_audio_batch request")
+    try:
+        data = json.loads(request.body)
+        renders, options, error_response = parse_batch_render_request(data)
+        if error_response:
+            return error_response
+        stitched = options['output'] == 'stitched'
+
+        plans = []
+        for index, render in enumerate(renders):
+            try:
+                plans.append(plan_speech(
+                    render['text'], [render['voice_settings']], render['detected_gender'], render['tts_provider'],
+                    'wav' if stitched else options['output_format'], None if stitched else options['bitrate']
+                ))
+            except ValueError as ve:
+                return create_error_response(400, f"Invalid render {index}", str(ve))
+
+        futures = [batch_render_executor.submit(synthesize_speech, plan) for plan in plans]
+        audio_files = [future.result() for future in futures]
+
+        if stitched:
+            audio_bytes = stitch_renders(audio_files, options['segment_gap_ms'], options['output_format'], options['bitrate'])
+            return build_audio_response(audio_bytes, False, options['output_format'])
+        return build_render_archive(renders, audio_files, options['output_format'])
+
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except ValueError as ve:
+        logger.error(f"Generate audio batch validation error: {str(ve)}")
+        return create_error_response(400, str(ve))
+    except Exception as e:
+        logger.error(f"Generate audio batch error: {str(e)}")
+        return create_error_response(500, "Failed to generate audio.", str(e))
+
+@api_view(['GET'])
+def available_voices(request):
+    logger.debug("Received available_voices request")
+    try:
+        body, etag = voice_catalog.get_view(request.GET.get('language_code'), request.GET.get('gender'))
+        if etag_matches(request, etag):
+            response = HttpResponse(status=304)
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = f'public, max-age={VOICE_CATALOG_MAX_AGE}'
+        return response
+    except Exception as e:
+        logger.error(f"Available voices error: {str(e)}")
+        return create_error_response(500, "Failed to fetch available voices.", str(e))
+
+@api_view(['GET'])
+def pool_stats(request):
+    logger.debug("Received pool_stats request")
+    return JsonResponse({
+        'google_clients': google_clients.stats(),
+        'upstreams': {client.name: client.stats() for client in UPSTREAM_CLIENTS},
+        'negotiation': upstream_negotiation.stats(),
+        'voice_catalog': voice_catalog.stats(),
+        'caches': {
+            'extraction': extraction_cache.stats(),
+            'audio': audio_cache.stats(),
+            'music': music_cache.stats(),
+        },
+    })
+
+# Asyncio request path. These views are meant to run under ASGI (backend/asgi.py), where a single
+# worker can keep many slow upstream calls in flight; concurrency per upstream is capped by
+# ASYNC_UPSTREAM_LIMITS. Validation, caching and prompt building are shared with the sync views.
+
+def check_throttles(request, throttle_classes):
+    """
+    Run DRF throttles for a plain Django view, as @api_view does for the sync views. Returns the
+    error response to send, or None when the request may proceed. Touches the session, so call it
+    through sync_to_async.
+    """
+    drf_request = DRFRequest(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        waits = []
+        for throttle_class in throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(drf_request, None):
+                waits.append(throttle.wait())
+    except APIException as e:
+        return JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+    if not waits:
+        return None
+    wait = max((wait for wait in waits if wait is not None), default=None)
+    throttled = Throttled(wait)
+    response = JsonResponse({'detail': str(throttled.detail)}, status=throttled.status_code)
+    if throttled.wait is not None:
+        response['Retry-After'] = '%d' % throttled.wait
+    return response
+
+_async_loop_state = weakref.WeakKeyDictionary()
+
+async def close_grpc_client(client):
+    try:
+        await client.transport.close()
+    except Exception as e:
+        logger.warning(f"Failed to close async client: {str(e)}")
+
+async def async_loop_cleanup(state):
+    """
+    Parked on the loop as an async generator: asyncio.run() and asgiref call shutdown_asyncgens()
+    before closing a loop, which runs the finally block while the loop can still await.
+    """
+    try:
+        yield
+    finally:
+        # The generator holds a reference to its loop, so drop it to let the loop be collected.
+        state.pop('cleanup', None)
+        await state['http_client'].aclose()
+        for model in state['gemini_models'].values():
+            await close_grpc_client(model._async_client)
+        for client in google_clients.pop_async_clients(asyncio.get_running_loop()):
+            await close_grpc_client(client)
+
+def get_async_loop_state():
+    # httpx clients, grpc.aio channels and asyncio semaphores are bound to the event loop they are
+    # first used on. They are closed when that loop shuts down.
+    loop = asyncio.get_running_loop()
+    state = _async_loop_state.get(loop)
+    if state is None:
+        state = {
+            'http_client': httpx.AsyncClient(
+                timeout=30,
+                limits=httpx.Limits(max_connections=sum(ASYNC_UPSTREAM_LIMITS.values()), max_keepalive_connections=32)
+            ),
+            'semaphores': {name: asyncio.Semaphore(limit) for name, limit in ASYNC_UPSTREAM_LIMITS.items()},
+            'gemini_models': {},
+        }
+        # Advance the generator to its yield without awaiting (nothing before it suspends). That
+        # registers it with the loop; keeping a reference stops it from being finalized early.
+        cleanup = async_loop_cleanup(state)
+        try:
+            cleanup.asend(None).send(None)
+        except StopIteration:
+            pass
+        state['cleanup'] = cleanup
+        _async_loop_state[loop] = state
+    return state
+
+def get_async_gemini_model(structured=False):
+    """
+    Return a GenerativeModel for the running loop. The library hands every model one process-wide
+    grpc.aio client, which would be bound to whichever loop used it first, so each loop's models
+    get a client of their own.
+    """
+    models = get_async_loop_state()['gemini_models']
+    model = models.get(structured)
+    if model is None:
+        model = build_gemini_model(structured)
+        model._async_client = genai_client._client_manager.make_client('generative_async')
+        models[structured] = model
+    return model
+
+def get_async_http_client():
+    return get_async_loop_state()['http_client']
+
+def async_upstream_limit(name):
+    return get_async_loop_state()['semaphores'][name]
+
+async def async_process_document(file_path, mime_type, is_batch=False):
+    try:
+        client = google_clients.get_async_client('documentai', f"{LOCATION}-documentai.googleapis.com")
+        name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+        request = await asyncio.to_thread(build_process_request, name, file_path, mime_type, is_batch)
+        async with async_upstream_limit('documentai'):
+            result = await client.process_document(request=request)
+        return check_processed_document(result.document, request)
+    except FileNotFoundError as e:
+        logger.error(f"Document AI error: {str(e)}")
+        raise
+    except ValueError as ve:
+        logger.error(f"Document AI validation error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to process document with Document AI: {str(e)}")
+        raise
+
+async def async_process_document_content(content, mime_type):
+    try:
+        client = google_clients.get_async_client('documentai', f"{LOCATION}-documentai.googleapis.com")
+        name = client.processor_path(PROJECT_ID, LOCATION, PROCESSOR_ID)
+        request = build_content_process_request(name, content, mime_type)
+        async with async_upstream_limit('documentai'):
+            result = await client.process_document(request=request)
+        return check_processed_document(result.document, request)
+    except ValueError as ve:
+        logger.error(f"Document AI validation error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to process document with Document AI: {str(e)}")
+        raise
+
+async def async_ocr_pdf_shard(pieces, shard_limit):
+    try:
+        page_texts = []
+        for _, content in pieces:
+            shard_key = shard_cache_key(content)
+            cached = await asyncio.to_thread(extraction_cache.get_json, shard_key)
+            if cached is None:
+                document = await async_process_document_content(content, DOCUMENT_AI_MIME_TYPES['pdf'])
+                cached = {'pages': document_page_texts(document)}
+                await asyncio.to_thread(extraction_cache.set_json, shard_key, cached)
+            page_texts.extend(cached['pages'])
+        return page_texts
+    finally:
+        shard_limit.release()
+
+async def async_ocr_pdf(reader, pages):
+    # Bounds how many shards are rendered and held in memory at once for this file. Shards are
+    # rendered one after another, so the reader is never used by two threads at the same time.
+    shard_limit = asyncio.Semaphore(PDF_SHARD_MAX_WORKERS)
+    tasks = []
+    try:
+        for shard in split_pages(pages, PDF_SHARD_MAX_PAGES):
+            await shard_limit.acquire()
+            try:
+                pieces = await asyncio.to_thread(render_pdf_shards, reader, shard)
+            except BaseException:
+                shard_limit.release()
+                raise
+            tasks.append(asyncio.create_task(async_ocr_pdf_shard(pieces, shard_limit)))
+    except Exception:
+        # Let the shards already sent finish, so they are cached for a retry.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    page_texts = []
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+        page_texts.extend(result)
+    return page_texts
+
+async def async_read_pdf_text_layer(file_path, page_count):
+    if not PDF_TEXT_LAYER_ENABLED or not page_count:
+        return [None] * page_count
+    try:
+        loop = asyncio.get_running_loop()
+        pool = get_local_extraction_pool()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, extract_pdf_text_layer, file_path, batch, PDF_TEXT_LAYER_MIN_CHARS, PDF_TEXT_LAYER_MAX_SUSPECT_RATIO)
+            for batch in split_pages(list(range(page_count)), PDF_TEXT_LAYER_PAGES_PER_TASK)
+        ))
+        return [text for batch_texts in results for text in batch_texts]
+    except Exception as e:
+        logger.error(f"PDF text layer extraction failed, falling back to OCR: {str(e)}")
+        return [None] * page_count
+
+async def async_extract_pdf_text(file_path):
+    stream = await asyncio.to_thread(open, file_path, 'rb')
+    try:
+        reader = await asyncio.to_thread(open_pdf, stream)
+        page_count = len(reader.pages)
+        page_texts = await async_read_pdf_text_layer(file_path, page_count)
+        ocr_pages = [index for index, text in enumerate(page_texts) if text is None]
+        return fill_ocr_pages(page_texts, ocr_pages, await async_ocr_pdf(reader, ocr_pages) if ocr_pages else [])
+    finally:
+        stream.close()
+
+async def async_prepare_image_pages(file_path):
+    if not IMAGE_PREPROCESSING_ENABLED:
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            get_local_extraction_pool(), preprocess_image, file_path, IMAGE_OCR_TARGET_DPI, IMAGE_OCR_MAX_EDGE,
+            MAX_IMAGE_RESOLUTION, IMAGE_OCR_JPEG_QUALITY, IMAGE_OCR_MAX_FRAMES
+        )
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Image preprocessing failed, sending the original: {str(e)}")
+        return None
+
+async def async_ocr_image_page(content, mime_type):
+    page_key = shard_cache_key(content)
+    cached = await asyncio.to_thread(extraction_cache.get_json, page_key)
+    if cached is None:
+        document = await async_process_document_content(content, mime_type)
+        cached = {'pages': [format_extracted_text(document)]}
+        await asyncio.to_thread(extraction_cache.set_json, page_key, cached)
+    return cached['pages'][0]
+
+async def async_extract_image_text(file_path, mime_type):
+    pages = await async_prepare_image_pages(file_path)
+    if pages is None:
+        document = await async_process_document(file_path, mime_type)
+        return format_extracted_text(document) if document else None
+    results = await asyncio.gather(
+        *(async_ocr_image_page(content, page_mime_type) for content, page_mime_type in pages),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return merge_page_texts(results)
+
+async def async_extract_text_from_file(file_path, file_extension):
+    if file_extension == 'pdf':
+        return await async_extract_pdf_text(file_path)
+    if file_extension in DOCUMENT_AI_MIME_TYPES:
+        return await async_extract_image_text(file_path, DOCUMENT_AI_MIME_TYPES[file_extension])
+    return await asyncio.to_thread(extract_text_from_file, file_path, file_extension)
+
+async def async_get_gemini_response(prompt, document_text):
+    try:
+        model = get_async_gemini_model()
+        async with async_upstream_limit('gemini'):
+            response = await model.generate_content_async([document_text, prompt])
+        if not response.text:
+            raise ValueError("Gemini API returned an empty response.")
+        return response.text
+    except ValueError as ve:
+        logger.error(f"Gemini error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error with Gemini API: {str(e)}")
+        raise
+
+async def async_analyze_text_combined(document_text):
+    try:
+        model = get_async_gemini_model(structured=True)
+        async with async_upstream_limit('gemini'):
+            response = await model.generate_content_async([document_text, COMBINED_ANALYSIS_PROMPT])
+        if not response.text:
+            raise ValueError("Gemini API returned an empty response.")
+        return parse_combined_analysis(response.text)
+    except ValueError as ve:
+        logger.error(f"Gemini combined analysis error: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error with Gemini API: {str(e)}")
+        raise
+
+async def async_filter_flagged_sentences(text, spans):
+    sentences = [text[start:end] for start, end in spans]
+    response = await async_get_gemini_response(build_sentence_filter_prompt(len(sentences)), number_sentences(sentences))
+    return splice_filtered_sentences(text, spans, response)
+
+async def async_filter_unethical_text_with_prompt(text):
+    spans = await asyncio.to_thread(flag_profane_sentences, text)
+    if spans == []:
+        return text
+    if spans:
+        cleaned_text = await async_filter_flagged_sentences(text, spans)
+        if cleaned_text is not None:
+            return cleaned_text.strip()
+        logger.warning("Sentence filter reply did not match the flagged sentences; filtering the whole text")
+    cleaned_text = await async_get_gemini_response(build_filter_prompt(text), text)
+    return cleaned_text.strip() if cleaned_text else text
+
+async def async_detect_emotions_with_ai(text):
+    response = await async_get_gemini_response(build_emotion_prompt(text), text)
+    return response.strip() if response else "No clear emotion detected"
+
+async def async_detect_gender_with_ai(text):
+    response = await async_get_gemini_response(build_gender_prompt(text), text)
+    return normalize_detected_gender(response)
+
+async def async_classify_window(window):
+    window_key = window_cache_key(window)
+    labels = await asyncio.to_thread(extraction_cache.get_json, window_key)
+    if labels is None:
+        emotion, emotion_source, gender, gender_source = await async_detect_emotion_and_gender(window)
+        labels = {'emotion': emotion, 'emotion_source': emotion_source, 'gender': gender, 'gender_source': gender_source}
+        await asyncio.to_thread(extraction_cache.set_json, window_key, labels)
+    return labels
+
+async def async_map_reduce_analysis(file_results):
+    windows = await asyncio.to_thread(plan_analysis_windows, file_results)
+    window_labels = await asyncio.gather(*(async_classify_window(window) for _, window in windows))
+    logger.info(f"Map-reduce analysis: {len(windows)} windows over {len(file_results)} files")
+    return reduce_window_labels(windows, window_labels)
+
+async def async_detect_emotion_and_gender(text):
+    (gender, _), (emotion, _) = await asyncio.to_thread(classify_with_lexicons, text)
+    emotion_source = 'lexicon' if emotion is not None else 'gemini'
+    gender_source = 'lexicon' if gender is not None else 'gemini'
+
+    async def answer(label, fallback):
+        return label if label is not None else await fallback(text)
+
+    emotion, gender = await asyncio.gather(
+        answer(emotion, async_detect_emotions_with_ai),
+        answer(gender, async_detect_gender_with_ai)
+    )
+    return emotion, emotion_source, gender, gender_source
+
+async def async_load_raw_document_text(upload):
+    raw_key = extraction_cache_key(upload.sha256, 'raw')
+    cached_raw = await asyncio.to_thread(extraction_cache.get_json, raw_key)
+    if cached_raw is not None:
+        return cached_raw['text']
+    document_text = await async_extract_text_from_file(upload.path, upload.kind)
+    await asyncio.to_thread(extraction_cache.set_json, raw_key, {'text': document_text or ''})
+    return document_text
+
+async def async_extract_cleaned_text_from_upload(upload):
+    cleaned_key = extraction_cache_key(upload.sha256, 'cleaned')
+    cached = await asyncio.to_thread(extraction_cache.get_json, cleaned_key)
+    if cached is not None:
+        logger.debug(f"Extraction cache hit for '{upload.name}' ({upload.sha256})")
+        return cached['text']
+
+    document_text = await async_load_raw_document_text(upload)
+    cleaned_text = ''
+    if document_text:
+        extracted_text = await async_get_gemini_response(URDU_EXTRACTION_PROMPT, document_text)
+        if extracted_text:
+            cleaned_text = await async_filter_unethical_text_with_prompt(extracted_text) or ''
+    await asyncio.to_thread(extraction_cache.set_json, cleaned_key, {'text': cleaned_text})
+    return cleaned_text
+
+async def async_refine_combined_analysis(analysis):
+    text = analysis['text']
+    spans = await asyncio.to_thread(flag_profane_sentences, text)
+    if spans:
+        cleaned_text = await async_filter_flagged_sentences(text, spans)
+        if cleaned_text is not None:
+            text = cleaned_text.strip()
+        else:
+            logger.warning("Sentence filter reply did not match the flagged sentences; keeping the combined result")
+    labels = await asyncio.to_thread(combined_lexicon_labels, analysis, text)
+    return dict(analysis, text=text, **labels)
+
+async def async_analyze_upload_combined(upload):
+    combined_key = extraction_cache_key(upload.sha256, 'combined')
+    cached = await asyncio.to_thread(extraction_cache.get_json, combined_key)
+    if cached is not None:
+        logger.debug(f"Combined analysis cache hit for '{upload.name}' ({upload.sha256})")
+        return cached
+
+    document_text = await async_load_raw_document_text(upload)
+    analysis = {'text': '', 'emotion': None, 'gender': 'unknown'}
+    if document_text:
+        analysis = await async_refine_combined_analysis(await async_analyze_text_combined(document_text))
+    await asyncio.to_thread(extraction_cache.set_json, combined_key, analysis)
+    return analysis
+
+async def async_analyze_uploaded_file(file, analysis_mode='multi'):
+    upload = None
+    try:
+        upload = await asyncio.to_thread(ingest_upload, file)
+        if upload.error:
+            return {'name': file.name, 'status': 'error', 'error': upload.error}
+        if analysis_mode == 'combined':
+            analysis = await async_analyze_upload_combined(upload)
+        else:
+            analysis = {'text': await async_extract_cleaned_text_from_upload(upload)}
+    except Exception as e:
+        logger.error(f"Failed to analyze '{file.name}': {str(e)}")
+        return {'name': file.name, 'status': 'error', 'error': str(e)}
+    finally:
+        await asyncio.to_thread(file.close)
+        if upload is not None:
+            upload.close()
+    if not analysis['text']:
+        return {'name': file.name, 'status': 'empty'}
+    return dict(analysis, name=file.name, status='ok')
+
+async def async_synthesize_tts_segment(plan, chunk, client=None):
+    segment_key = tts_segment_cache_key(plan, chunk)
+    cached = await asyncio.to_thread(audio_cache.get, segment_key)
+    if cached is not None:
+        return cached
+    if plan['provider'] == 'gpt4o_mini':
+        response = await openai_client.async_request(
+            'POST', OPENAI_TTS_URL, limit=async_upstream_limit('openai'), headers=plan['headers'],
+            json=dict(plan['payload'], input=chunk), timeout=30
+        )
+        if response.status_code != 200:
+            logger.error(f"GPT-4o mini TTS API error: {response.status_code} - {response.text}")
+            raise Exception(f"GPT-4o mini TTS API error: {response.text}")
+        audio = response.content
+    else:
+        async with async_upstream_limit('texttospeech'):
+            response = await client.synthesize_speech(
+                input=google_synthesis_input(chunk, plan['input_type']), voice=plan['voice'], audio_config=plan['audio_config']
+            )
+        audio = response.audio_content
+    await asyncio.to_thread(audio_cache.set, segment_key, audio)
+    return audio
+
+async def async_iter_tts_segments(plan):
+    client = google_clients.get_async_client('texttospeech') if plan['provider'] == 'google' else None
+    tasks = [asyncio.ensure_future(async_synthesize_tts_segment(plan, chunk, client)) for chunk in plan['chunks']]
+    is_mp3 = plan['encoding'] == 'mp3'
+    try:
+        for task in tasks:
+            audio = await task
+            yield strip_id3_tags(audio) if is_mp3 else audio
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def async_iter_gpt4o_mini_speech(headers, payload):
+    client = get_async_http_client()
+    async with async_upstream_limit('openai'):
+        async with client.stream('POST', OPENAI_TTS_URL, headers=headers, json=payload, timeout=30) as response:
+            if response.status_code != 200:
+                error_text = (await response.aread()).decode('utf-8', errors='replace')
+                logger.error(f"GPT-4o mini TTS API error: {response.status_code} - {error_text}")
+                raise Exception(f"GPT-4o mini TTS API error: {error_text}")
+            async for piece in response.aiter_bytes(AUDIO_STREAM_CHUNK_SIZE):
+                yield piece
+
+def async_iter_tts_plan(plan):
+    if plan['provider'] == 'gpt4o_mini' and len(plan['chunks']) == 1:
+        return async_iter_gpt4o_mini_speech(plan['headers'], plan['payload'])
+    return async_iter_tts_segments(plan)
+
+async def async_synthesize_speech(plan):
+    cached = await asyncio.to_thread(audio_cache.get, plan['cache_key'])
+    if cached is not None:
+        logger.debug(f"Audio cache hit: {plan['cache_key']}")
+        return cached
+    try:
+        pieces = [piece async for piece in async_iter_tts_plan(plan)]
+    except Exception as e:
+        logger.error(f"Error generating audio: {str(e)}")
+        raise
+    audio_content = await asyncio.to_thread(finish_synthesized_audio, plan, pieces)
+    await asyncio.to_thread(audio_cache.set, plan['cache_key'], audio_content)
+    return audio_content
+
+async def async_text_to_speech(text, voice_settings_list, detected_gender, tts_provider="google",
+                               output_format="mp3", bitrate=None):
+    plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider, output_format, bitrate)
+    return await async_synthesize_speech(plan)
+
+@csrf_exempt
+async def analyze_files_async(request):
+    logger.debug("Received analyze_files_async request")
+    if request.method != "POST":
+        return create_error_response(405, "Only POST requests allowed")
+    try:
+        if upload_request_too_large(request):
+            return create_error_response(413, "Upload is too large.", f"Maximum request size is {MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024)} MB.")
+        use_upload_spool(request)
+        throttled = await sync_to_async(check_throttles)(request, [CustomAnonThrottle, CustomUserThrottle])
+        if throttled:
+            return throttled
+        files = await sync_to_async(request.FILES.getlist)('files')
+        if not files:
+            return create_error_response(400, "No files uploaded.", "Please upload at least one file to analyze.")
+        if len(files) > MAX_FILES_PER_BATCH:
+            return create_error_response(400, "Too many files uploaded.", f"Maximum of {MAX_FILES_PER_BATCH} files allowed.")
+
+        analysis_mode = (await sync_to_async(request.POST.get)('analysis_mode')) or ANALYSIS_MODE
+        if analysis_mode not in ANALYSIS_MODES:
+            return create_error_response(400, "Invalid analysis mode", f"Choose one of: {', '.join(ANALYSIS_MODES)}")
+
+        # Same bound as the sync view's map_bounded: at most ANALYZE_MAX_FANOUT files in flight.
+        fanout = asyncio.Semaphore(ANALYZE_MAX_FANOUT)
+
+        async def analyze_bounded(file):
+            async with fanout:
+                return await async_analyze_uploaded_file(file, analysis_mode)
+
+        file_results = await asyncio.gather(*(analyze_bounded(file) for file in files))
+        combined_text = [result['text'] for result in file_results if result['status'] == 'ok']
+
+        if not combined_text:
+            failures = [result for result in file_results if result['status'] == 'error']
+            return create_error_response(400, "No valid text extracted.", failures or None)
+
+        extracted_text = "\n\n".join(combined_text)
+        if analysis_mode == 'multi' and len(extracted_text) > MAP_REDUCE_AUTO_THRESHOLD_CHARS:
+            logger.info(f"Switching to map_reduce analysis for {len(extracted_text)} characters of text")
+            analysis_mode = 'map_reduce'
+        if analysis_mode == 'combined':
+            detected_emotion, emotion_source, detected_gender, gender_source = summarize_combined_results(file_results)
+        elif analysis_mode == 'map_reduce':
+            detected_emotion, emotion_source, detected_gender, gender_source = await async_map_reduce_analysis(file_results)
+        else:
+            detected_emotion, emotion_source, detected_gender, gender_source = await async_detect_emotion_and_gender(extracted_text)
+        for result in file_results:
+            result.pop('text', None)
+        logger.debug(f"Analyze files response: text_length={len(extracted_text)}, emotion={detected_emotion} ({emotion_source}), gender={detected_gender} ({gender_source})")
+        return JsonResponse({
+            'extracted_text': extracted_text,
+            'detected_emotion': detected_emotion,
+            'detected_gender': detected_gender,
+            'emotion_source': emotion_source,
+            'gender_source': gender_source,
+            'analysis_mode': analysis_mode,
+            'files': list(file_results)
+        })
+    except Exception as e:
+        logger.error(f"Analyze files error: {str(e)}")
+        return create_error_response(500, "An unexpected error occurred.", str(e))
+
+async def async_stream_generated_audio(text, voice_settings_list, detected_gender, tts_provider):
+    plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider)
+    cached = await asyncio.to_thread(audio_cache.get, plan['cache_key'])
+    if cached is not None:
+        return build_audio_response(cached, False, etag=plan['cache_key'])
+    audio_stream = async_iter_tts_plan(plan)
+    first_chunk = await anext(audio_stream, b'')
+
+    async def relay():
+        pieces = [first_chunk]
+        try:
+            yield first_chunk
+            async for piece in audio_stream:
+                pieces.append(piece)
+                yield piece
+            await asyncio.to_thread(audio_cache.set, plan['cache_key'], join_synthesized_audio(plan, pieces))
+        except Exception as e:
+            logger.error(f"Audio stream aborted: {str(e)}")
+        finally:
+            await audio_stream.aclose()
+
+    response = StreamingHttpResponse(relay(), content_type='audio/mp3')
+    response['Content-Disposition'] = 'attachment; filename="generated_audio.mp3"'
+    set_audio_cache_headers(response, plan['cache_key'])
+    logger.info(f"Streaming {tts_provider} audio")
+    return response
+
+@csrf_exempt
+async def generate_audio_async(request):
+    logger.debug("Received generate_audio_async request")
+    if request.method != "POST":
+        return create_error_response(405, "Only POST requests allowed")
+    throttled = await sync_to_async(check_throttles)(request, api_settings.DEFAULT_THROTTLE_CLASSES)
+    if throttled:
+        return throttled
+    try:
+        data = json.loads(request.body)
+        params, error_response = parse_generate_audio_request(data)
+        if error_response:
+            return error_response
+        text = params['text']
+        voice_settings_list = params['voice_settings_list']
+        detected_gender = params['detected_gender']
+        tts_provider = params['tts_provider']
+        use_background_music = params['use_background_music']
+        music_file_url = params['music_file_url']
+        music_volume_db = params['music_volume_db']
+        output_format = params['output_format']
+        bitrate = params['bitrate']
+
+        if params['stream']:
+            return await async_stream_generated_audio(text, voice_settings_list, detected_gender, tts_provider)
+
+        if not use_background_music:
+            plan = plan_speech(text, voice_settings_list, detected_gender, tts_provider, output_format, bitrate)
+            audio_content = await async_synthesize_speech(plan)
+            return build_audio_response(audio_content, use_background_music, output_format, etag=plan['cache_key'])
+
+        audio_content = await async_text_to_speech(text, voice_settings_list, detected_gender, tts_provider, 'wav')
+        mixed_frames = await asyncio.to_thread(read_wav_frames, audio_content)
+
+        if use_background_music and music_file_url:
+            try:
+                logger.debug(f"Processing audio with background music: URL={music_file_url}, volume={music_volume_db}dB")
+                music_pcm = await asyncio.to_thread(music_store.open, music_file_url)
+                with music_pcm:
+                    mixed_frames = await asyncio.to_thread(
+                        mix_background_music, mixed_frames, music_pcm, music_volume_db, params['music_ducking_db']
+                    )
+            except MusicAssetError as e:
+                return create_error_response(e.status_code, e.message, e.details)
+            except RequestException as e:
+                logger.error(f"Failed to download music file: {str(e)}")
+                return create_error_response(500, "Failed to download music file", str(e))
+            except Exception as e:
+                logger.error(f"Failed to process music file: {str(e)}")
+                return create_error_response(500, "Failed to process music file", str(e))
+
+        audio_bytes = await asyncio.to_thread(encode_pcm_frames, mixed_frames, output_format, bitrate)
+        return build_audio_response(audio_bytes, use_background_music, output_format)
+
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except ValueError as ve:
+        logger.error(f"Generate audio validation error: {str(ve)}")
+        return create_error_response(400, str(ve))
+    except Exception as e:
+        logger.error(f"Generate audio error: {str(e)}")
+        return create_error_response(500, "Failed to generate audio.", str(e))
+
+async def async_request_loudly_music(prompt, duration):
+    negotiation = LoudlyNegotiation(prompt, duration)
+    for variant, request_kwargs in negotiation:
+        try:
+            response = await loudly_client.async_request(
+                'POST', variant[0], limit=async_upstream_limit('loudly'), **request_kwargs
+            )
+        except (httpx.HTTPError, UpstreamUnavailableError) as e:
+            negotiation.network_error(variant, e)
+            continue
+        response_data = negotiation.response(variant, response)
+        if response_data is not None:
+            return response_data
+    raise negotiation.error()
+
+@csrf_exempt
+async def generate_music_with_prompt_async(request):
+    """
+    Asyncio variant of generate_music_with_prompt: same attempts against the Loudly API, made
+    with a shared httpx client so the worker is free while they are in flight.
+    """
+    if request.method != "POST":
+        return create_error_response(405, "Only POST requests allowed")
+    throttled = await sync_to_async(check_throttles)(request, api_settings.DEFAULT_THROTTLE_CLASSES)
+    if throttled:
+        return throttled
+
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+        prompt, duration, error_response = parse_music_request(body)
+        if error_response:
+            return error_response
+        response_data = await async_request_loudly_music(prompt, duration)
+        return JsonResponse(response_data, status=200)
+
+    except MusicGenerationError as e:
+        return create_error_response(e.status_code, e.message, e.details)
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON in request body")
+        return create_error_response(400, "Invalid JSON format in request body")
+    except Exception as e:
+        logger.error(f"Unexpected error in generate_music_with_prompt_async: {str(e)}", exc_info=True)
+        return create_error_response(500, "An unexpected error occurred", str(e))